@@ -0,0 +1,210 @@
+# CPU benchmarks of the data pipeline and the models on synthetic data
+
+import os
+import argparse
+import json
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../model"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../datasets"))
+from generator import Generator
+from discriminator import Discriminator
+from basicblock import VoxelShuffle, ConvLSTMCell
+from trainDataset import TVDataset, volume_loader
+import utils
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: 1)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="number of intra-op threads (default: torch default)")
+    parser.add_argument("--quick", action="store_true", default=False,
+                        help="only the smallest block size and step count")
+    parser.add_argument("--filter", type=str, default="",
+                        help="only run the benchmarks whose name contains the given string")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="untimed runs before measuring")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timed runs per benchmark")
+    parser.add_argument("--results", type=str, default="results.json",
+                        help="results of every commit, keyed by the git commit")
+    parser.add_argument("--baseline", type=str, default="",
+                        help="commit in the results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown of the median flagged as a regression")
+    return parser.parse_args()
+
+def git_commit():
+    # the working tree state is part of the key, so uncommitted changes never overwrite a commit's results
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=root).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+def measure(fn, warmup, repeat):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - tic)
+    return {"median": float(np.median(times)), "min": float(np.min(times)), "max": float(np.max(times)),
+            "repeat": repeat}
+
+def write_tiles(root, sub_size, num_tiles, max_k):
+    # a TVDataset list over random tiles, one window of max_k intermediate volumes per tile
+    os.makedirs(os.path.join(root, "train_cropped"))
+    names = []
+    for n in range(num_tiles):
+        for t in range(max_k + 2):
+            name = "jet_mixfrac_{:04d}_x{}_y0_z0.raw".format(t, n * sub_size)
+            np.random.rand(sub_size, sub_size, sub_size).astype(np.float32).tofile(
+                os.path.join(root, "train_cropped", name))
+            names.append(name)
+    with open(os.path.join(root, "train_cropped", "volume_train_list.txt"), "w") as f:
+        f.write("{}\n1\n".format(num_tiles))
+        for name in names:
+            f.write(name + "\n")
+
+def benchmarks(args, tmp):
+    # name -> (function, number of items processed per call)
+    block_sizes = [32] if args.quick else [32, 64]
+    steps = [3] if args.quick else [3, 9]
+    transform = transforms.Compose([utils.Normalize(), utils.ToTensor()])
+    cases = {}
+
+    # data pipeline
+    tile = os.path.join(tmp, "tile.raw")
+    np.random.rand(16, 32, 32).astype(np.float32).tofile(tile)
+    cases["volume_loader_16x32x32"] = (lambda: volume_loader(tile, 16, 32, 32), 1)
+    volume = np.random.rand(64, 64, 64)
+    cases["normalize_to_tensor_64"] = (lambda: transform(volume), 1)
+
+    write_tiles(os.path.join(tmp, "data"), 16, 4, 3)
+    dataset = TVDataset(os.path.join(tmp, "data"), 16, 3, transform=transform)
+    loader = DataLoader(dataset, batch_size=2, shuffle=False)
+    cases["dataset_iteration_16_step3"] = (lambda: [sample for sample in loader], len(dataset))
+
+    # upsampling: voxel shuffle after the convolution (lr) vs interpolation before it (hr)
+    x = torch.randn(1, 16, 32, 32, 32)
+    conv_lr = nn.Conv3d(16, 16 * 8, 3, 1, 1)
+    conv_hr = nn.Conv3d(16, 16, 3, 1, 1)
+    shuffle = VoxelShuffle(2)
+    features = torch.randn(1, 16 * 8, 32, 32, 32)
+    cases["voxel_shuffle_32"] = (lambda: shuffle(features), 1)
+    cases["upsample_lr_32"] = (lambda: shuffle(conv_lr(x)), 1)
+    cases["upsample_hr_32"] = (lambda: conv_hr(F.interpolate(x, mode="nearest", scale_factor=2)), 1)
+
+    # one ConvLSTM step at the bottleneck of a 64^3 block
+    cell = ConvLSTMCell(input_channels=64, hidden_channels=64, kernel_size=3, stride=1)
+    h, c = cell.init_hidden(1, 64, (4, 4, 4), device="cpu")
+    feature = torch.randn(1, 64, 4, 4, 4)
+    cases["convlstm_step_4"] = (lambda: cell(feature, h, c), 1)
+
+    # models
+    for upsample_mode in ["lr", "hr"]:
+        g_model = Generator(upsample_mode, True, True, False, False)
+        for block_size in block_sizes:
+            for step in steps:
+                v_f = torch.randn(1, 1, block_size, block_size, block_size)
+                v_b = torch.randn(1, 1, block_size, block_size, block_size)
+                v_i = torch.randn(1, step, 1, block_size, block_size, block_size)
+
+                def forward(g_model=g_model, v_f=v_f, v_b=v_b, step=step):
+                    with torch.no_grad():
+                        g_model(v_f, v_b, step, False, "")
+
+                def forward_backward(g_model=g_model, v_f=v_f, v_b=v_b, v_i=v_i, step=step):
+                    g_model.zero_grad()
+                    F.mse_loss(g_model(v_f, v_b, step, False, ""), v_i).backward()
+
+                name = "generator_{}_{}_step{}".format(upsample_mode, block_size, step)
+                cases[name + "_forward"] = (forward, step)
+                cases[name + "_forward_backward"] = (forward_backward, step)
+
+    # the discriminator only accepts 64^3 blocks
+    d_model = Discriminator(False)
+    for step in steps:
+        v_i = torch.randn(1, step, 1, 64, 64, 64)
+
+        def discriminate(v_i=v_i):
+            d_model.zero_grad()
+            d_model(v_i).mean().backward()
+
+        cases["discriminator_64_step{}_forward_backward".format(step)] = (discriminate, step)
+    return cases
+
+def compare(current, baseline, threshold):
+    regressions = []
+    for name, result in sorted(current.items()):
+        if name not in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        flag = "REGRESSION" if ratio > 1 + threshold else ("faster" if ratio < 1 - threshold else "")
+        print("{:<48}{:>12.4f}{:>12.4f}{:>9.2f}x  {}".format(
+            name, baseline[name]["median"], result["median"], ratio, flag))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+def main(args):
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    commit = git_commit()
+    print("=> benchmarking commit {} with {} threads".format(commit, torch.get_num_threads()))
+    current = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (fn, items) in benchmarks(args, tmp).items():
+            if args.filter not in name:
+                continue
+            current[name] = measure(fn, args.warmup, args.repeat)
+            current[name]["items_per_sec"] = items / current[name]["median"]
+            print("{:<48}{:>12.4f} s{:>12.2f} items/s".format(name, current[name]["median"],
+                                                            current[name]["items_per_sec"]))
+
+    results = {}
+    if os.path.isfile(args.results):
+        with open(args.results) as f:
+            results = json.load(f)
+    # compare against the stored results, before this run overwrites them
+    baseline = dict(results.get(args.baseline, {}))
+    results.setdefault(commit, {}).update(current)
+    results[commit]["_config"] = {"threads": torch.get_num_threads(), "torch": torch.__version__,
+                                  "time": time.asctime(time.localtime(time.time()))}
+    with open(args.results, "w") as f:
+        json.dump(results, f, indent=2)
+    print("=> results saved to {}".format(args.results))
+
+    if args.baseline:
+        if not baseline:
+            raise ValueError("no results for the baseline {}".format(args.baseline))
+        baseline.pop("_config", None)
+        print("====> {} vs baseline {}".format(commit, args.baseline))
+        print("{:<48}{:>12}{:>12}{:>10}".format("benchmark", "baseline", "current", "ratio"))
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print("====> {} regressions above {:.0f}%: {}".format(
+                len(regressions), 100 * args.threshold, ", ".join(regressions)))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main(parse_args())
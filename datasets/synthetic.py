@@ -0,0 +1,246 @@
+# synthetic time-varying scalar fields in the layout of the combustion dataset
+
+import os
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: 1)")
+    parser.add_argument("--root", required=True, type=str,
+                        help="root of the generated dataset")
+    parser.add_argument("--volume-type", type=str, default="jet_mixfrac")
+    parser.add_argument("--size", type=int, nargs=3, default=[480, 720, 120], metavar=("X", "Y", "Z"),
+                        help="size of the full volumes")
+    parser.add_argument("--time-start", type=int, default=1,
+                        help="first timestep")
+    parser.add_argument("--time-end", type=int, default=122,
+                        help="last timestep")
+    parser.add_argument("--fields", type=str, default="blobs,vortex,front",
+                        help="comma separated components averaged into the field: blobs, vortex, front")
+    parser.add_argument("--num-blobs", type=int, default=24,
+                        help="number of advected gaussian blobs")
+    parser.add_argument("--chunk-size", type=int, default=8,
+                        help="number of z slices generated at a time")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of timesteps generated in parallel")
+
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="the size of the sub-block")
+    parser.add_argument("--data-size", type=int, default=8,
+                        help="number of random crops per training window")
+    parser.add_argument("--train-end", type=int, default=45,
+                        help="last starting timestep of the training windows")
+    parser.add_argument("--test-start", type=int, default=50,
+                        help="starting key timestep of the test set")
+    parser.add_argument("--test-end", type=int, default=122,
+                        help="ending key timestep of the test set")
+    parser.add_argument("--max-k", type=int, default=9,
+                        help="number of intermediate volumes of a window")
+    parser.add_argument("--infering-step", type=int, default=7,
+                        help="number of intermediate volumes of the inference tiles")
+    parser.add_argument("--infer-stride", type=int, default=0,
+                        help="stride of the inference tiles (default: half the block size)")
+    parser.add_argument("--no-crop", action="store_true", default=False,
+                        help="only write the full volumes")
+    return parser.parse_args()
+
+def make_params(fields, shape, num_blobs, seed):
+    # every parameter is drawn once, so any timestep can be generated independently
+    rng = np.random.RandomState(seed)
+    zSize, ySize, xSize = shape
+    extent = np.array(shape, dtype=np.float32)
+    params = {"fields": fields.split(","), "shape": shape}
+    params["blobs"] = {
+        "center": rng.rand(num_blobs, 3) * extent,
+        # voxels per timestep
+        "velocity": (rng.rand(num_blobs, 3) - 0.5) * extent / 40,
+        "sigma": (0.05 + 0.1 * rng.rand(num_blobs)) * min(shape),
+        "amplitude": 0.5 + 0.5 * rng.rand(num_blobs),
+    }
+    params["vortex"] = {
+        "center": np.array([ySize, xSize]) * (0.35 + 0.3 * rng.rand(2)),
+        "wobble": 0.1 * min(ySize, xSize) * rng.rand(),
+        "omega": 0.2 + 0.2 * rng.rand(),
+        "core": 0.1 * min(ySize, xSize),
+        "radius": 0.4 * min(ySize, xSize),
+        "arms": rng.randint(2, 5),
+    }
+    normal = rng.rand(3) + 0.5
+    params["front"] = {
+        "normal": normal / np.linalg.norm(normal),
+        "offset": 0.2 * float(np.dot(normal / np.linalg.norm(normal), extent)),
+        "speed": float(np.dot(normal / np.linalg.norm(normal), extent)) / 200,
+        "width": 0.02 * min(shape),
+        "amplitude": 0.05 * min(shape),
+        "wavelength": (0.3 + 0.3 * rng.rand(2)) * np.array([ySize, zSize]),
+    }
+    return params
+
+def blobs(p, t, z, y, x, shape):
+    # gaussians advected with constant velocities in a periodic box; separable, so each blob is an outer product
+    # restricted to the voxels it reaches
+    out = np.zeros((len(z), len(y), len(x)), dtype=np.float32)
+    extent = np.array(shape, dtype=np.float32)
+    centers = np.mod(p["center"] + p["velocity"] * t, extent).astype(np.float32)
+    for center, sigma, amplitude in zip(centers, p["sigma"], p["amplitude"]):
+        profiles, support = [], []
+        for coord, c, length in zip((z, y, x), center, extent):
+            d = np.mod(coord - c + length / 2, length) - length / 2
+            profile = np.exp(-d ** 2 / (2 * sigma ** 2)).astype(np.float32)
+            support.append(np.nonzero(profile > 1e-4)[0])
+            profiles.append(profile[support[-1]])
+        # blobs far from the slab contribute nothing
+        if len(support[0]) == 0:
+            continue
+        window = np.ix_(*support)
+        out[window] += (amplitude * profiles[0])[:, None, None] * profiles[1][None, :, None] * profiles[2][None, None, :]
+    return np.minimum(out, 1., out=out)
+
+def vortex(p, t, z, y, x, shape):
+    # spiral arms wound up by a differentially rotating vortex whose axis wobbles along z
+    phase = 2 * np.pi * z / shape[0]
+    cy = (p["center"][0] + p["wobble"] * np.sin(phase)).astype(np.float32)
+    cx = (p["center"][1] + p["wobble"] * np.cos(phase)).astype(np.float32)
+    dy = y[None, :, None] - cy[:, None, None]
+    dx = x[None, None, :] - cx[:, None, None]
+    r = np.sqrt(dy ** 2 + dx ** 2)
+    theta = np.arctan2(dy, dx)
+    theta -= np.float32(p["omega"] * t) / (1 + (r / np.float32(p["core"])) ** 2)
+    out = np.cos(p["arms"] * theta + np.float32(2 * np.pi / p["radius"]) * r)
+    out = 0.5 + 0.5 * out
+    out *= np.exp(-(r / np.float32(p["radius"])) ** 2)
+    return out
+
+def front(p, t, z, y, x, shape):
+    # a wrinkled interface moving along its normal
+    normal = p["normal"].astype(np.float32)
+    wrinkle = (np.sin(2 * np.pi * y / p["wavelength"][0] + 0.1 * t).astype(np.float32)[None, :, None] *
+               (p["amplitude"] * np.sin(2 * np.pi * z / p["wavelength"][1])).astype(np.float32)[:, None, None])
+    wrinkle += (normal[0] * z - np.float32(p["offset"] + p["speed"] * t))[:, None, None]
+    wrinkle += (normal[1] * y)[None, :, None]
+    s = wrinkle + (normal[2] * x)[None, None, :]
+    s /= np.float32(p["width"])
+    out = np.tanh(s, out=s)
+    out += 1
+    out *= 0.5
+    return out
+
+FIELDS = {"blobs": blobs, "vortex": vortex, "front": front}
+
+def field(params, t, z0, z1):
+    shape = params["shape"]
+    z = np.arange(z0, z1, dtype=np.float32)
+    y = np.arange(shape[1], dtype=np.float32)
+    x = np.arange(shape[2], dtype=np.float32)
+    out = np.zeros((z1 - z0, shape[1], shape[2]), dtype=np.float32)
+    for name in params["fields"]:
+        out += FIELDS[name](params[name], t, z, y, x, shape)
+    out /= len(params["fields"])
+    return out
+
+def volume_path(root, volume_type, t):
+    idx = ("%04d" % t)
+    return os.path.join(root, "exavisData", "combustion", "jet_" + idx, volume_type + "_" + idx + ".dat")
+
+def write_volume(args, params, t):
+    path = volume_path(args.root, args.volume_type, t)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        for z in range(0, params["shape"][0], args.chunk_size):
+            f.write(field(params, t, z, min(z + args.chunk_size, params["shape"][0])).tobytes())
+
+def tile_name(volume_type, t, origin):
+    return "{}_{:04d}_x{}_y{}_z{}.raw".format(volume_type, t, origin[2], origin[1], origin[0])
+
+def crop(args, shape, t, origin, save_dir):
+    volume = np.memmap(volume_path(args.root, args.volume_type, t), dtype=np.float32, mode="r", shape=shape)
+    z, y, x = origin
+    b = args.block_size
+    name = tile_name(args.volume_type, t, origin)
+    np.ascontiguousarray(volume[z:z+b, y:y+b, x:x+b]).tofile(os.path.join(save_dir, name))
+    return name
+
+def write_windows(args, shape, rng, save_dir, list_name, starts, pool):
+    # the CropData layout: dataSize, number of windows, then max_k+2 tiles per (crop, window)
+    os.makedirs(os.path.join(args.root, save_dir), exist_ok=True)
+    b = args.block_size
+    jobs = []
+    for d in range(args.data_size):
+        for start in starts:
+            origin = tuple(int(rng.randint(0, n - b + 1)) for n in shape)
+            jobs.extend((start + t, origin) for t in range(args.max_k + 2))
+    names = list(pool.map(lambda job: crop(args, shape, job[0], job[1], os.path.join(args.root, save_dir)), jobs))
+    with open(os.path.join(args.root, save_dir, list_name), "w") as f:
+        f.write("{}\n{}\n".format(args.data_size, len(starts)))
+        for name in names:
+            f.write(name + "\n")
+
+def grid(length, block_size, stride):
+    # the last tile is aligned with the end of the volume
+    origins = list(range(0, length - block_size + 1, stride))
+    if origins[-1] != length - block_size:
+        origins.append(length - block_size)
+    return origins
+
+def write_infer_tiles(args, shape, pool):
+    # the InferTVDataset layout: number of tiles, the tiles of the starting key frame, then of the ending one
+    os.makedirs(os.path.join(args.root, "test_cropped"), exist_ok=True)
+    stride = args.infer_stride or args.block_size // 2
+    origins = [(z, y, x) for z in grid(shape[0], args.block_size, stride)
+               for y in grid(shape[1], args.block_size, stride)
+               for x in grid(shape[2], args.block_size, stride)]
+    lists = []
+    for start in range(args.test_start, args.test_end, args.infering_step + 1):
+        end = start + args.infering_step + 1
+        if end > args.test_end:
+            break
+        jobs = [(start, origin) for origin in origins] + [(end, origin) for origin in origins]
+        names = list(pool.map(lambda job: crop(args, shape, job[0], job[1], os.path.join(args.root, "test_cropped")),
+                              jobs))
+        list_name = "volume_test_list_{}-{}.txt".format(start, end)
+        with open(os.path.join(args.root, "test_cropped", list_name), "w") as f:
+            f.write("{}\n".format(len(origins)))
+            for name in names:
+                f.write(name + "\n")
+        lists.append(list_name)
+    return lists
+
+def main(args):
+    xSize, ySize, zSize = args.size
+    shape = (zSize, ySize, xSize)
+    for name in args.fields.split(","):
+        if name not in FIELDS:
+            raise ValueError("unknown field {}".format(name))
+    params = make_params(args.fields, shape, args.num_blobs, args.seed)
+    timesteps = list(range(args.time_start, args.time_end + 1))
+
+    tic = time.time()
+    with ThreadPoolExecutor(args.workers) as pool:
+        list(pool.map(lambda t: write_volume(args, params, t), timesteps))
+    size = len(timesteps) * zSize * ySize * xSize * 4
+    print("=> {} volumes ({:.2f} GB) written in {:.2f}s ({:.1f} MB/s)".format(
+        len(timesteps), size / 2 ** 30, time.time() - tic, size / 2 ** 20 / (time.time() - tic)
+    ))
+    if args.no_crop:
+        return
+
+    tic = time.time()
+    rng = np.random.RandomState(args.seed)
+    with ThreadPoolExecutor(args.workers) as pool:
+        # every window of max_k+2 timesteps starting up to train_end, and disjoint windows of the test range
+        train_starts = [t for t in range(args.time_start, args.train_end + 1) if t + args.max_k + 1 <= args.time_end]
+        write_windows(args, shape, rng, "train_cropped", "volume_train_list.txt", train_starts, pool)
+        test_starts = list(range(args.test_start, args.test_end - args.max_k, args.max_k + 1))
+        write_windows(args, shape, rng, "test_cropped_random", "volume_test_list.txt", test_starts, pool)
+        lists = write_infer_tiles(args, shape, pool)
+    print("=> {} training and {} test windows, inference lists {} written in {:.2f}s".format(
+        len(train_starts) * args.data_size, len(test_starts) * args.data_size, ", ".join(lists), time.time() - tic
+    ))
+
+if __name__ == "__main__":
+    main(parse_args())
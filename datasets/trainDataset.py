@@ -1,4 +1,5 @@
 import os
+import json
 import struct
 import numpy as np
 import pdb
@@ -20,7 +21,7 @@ def volume_loader(path, zSize, ySize, xSize):
 
 class TVDataset(Dataset):
     def __init__(self, root, sub_size, max_k, volume_list="volume_train_list.txt", train=True, transform=None,
-                 loader=volume_loader):
+                 loader=volume_loader, cache=False):
         if train:
             f = open(os.path.join(root, "train_cropped", volume_list))
         else:
@@ -45,42 +46,119 @@ class TVDataset(Dataset):
                 self.vs.append(os.path.join("test_cropped_random", line))
             line = f.readline()
 
-        self.dataset_size = self.dataSize * self.timeRange
         self.root = root
         self.sub_size = sub_size
-        self.max_k = max_k
+        # number of intermediate volumes of the windows in the list
+        self.window = max_k
         self.train = train
         self.transform = transform
         self.loader = loader
+        # loaded (and transformed) tiles by name
+        self.cache = {} if cache else None
+        # the rows of the packed tiles by name
+        self.packed = None
+        self.pack_path = None
+        self.set_step(max_k)
+
+    def set_step(self, max_k):
+        # re-slice every window of the list into consecutive windows of max_k intermediate volumes, the ending key
+        # volume of one being the starting key volume of the next; when they do not tile the window exactly, a last
+        # one ends on its ending key volume, overlapping the one before, so that no volume is left out
+        if max_k > self.window:
+            raise ValueError("the windows of the list have {} intermediate volumes, not {}".format(self.window, max_k))
+        self.max_k = max_k
+        # offsets of the starting key volumes in a window
+        self.starts = list(range(0, self.window - max_k + 1, max_k + 1))
+        if self.starts[-1] != self.window - max_k:
+            self.starts.append(self.window - max_k)
+        self.sub_windows = len(self.starts)
+        self.dataset_size = self.dataSize * self.timeRange * self.sub_windows
+
+    def load(self, name):
+        if self.packed is not None:
+            return torch.from_numpy(np.array(self.packed[self.rows[name]]))
+        if self.cache is not None and name in self.cache:
+            return self.cache[name]
+        volume = self.loader(os.path.join(self.root, name), self.sub_size, self.sub_size, self.sub_size)
+        if self.transform is not None:
+            volume = self.transform(volume)
+        if self.cache is not None:
+            self.cache[name] = volume
+        return volume
+
+    def preload(self):
+        # load every tile once; loader workers forked afterwards share the cache
+        for name in self.vs:
+            self.load(name)
+
+    def pack(self, path):
+        # every transformed tile in one memory-mapped .npy file, written on first use with the tile names, the
+        # block size and the transform in path.json; the processes mapping the same file share its pages instead
+        # of each loading the tiles
+        names = list(dict.fromkeys(self.vs))
+        transform = [type(t).__name__ for t in getattr(self.transform, "transforms", [self.transform])]
+        if not os.path.isfile(path):
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            packed = None
+            for row, name in enumerate(names):
+                volume = self.load(name).numpy()
+                if packed is None:
+                    packed = np.lib.format.open_memmap(tmp, mode="w+", dtype=volume.dtype,
+                                                       shape=(len(names),) + volume.shape)
+                packed[row] = volume
+            packed.flush()
+            with open(tmp + ".json", "w") as f:
+                json.dump({"names": names, "sub_size": self.sub_size, "transform": transform,
+                           "dtype": str(packed.dtype), "shape": list(packed.shape)}, f)
+            del packed
+            os.replace(tmp + ".json", path + ".json")
+            os.replace(tmp, path)
+        packed = np.load(path, mmap_mode="r")
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        if not isinstance(meta, dict) or meta["names"] != names:
+            raise ValueError("{} holds other tiles than the list".format(path))
+        if meta["sub_size"] != self.sub_size or meta["transform"] != transform:
+            raise ValueError("{} holds blocks of size {} transformed by {}, not of size {} transformed by {}".format(
+                path, meta["sub_size"], meta["transform"], self.sub_size, transform))
+        if meta["dtype"] != str(packed.dtype) or meta["shape"] != list(packed.shape):
+            raise ValueError("{} does not match the {} {} array of {}.json".format(
+                path, meta["dtype"], meta["shape"], path))
+        self.packed = packed
+        self.pack_path = path
+        self.rows = {name: row for row, name in enumerate(names)}
+
+    def __getstate__(self):
+        # a memory map pickles as a full copy of the array; processes started with spawn map the file again
+        state = self.__dict__.copy()
+        state["packed"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.pack_path is not None:
+            self.packed = np.load(self.pack_path, mmap_mode="r")
 
     def __len__(self):
         return self.dataset_size
 
     def __getitem__(self, index):
-        vf_path = os.path.join(self.root, self.vs[index*(self.max_k+2)])
-        v_f = self.loader(vf_path, self.sub_size, self.sub_size, self.sub_size)
-
-        vb_path = os.path.join(self.root, self.vs[index*(self.max_k+2) + self.max_k + 1])
-        v_b = self.loader(vb_path, self.sub_size, self.sub_size, self.sub_size)
-        if self.transform is not None:
-            v_f = self.transform(v_f)
-            v_b = self.transform(v_b)
+        start = (index // self.sub_windows) * (self.window+2) + self.starts[index % self.sub_windows]
+        v_f = self.load(self.vs[start])
+        v_b = self.load(self.vs[start + self.max_k + 1])
 
         vi_list = []
-        for idx in range(index*(self.max_k+2) + 1, index*(self.max_k+2) + self.max_k + 1):
-            vi_path = os.path.join(self.root, self.vs[idx])
-            v_i = self.loader(vi_path, self.sub_size, self.sub_size, self.sub_size)
-            if self.transform is not None:
-                v_i = self.transform(v_i)
+        for idx in range(start + 1, start + self.max_k + 1):
+            v_i = self.load(self.vs[idx])
             v_i = torch.unsqueeze(v_i, 0)
             vi_list.append(v_i)
 
         v_is = torch.cat(vi_list, 0)
-        sample = { "vf_name": self.vs[index*(self.max_k+2)],
-                   "vb_name": self.vs[index*(self.max_k+2) + self.max_k + 1],
-                   "vi_name": [self.vs[idx] for idx in range(index*(self.max_k+2) + 1, index*(self.max_k+2) + self.max_k + 1)],
+        sample = { "vf_name": self.vs[start],
+                   "vb_name": self.vs[start + self.max_k + 1],
+                   "vi_name": [self.vs[idx] for idx in range(start + 1, start + self.max_k + 1)],
                    "v_f": v_f, "v_b": v_b, "v_i": v_is}
-        # print("{} {}\n".format(index, self.vs[index*(self.max_k+2)]))
+        # print("{} {}\n".format(index, self.vs[start]))
 
         return sample
 
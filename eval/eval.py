@@ -14,7 +14,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.autograd import Variable
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Subset
 from torchvision.utils import save_image
 from torchvision import transforms
 
@@ -26,6 +26,9 @@ from generator import Generator
 from discriminator import Discriminator
 from inferDataset import *
 import utils
+from infer_utils import *
+from profiler import ModuleProfiler
+from autotune import load_profile, apply_profile, loader_kwargs
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Deep Learning Model")
@@ -43,9 +46,12 @@ def parse_args():
                         help="dir of predicted volumes")
     parser.add_argument("--resume", type=str, default="",
                         help="path to the latest checkpoint (default: none)")
+    parser.add_argument("--volume-test-list", type=str, default="volume_test_list.txt")
 
     parser.add_argument("--gen-sn", action="store_true", default=False,
                         help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
 
     parser.add_argument("--gan-loss", type=str, default="none",
                         help="gan loss (default: none)")
@@ -87,6 +93,26 @@ def parse_args():
 
     parser.add_argument("--block-size", type=int, default=64,
                         help="the size of the sub-block")
+
+    parser.add_argument("--bbox", type=int, nargs=6, default=None,
+                        metavar=("X0", "X1", "Y0", "Y1", "Z0", "Z1"),
+                        help="only infer the blocks touching the given region (end exclusive)")
+    parser.add_argument("--halo", type=int, default=0,
+                        help="also blend the blocks within the given number of voxels of the region; the saved "
+                             "volumes only cover the region")
+    parser.add_argument("--iso-range", type=float, nargs=2, default=None, metavar=("MIN", "MAX"),
+                        help="blocks whose key frames never reach the value range are linearly interpolated")
+    parser.add_argument("--skip-threshold", type=float, default=0.,
+                        help="blocks whose mean change between the key frames is below it are linearly interpolated")
+    parser.add_argument("--skip-range", type=float, default=0.,
+                        help="blocks whose value range is below it are linearly interpolated")
+
+    parser.add_argument("--tune-profile", type=str, default="",
+                        help="DataLoader workers, threads and core pinning from a profile written by autotune.py")
+    parser.add_argument("--profile", type=str, default="",
+                        help="profile the modules of the first batches and write <profile>_trace.json and <profile>_summary.txt")
+    parser.add_argument("--profile-batches", type=int, default=3,
+                        help="number of batches to profile")
     return parser.parse_args()
 
 # the main function
@@ -97,6 +123,10 @@ def main(args):
     # select device
     args.cuda = not args.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda: 0" if args.cuda else "cpu")
+    tuning = None
+    if args.tune_profile:
+        tuning = load_profile(args.tune_profile, "infer", args.batch_size)
+        apply_profile(tuning)
 
     # set random seed
     np.random.seed(args.seed)
@@ -111,93 +141,89 @@ def main(args):
     infer_dataset = InferTVDataset(
         root=args.root,
         sub_size=args.block_size,
-        volume_list="volume_test_list.txt",
+        volume_list=args.volume_test_list,
         max_k = args.infering_step,
         transform=transform
     )
 
-    kwargs = {"num_workers": 4, "pin_memory": True} if args.cuda else {}
-    infer_loader = DataLoader(infer_dataset, batch_size=args.batch_size,
+    # region of interest
+    zSize, ySize, xSize = 120, 720, 480
+    if args.bbox is not None:
+        x0, x1, y0, y1, z0, z1 = args.bbox
+        region = (max(z0, 0), min(z1, zSize), max(y0, 0), min(y1, ySize), max(x0, 0), min(x1, xSize))
+    else:
+        region = (0, zSize, 0, ySize, 0, xSize)
+    # the blocks are blended over the region padded by the halo, the volumes saved are trimmed back to the region
+    bbox = (max(region[0] - args.halo, 0), min(region[1] + args.halo, zSize),
+            max(region[2] - args.halo, 0), min(region[3] + args.halo, ySize),
+            max(region[4] - args.halo, 0), min(region[5] + args.halo, xSize))
+    trim = tuple(slice(region[2*d] - bbox[2*d], region[2*d+1] - bbox[2*d]) for d in range(3))
+    # every block covering a voxel of the region touches it, so the blend inside the region is seamless
+    indices = [i for i in range(len(infer_dataset))
+               if intersects(tile_origin(infer_dataset.vs[i]), args.block_size, bbox)]
+    print("=> {} of {} blocks intersect the region".format(len(indices), len(infer_dataset)))
+
+    kwargs = loader_kwargs(tuning, args.cuda)
+    infer_loader = DataLoader(Subset(infer_dataset, indices), batch_size=args.batch_size,
                              shuffle=False, **kwargs)
 
     # model
-    def generator_weights_init(m):
-        if isinstance(m, nn.Conv3d):
-            nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
-            if m.bias is not None:
-                nn.init.zeros_(m.bias)
-
-    g_model = Generator(args.upsample_mode, args.forward, args.backward, args.gen_sn)
-    g_model.apply(generator_weights_init)
+    g_model = build_generator(args, device)
     if args.data_parallel and torch.cuda.device_count() > 1:
         g_model = nn.DataParallel(g_model)
-    g_model.to(device)
-
-    mse_loss = nn.MSELoss()
-    adversarial_loss = nn.MSELoss()
-    train_losses, test_losses = [], []
-    d_losses, g_losses = [], []
-
-    # load checkpoint
-    if args.resume:
-        if os.path.isfile(args.resume):
-            print("=> loading checkpoint {}".format(args.resume))
-            checkpoint = torch.load(args.resume)
-            args.start_epoch = checkpoint["epoch"]
-            g_model.load_state_dict(checkpoint["g_model_state_dict"])
-            # g_optimizer.load_state_dict(checkpoint["g_optimizer_state_dict"])
-            if args.gan_loss != "none":
-                # d_model.load_state_dict(checkpoint["d_model_state_dict"])
-                # d_optimizer.load_state_dict(checkpoint["d_optimizer_state_dict"])
-                d_losses = checkpoint["d_losses"]
-                g_losses = checkpoint["g_losses"]
-            train_losses = checkpoint["train_losses"]
-            test_losses = checkpoint["test_losses"]
-            print("=> load chekcpoint {} (epoch {})"
-                  .format(args.resume, checkpoint["epoch"]))
-
-    g_model.eval()
+    profiler = None
+    if args.profile:
+        profiler = ModuleProfiler({"g_model": g_model.module if isinstance(g_model, nn.DataParallel) else g_model},
+                                  args.cuda)
+
     inferRes = []
-    zSize, ySize, xSize = 120, 720, 480
     for i in range(args.infering_step):
-        inferRes.append(np.zeros((zSize, ySize, xSize)))
-    inferScale = np.zeros((zSize, ySize, xSize))
-    time_start = 0
-    volume_type = ''
+        inferRes.append(VolumeBlender(bbox))
+    volume_type, time_start, _ = key_frames(infer_dataset)
+    denormalize = utils.Denormalize()
+    num_skipped = 0
 
     with torch.no_grad():
         for i, sample in tqdm(enumerate(infer_loader)):
             v_f = sample["v_f"].to(device)
             v_b = sample["v_b"].to(device)
-            fake_volumes = g_model(v_f, v_b, args.infering_step, args.wo_ori_volume, args.norm)
-            volume_type, time_start, x_start, y_start, z_start = utils.Parse(sample["vf_name"][0])
-
-            for j in range(fake_volumes.shape[1]):
-                volume = fake_volumes[0, j, 0]
-                min_value = -0.015  # -0.012058
-                max_value = 1.01  # 1.009666
-                mean = (min_value + max_value) / 2
-                std = mean - min_value
-                volume = volume.to("cpu").numpy() * std + mean
-
-                inferRes[j][z_start:z_start+args.block_size,
-                y_start:y_start+args.block_size, x_start:x_start+args.block_size] += volume
-                if j == 0:
-                    inferScale[z_start:z_start + args.block_size,
-                    y_start:y_start + args.block_size, x_start:x_start + args.block_size] += 1
-                # pdb.set_trace()
 
-    for j in range(args.infering_step):
-        inferRes[j] = inferRes[j] / inferScale
-        inferRes[j] = inferRes[j].astype(np.float32)
+            # blocks outside the isovalue range only need the linear interpolation
+            if args.iso_range is not None:
+                active = in_value_range(v_f, v_b, *args.iso_range)
+            else:
+                active = torch.ones(v_f.shape[0], dtype=torch.bool, device=device)
+            # so do the blocks that barely change between the key frames
+            if args.skip_threshold > 0 or args.skip_range > 0:
+                active &= ~skip_mask(v_f, v_b, args.skip_threshold, args.skip_range)
+            fake_volumes = lerp_volumes(v_f, v_b, args.infering_step)
+            if active.any():
+                fake_volumes[active] = g_model(v_f[active], v_b[active], args.infering_step,
+                                               args.wo_ori_volume, args.norm)
+            num_skipped += int((~active).sum())
+
+            fake_volumes = denormalize(fake_volumes.to("cpu").numpy())
+            for b in range(fake_volumes.shape[0]):
+                origin = tile_origin(sample["vf_name"][b])
+                for j in range(fake_volumes.shape[1]):
+                    inferRes[j].add(fake_volumes[b, j, 0], origin)
+
+            if profiler is not None and (i + 1) >= args.profile_batches:
+                print("=> saving profile {} and {}".format(*profiler.export(args.profile)))
+                profiler.remove()
+                profiler = None
+    if profiler is not None:
+        print("=> saving profile {} and {}".format(*profiler.export(args.profile)))
+        profiler.remove()
+    if args.iso_range is not None or args.skip_threshold > 0 or args.skip_range > 0:
+        print("=> {} of {} blocks ({:.1f}%) linearly interpolated".format(
+            num_skipped, len(indices), 100. * num_skipped / max(len(indices), 1)
+        ))
 
+    for j in range(args.infering_step):
         volume_name = volume_type + '_' + ("%04d" % (time_start+j+1)) + '.raw'
-        inferRes[j].tofile(os.path.join(args.save_pred, volume_name))
+        save_volume(os.path.join(args.save_pred, volume_name), inferRes[j].result()[trim],
+                    origin=region[::2] if args.bbox is not None else None)
 
 if __name__ == "__main__":
     main(parse_args())
-
-
-
-
-
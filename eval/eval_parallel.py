@@ -0,0 +1,186 @@
+# multi-process CPU inference
+
+import os
+import argparse
+import time
+
+import numpy as np
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
+
+import sys
+sys.path.append("../")
+sys.path.append("../datasets")
+sys.path.append("../model")
+from inferDataset import *
+import utils
+from infer_utils import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: 1)")
+
+    parser.add_argument("--root", required=True, type=str,
+                        help="root of the dataset")
+    parser.add_argument("--save-pred", required=True, type=str,
+                        help="dir of predicted volumes")
+    parser.add_argument("--resume", type=str, default="",
+                        help="path to the latest checkpoint (default: none)")
+    parser.add_argument("--volume-test-list", type=str, default="volume_test_list.txt")
+
+    parser.add_argument("--gen-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
+    parser.add_argument("--wo-ori-volume", action="store_true", default=False,
+                        help="during training, without the original volume")
+    parser.add_argument("--upsample-mode", type=str, default="lr",
+                        help="how to do upsample, voxel shuffle (lr) or interpolate (hr)")
+    parser.add_argument("--norm", type=str, default="",
+                        help="how normalize hidden layer, none or batch norm or instance norm")
+    parser.add_argument("--forward", action="store_true", default=False,
+                        help="during training, do forward prediction")
+    parser.add_argument("--backward", action="store_true", default=False,
+                        help="during training, do backward prediction")
+
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="batch size of every worker")
+    parser.add_argument("--infering-step", type=int, default=3,
+                        help="in the infering phase, the number of intermediate volumes")
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="the size of the sub-block")
+
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of inference processes")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="torch threads of every process (default: cores / workers; 1 with --scaling)")
+    parser.add_argument("--scaling", action="store_true", default=False,
+                        help="report the scaling efficiency from 1 to --workers processes of --threads threads each, "
+                             "the cores growing with the processes")
+    parser.add_argument("--split-cores", action="store_true", default=False,
+                        help="with --scaling, run every worker count on all the cores instead, cores / workers "
+                             "threads each (ignoring --threads), to compare processes with threads")
+    return parser.parse_args()
+
+def output_paths(args, volume_type, time_start):
+    paths = []
+    for j in range(args.infering_step):
+        paths.append(os.path.join(args.save_pred, volume_type + '_' + ("%04d" % (time_start+j+1)) + '.raw'))
+    return paths, os.path.join(args.save_pred, volume_type + "_weight.raw")
+
+def worker(rank, args, dataset, shards, paths, weight_path, shape, lock):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    # every process owns a model and writes straight into the memory-mapped volumes
+    g_model = build_generator(args, torch.device("cpu"))
+    outputs = [np.memmap(path, dtype=np.float32, mode="r+", shape=shape) for path in paths]
+    weight = np.memmap(weight_path, dtype=np.float32, mode="r+", shape=shape)
+    denormalize = utils.Denormalize()
+    loader = DataLoader(Subset(dataset, shards[rank]), batch_size=args.batch_size, shuffle=False)
+
+    with torch.no_grad():
+        for sample in loader:
+            fake_volumes = g_model(sample["v_f"], sample["v_b"], args.infering_step,
+                                   args.wo_ori_volume, args.norm)
+            fake_volumes = denormalize(fake_volumes.numpy())
+            for b in range(fake_volumes.shape[0]):
+                z, y, x = tile_origin(sample["vf_name"][b])
+                region = (slice(z, z + args.block_size), slice(y, y + args.block_size),
+                          slice(x, x + args.block_size))
+                # neighbouring blocks of different shards overlap
+                with lock:
+                    for j in range(fake_volumes.shape[1]):
+                        outputs[j][region] += fake_volumes[b, j, 0]
+                    weight[region] += 1
+
+    for output in outputs:
+        output.flush()
+    weight.flush()
+
+def run(args, dataset, num_workers, volume_type, time_start, shape):
+    paths, weight_path = output_paths(args, volume_type, time_start)
+    for path in paths + [weight_path]:
+        np.memmap(path, dtype=np.float32, mode="w+", shape=shape).flush()
+
+    # contiguous shards keep most overlapping neighbours inside one process
+    shards = np.array_split(np.arange(len(dataset)), num_workers)
+    shards = [shard.tolist() for shard in shards]
+    lock = mp.get_context("spawn").Lock()
+
+    tic = time.time()
+    mp.start_processes(worker, args=(args, dataset, shards, paths, weight_path, shape, lock),
+                       nprocs=num_workers, start_method="spawn")
+    elapsed = time.time() - tic
+
+    # normalize in place, slab by slab
+    weight = np.memmap(weight_path, dtype=np.float32, mode="r", shape=shape)
+    for path in paths:
+        output = np.memmap(path, dtype=np.float32, mode="r+", shape=shape)
+        for z in range(0, shape[0], args.block_size):
+            output[z:z+args.block_size] /= np.maximum(weight[z:z+args.block_size], 1)
+        output.flush()
+    del weight
+    os.remove(weight_path)
+    return elapsed
+
+# the main function
+def main(args):
+    # log hyperparameter
+    print(args)
+
+    threads = args.threads
+    if args.threads <= 0:
+        args.threads = max(os.cpu_count() // args.workers, 1)
+
+    transform = transforms.Compose([
+        utils.Normalize(),
+        utils.ToTensor()
+    ])
+    infer_dataset = InferTVDataset(
+        root=args.root,
+        sub_size=args.block_size,
+        volume_list=args.volume_test_list,
+        max_k=args.infering_step,
+        transform=transform
+    )
+    volume_type, time_start, _ = key_frames(infer_dataset)
+    shape = (120, 720, 480)
+
+    if not args.scaling:
+        elapsed = run(args, infer_dataset, args.workers, volume_type, time_start, shape)
+        print("====> {} blocks with {} workers x {} threads in {:.2f}s".format(
+            len(infer_dataset), args.workers, args.threads, elapsed
+        ))
+        return
+
+    num_workers = [1]
+    while num_workers[-1] * 2 < args.workers:
+        num_workers.append(num_workers[-1] * 2)
+    if num_workers[-1] != args.workers:
+        num_workers.append(args.workers)
+
+    print("workers\tthreads\ttime\tblocks/s\tspeedup\tefficiency")
+    for n in num_workers:
+        if args.split_cores:
+            # the same cores in every run, split between processes instead of threads
+            args.threads = max(os.cpu_count() // n, 1)
+        else:
+            # a fixed number of threads per process, so the run of n processes uses n times the cores
+            args.threads = threads if threads > 0 else 1
+        elapsed = run(args, infer_dataset, n, volume_type, time_start, shape)
+        if n == 1:
+            base, base_threads = elapsed, args.threads
+        # the efficiency is per core: the speedup over the growth of the total number of threads
+        print("{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}".format(
+            n, args.threads, elapsed, len(infer_dataset) / elapsed, base / elapsed,
+            base / elapsed * base_threads / (n * args.threads)
+        ))
+
+if __name__ == "__main__":
+    main(parse_args())
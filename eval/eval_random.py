@@ -26,6 +26,7 @@ from generator import Generator
 from discriminator import Discriminator
 from trainDataset import *
 from utils import *
+from infer_utils import build_generator, lerp_volumes
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Deep Learning Model")
@@ -48,6 +49,8 @@ def parse_args():
 
     parser.add_argument("--gen-sn", action="store_true", default=False,
                         help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
 
     parser.add_argument("--gan-loss", type=str, default="none",
                         help="gan loss (default: none)")
@@ -102,6 +105,8 @@ def parse_args():
 
     parser.add_argument("--block-size", type=int, default=64,
                         help="the size of the sub-block")
+    parser.add_argument("--summary", type=str, default="",
+                        help="write the per-intermediate summary table as csv")
     return parser.parse_args()
 
 # the main function
@@ -146,43 +151,10 @@ def main(args):
                              shuffle=False, **kwargs)
 
     # model
-    def generator_weights_init(m):
-        if isinstance(m, nn.Conv3d):
-            nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
-            if m.bias is not None:
-                nn.init.zeros_(m.bias)
-
-    g_model = Generator(args.upsample_mode, args.forward, args.backward, args.gen_sn)
-    g_model.apply(generator_weights_init)
-    if args.data_parallel and torch.cuda.device_count() > 1:
-        g_model = nn.DataParallel(g_model)
-    g_model.to(device)
-
-    mse_loss = nn.MSELoss()
-    adversarial_loss = nn.MSELoss()
-    train_losses, test_losses = [], []
-    d_losses, g_losses = [], []
-
-    # load checkpoint
-    if args.resume:
-        if os.path.isfile(args.resume):
-            print("=> loading checkpoint {}".format(args.resume))
-            checkpoint = torch.load(args.resume)
-            args.start_epoch = checkpoint["epoch"]
-            g_model.load_state_dict(checkpoint["g_model_state_dict"])
-            # g_optimizer.load_state_dict(checkpoint["g_optimizer_state_dict"])
-            if args.gan_loss != "none":
-                # d_model.load_state_dict(checkpoint["d_model_state_dict"])
-                # d_optimizer.load_state_dict(checkpoint["d_optimizer_state_dict"])
-                d_losses = checkpoint["d_losses"]
-                g_losses = checkpoint["g_losses"]
-            train_losses = checkpoint["train_losses"]
-            test_losses = checkpoint["test_losses"]
-            print("=> load chekcpoint {} (epoch {})"
-                  .format(args.resume, checkpoint["epoch"]))
-
-    # evaluating 
-    # 1) plot losses 
+    g_model = build_generator(args, device)
+
+    # evaluating
+    # 1) plot losses
     # pdb.set_trace()
     # fig, ax = plt.subplots()
     # ax.set(xlabel=u"SubEpoches", ylabel=u"loss")
@@ -193,58 +165,60 @@ def main(args):
 
 
     # 3) compute PSNR
-    g_model.eval()
-    test_loss = 0.
-    test_loss_tsr = 0.
-    test_loss_lerp = 0.
+    # all samples and intermediates of a batch at once; statistics stay on the device until the end
+    num_steps = args.training_step
+    sum_mse_tsr = torch.zeros(num_steps, dtype=torch.float64, device=device)
+    sum_mse_lerp = torch.zeros(num_steps, dtype=torch.float64, device=device)
+    sum_psnr_tsr = torch.zeros(num_steps, dtype=torch.float64, device=device)
+    sum_psnr_lerp = torch.zeros(num_steps, dtype=torch.float64, device=device)
+    # the PSNR is undefined for an exact prediction or a constant intermediate, which are left out of its average
+    num_psnr_tsr = torch.zeros(num_steps, dtype=torch.float64, device=device)
+    num_psnr_lerp = torch.zeros(num_steps, dtype=torch.float64, device=device)
+    num_samples = 0
     with torch.no_grad():
-        for i, sample in enumerate(test_loader):
-            # print(sample["idx"].item(), sample["vf_name"])
+        for i, sample in enumerate(tqdm(test_loader)):
             v_f = sample["v_f"].to(device)
             v_b = sample["v_b"].to(device)
             v_i = sample["v_i"].to(device)
-            fake_volumes = g_model(v_f, v_b, args.training_step, args.wo_ori_volume, args.norm)
-            test_loss += args.volume_loss_weight * mse_loss(v_i, fake_volumes).item()
-
-            for j in range(fake_volumes.shape[1]):
-                min_value = -0.015  # -0.012058
-                max_value = 1.01  # 1.009666
-                mean = (min_value + max_value) / 2
-                std = mean - min_value
-
-                real = v_i[0, j, 0]
-                # real = real.to("cpu").numpy() * std + mean
-                real = real.to("cpu").numpy()
-                diff = real.max() - real.min()
-
-                tsr = fake_volumes[0, j, 0]
-                # tsr = tsr.to("cpu").numpy() * std + mean
-                tsr = tsr.to("cpu").numpy()
-                mse_tsr = np.mean(np.power(tsr - real, 2.))
-                # psnr_tsr = 20. * np.log10(diff) - 10. * np.log10(mse_tsr)
-
-                offset = j + 1
-                interval = args.training_step + 1
-                lerp = (1-offset/interval) * v_f + offset/interval * v_b
-                # lerp = lerp.to("cpu").numpy() * std + mean
-                lerp = lerp.to("cpu").numpy()
-                mse_lerp = np.mean(np.power(lerp - real, 2.))
-                # psnr_lerp = 20. * np.log10(diff) - 10. * np.log10(mse_lerp)
-
-                # pdb.set_trace()
-                print("sample {}, intermediate {}, TSR MSE {:.6f}, LERP MSE {:.6f}"
-                      .format(sample["vf_name"], j+1, mse_tsr, mse_lerp))
-                test_loss_tsr += mse_tsr / fake_volumes.shape[1]
-                test_loss_lerp += mse_lerp / fake_volumes.shape[1]
-                # volume.tofile(os.path.join(args.save_pred, sample["vi_name"][j][0]))
-            # if (args.volume_loss_weight * mse_loss(v_i, fake_volumes).item() > 0.004):
-            #     print("{} {}".format(sample["vf_name"], args.volume_loss_weight * mse_loss(v_i, fake_volumes).item()))
-
-    #     pdb.set_trace()
-        print("====> Test set loss TSR {:4f} LERP {:4f}".format(
-            test_loss_tsr / len(test_loader.dataset), test_loss_lerp / len(test_loader.dataset)
-        ))
-        
+            fake_volumes = g_model(v_f, v_b, num_steps, args.wo_ori_volume, args.norm)
+            lerp = lerp_volumes(v_f, v_b, num_steps)
+
+            # (batch, step) statistics
+            real = v_i.flatten(2)
+            diff = real.max(2)[0] - real.min(2)[0]
+            mse_tsr = (fake_volumes.flatten(2) - real).pow(2).mean(2)
+            mse_lerp = (lerp.flatten(2) - real).pow(2).mean(2)
+            sum_mse_tsr += mse_tsr.sum(0)
+            sum_mse_lerp += mse_lerp.sum(0)
+            for mse, sum_psnr, num_psnr in ((mse_tsr, sum_psnr_tsr, num_psnr_tsr),
+                                            (mse_lerp, sum_psnr_lerp, num_psnr_lerp)):
+                defined = (mse > 0) & (diff > 0)
+                psnr = 20. * torch.log10(diff) - 10. * torch.log10(mse)
+                sum_psnr += torch.where(defined, psnr, torch.zeros_like(psnr)).sum(0)
+                num_psnr += defined.sum(0)
+            num_samples += v_i.shape[0]
+
+    mse_tsr = (sum_mse_tsr / num_samples).tolist()
+    mse_lerp = (sum_mse_lerp / num_samples).tolist()
+    psnr_tsr = (sum_psnr_tsr / num_psnr_tsr).tolist()
+    psnr_lerp = (sum_psnr_lerp / num_psnr_lerp).tolist()
+    undefined = int(2 * num_samples * num_steps - num_psnr_tsr.sum().item() - num_psnr_lerp.sum().item())
+    if undefined:
+        print("=> PSNR undefined for {} of {} intermediates (exact prediction or constant volume), left out".format(
+            undefined, 2 * num_samples * num_steps))
+
+    print("intermediate\tTSR MSE\tLERP MSE\tTSR PSNR\tLERP PSNR")
+    for j in range(num_steps):
+        print("{}\t{:.6f}\t{:.6f}\t{:.4f}\t{:.4f}".format(j+1, mse_tsr[j], mse_lerp[j], psnr_tsr[j], psnr_lerp[j]))
+    print("====> Test set loss TSR {:4f} LERP {:4f}".format(
+        np.mean(mse_tsr), np.mean(mse_lerp)
+    ))
+
+    if args.summary:
+        with open(args.summary, "w") as f:
+            f.write("intermediate,tsr_mse,lerp_mse,tsr_psnr,lerp_psnr\n")
+            for j in range(num_steps):
+                f.write("{},{},{},{},{}\n".format(j+1, mse_tsr[j], mse_lerp[j], psnr_tsr[j], psnr_lerp[j]))
+
 if __name__ == "__main__":
     main(parse_args())
-
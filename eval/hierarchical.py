@@ -0,0 +1,243 @@
+# hierarchical recursive interpolation for gaps larger than the trained step
+
+import os
+import argparse
+import copy
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+import torch
+from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
+
+import sys
+sys.path.append("../")
+sys.path.append("../datasets")
+sys.path.append("../model")
+from inferDataset import *
+import utils
+from infer_utils import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disable CUDA inference")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: 1)")
+
+    parser.add_argument("--root", required=True, type=str,
+                        help="root of the dataset")
+    parser.add_argument("--save-pred", required=True, type=str,
+                        help="dir of predicted volumes")
+    parser.add_argument("--resume", type=str, default="",
+                        help="path to the checkpoint of the trained model")
+    parser.add_argument("--volume-test-list", type=str, default="volume_test_list.txt")
+
+    parser.add_argument("--gen-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
+    parser.add_argument("--wo-ori-volume", action="store_true", default=False,
+                        help="during training, without the original volume")
+    parser.add_argument("--upsample-mode", type=str, default="lr",
+                        help="how to do upsample, voxel shuffle (lr) or interpolate (hr)")
+    parser.add_argument("--norm", type=str, default="",
+                        help="how normalize hidden layer, none or batch norm or instance norm")
+    parser.add_argument("--forward", action="store_true", default=False,
+                        help="during training, do forward prediction")
+    parser.add_argument("--backward", action="store_true", default=False,
+                        help="during training, do backward prediction")
+
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="maximum number of blocks per forward call")
+    parser.add_argument("--chunk-size", type=int, default=64,
+                        help="number of blocks whose whole plan is run together")
+    parser.add_argument("--training-step", type=int, default=3,
+                        help="the number of intermediate volumes the model was trained with")
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="the size of the sub-block")
+
+    parser.add_argument("--native-resume", type=str, default="",
+                        help="checkpoint of a model natively trained for the whole gap, for comparison")
+    parser.add_argument("--gt-root", type=str, default="",
+                        help="dir of the ground truth jet_XXXX/ volumes, to report PSNR")
+    return parser.parse_args()
+
+def plan_intervals(t_start, t_end, step):
+    # levels of independent jobs; the key frames of a job are filled by an earlier level. The generator is
+    # recurrent, so every interval is predicted: with the trained step when its length is a multiple of step + 1,
+    # with a shorter recurrence when it is shorter than that, otherwise by predicting a split point first
+    levels = []
+
+    def fillable(length):
+        return length <= step + 1 or length % (step + 1) == 0
+
+    def visit(a, b, depth):
+        length = b - a
+        if length <= 1:
+            return
+        while len(levels) <= depth:
+            levels.append([])
+        if length % (step + 1) == 0:
+            # the trained step count fits: its outputs become the key frames of the sub-intervals
+            spacing = length // (step + 1)
+            times = [a + k * spacing for k in range(1, step + 1)]
+            levels[depth].append({"kind": "model", "a": a, "b": b, "times": times})
+            for lo, hi in zip([a] + times, times + [b]):
+                visit(lo, hi, depth + 1)
+        elif length <= step:
+            # a remainder shorter than the trained step: one call with a shorter recurrence
+            levels[depth].append({"kind": "short", "a": a, "b": b, "times": list(range(a + 1, b))})
+        else:
+            # the split point closest to the midpoint leaving a sub-interval filled without another split; it is
+            # queried on the trained time scale when it lines up with it, else on the scale of the interval
+            m = min(range(a + 1, b), key=lambda m: (not (fillable(m - a) or fillable(b - m)), abs(2 * m - a - b),
+                                                    not (fillable(m - a) and fillable(b - m))))
+            if (m - a) * (step + 1) % length == 0:
+                span, offset = step + 1, (m - a) * (step + 1) // length
+            else:
+                span, offset = length, m - a
+            levels[depth].append({"kind": "split", "a": a, "b": b, "times": [m], "span": span, "offset": offset})
+            visit(a, m, depth + 1)
+            visit(m, b, depth + 1)
+
+    visit(t_start, t_end, 0)
+    return levels
+
+def job_key(job):
+    # the jobs sharing forward calls
+    return job["kind"], len(job["times"]), job.get("span"), job.get("offset")
+
+def run_plan(g_model, levels, cache, step, args):
+    # cache: timestep -> (blocks, 1, z, y, x); predictions are reused as key frames of later levels
+    num_blocks = cache[min(cache)].shape[0]
+    num_calls = 0
+    for level in levels:
+        for job in level:
+            for t in job["times"]:
+                cache[t] = torch.empty_like(cache[job["a"]])
+        for key in sorted({job_key(job) for job in level}, key=str):
+            kind, num_times, span, offset = key
+            pairs = [(job, n) for job in level if job_key(job) == key for n in range(num_blocks)]
+            # blocks of every job of the level share the forward calls
+            for s in range(0, len(pairs), args.batch_size):
+                batch = pairs[s:s+args.batch_size]
+                v_f = torch.stack([cache[job["a"]][n] for job, n in batch])
+                v_b = torch.stack([cache[job["b"]][n] for job, n in batch])
+                if kind == "split":
+                    outputs = g_model.interpolate(v_f, v_b, 0, span, offset,
+                                                  args.wo_ori_volume, args.norm).unsqueeze(1)
+                else:
+                    # num_times is step for a model job
+                    outputs = g_model(v_f, v_b, num_times, args.wo_ori_volume, args.norm)
+                num_calls += 1
+                for b, (job, n) in enumerate(batch):
+                    for k, t in enumerate(job["times"]):
+                        cache[t][n] = outputs[b, k]
+    return num_calls
+
+def infer(g_model, levels, loader, step, shape, t_start, t_end, device, args):
+    blenders = {t: VolumeBlender((0, shape[0], 0, shape[1], 0, shape[2])) for t in range(t_start + 1, t_end)}
+    denormalize = utils.Denormalize()
+    num_calls = 0
+    tic = time.time()
+    with torch.no_grad():
+        for sample in tqdm(loader):
+            cache = {t_start: sample["v_f"].to(device), t_end: sample["v_b"].to(device)}
+            if levels is None:
+                # natively trained model: one call per batch for the whole gap
+                for s in range(0, cache[t_start].shape[0], args.batch_size):
+                    outputs = g_model(cache[t_start][s:s+args.batch_size], cache[t_end][s:s+args.batch_size],
+                                      step, args.wo_ori_volume, args.norm)
+                    for k in range(step):
+                        cache.setdefault(t_start + k + 1, []).append(outputs[:, k])
+                    num_calls += 1
+                for t in range(t_start + 1, t_end):
+                    cache[t] = torch.cat(cache[t], 0)
+            else:
+                num_calls += run_plan(g_model, levels, cache, step, args)
+
+            for t in range(t_start + 1, t_end):
+                volumes = denormalize(cache[t].to("cpu").numpy())
+                for b in range(volumes.shape[0]):
+                    blenders[t].add(volumes[b, 0], tile_origin(sample["vf_name"][b]))
+    return blenders, time.time() - tic, num_calls
+
+def psnr(gt, pred):
+    mse = np.mean((gt.astype(np.float64) - pred) ** 2)
+    return 20. * np.log10(gt.max() - gt.min()) - 10. * np.log10(mse)
+
+# the main function
+def main(args):
+    # log hyperparameter
+    print(args)
+
+    # select device
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda: 0" if args.cuda else "cpu")
+
+    # set random seed
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    transform = transforms.Compose([
+        utils.Normalize(),
+        utils.ToTensor()
+    ])
+    infer_dataset = InferTVDataset(
+        root=args.root,
+        sub_size=args.block_size,
+        volume_list=args.volume_test_list,
+        max_k=args.training_step,
+        transform=transform
+    )
+    volume_type, t_start, t_end = key_frames(infer_dataset)
+    shape = (120, 720, 480)
+    kwargs = {"num_workers": 4, "pin_memory": True} if args.cuda else {}
+    loader = DataLoader(infer_dataset, batch_size=args.chunk_size, shuffle=False, **kwargs)
+
+    levels = plan_intervals(t_start, t_end, args.training_step)
+    print("=> plan for timesteps {}-{} with a step {} model:".format(t_start, t_end, args.training_step))
+    for depth, level in enumerate(levels):
+        print("\tlevel {}: {}".format(depth, ", ".join(
+            "{}({}-{})".format(job["kind"], job["a"], job["b"]) for job in level)))
+    predicted = {t for level in levels for job in level for t in job["times"]}
+    print("=> {} of {} intermediate timesteps predicted, {} linearly interpolated".format(
+        len(predicted), t_end - t_start - 1, t_end - t_start - 1 - len(predicted)))
+
+    g_model = build_generator(args, device)
+    blenders, elapsed, num_calls = infer(g_model, levels, loader, args.training_step, shape,
+                                         t_start, t_end, device, args)
+    print("====> Hierarchical: {:.2f}s, {:.2f} blocks/s, {} forward calls".format(
+        elapsed, len(infer_dataset) / elapsed, num_calls
+    ))
+    results = {"hierarchical": blenders}
+
+    if args.native_resume:
+        native_args = copy.copy(args)
+        native_args.resume = args.native_resume
+        native_model = build_generator(native_args, device)
+        blenders, elapsed, num_calls = infer(native_model, None, loader, t_end - t_start - 1, shape,
+                                             t_start, t_end, device, args)
+        print("====> Native: {:.2f}s, {:.2f} blocks/s, {} forward calls".format(
+            elapsed, len(infer_dataset) / elapsed, num_calls
+        ))
+        results["native"] = blenders
+
+    for t in range(t_start + 1, t_end):
+        volume = results["hierarchical"][t].result()
+        volume_name = volume_type + '_' + ("%04d" % t) + '.raw'
+        save_volume(os.path.join(args.save_pred, volume_name), volume)
+
+        if args.gt_root:
+            gt_path = os.path.join(args.gt_root, "jet_" + ("%04d" % t), volume_type + '_' + ("%04d" % t) + '.dat')
+            gt = load_volume(gt_path, shape)
+            print("{}, PSNR {}".format(volume_name, ", ".join(
+                "{} {:.4f}".format(name, psnr(gt, blenders[t].result())) for name, blenders in results.items()
+            )))
+
+if __name__ == "__main__":
+    main(parse_args())
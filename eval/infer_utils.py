@@ -0,0 +1,115 @@
+# shared helpers of the inference scripts
+
+import os
+import json
+
+import numpy as np
+
+import torch
+
+import sys
+sys.path.append("../")
+sys.path.append("../datasets")
+sys.path.append("../model")
+from generator import Generator
+import utils
+
+def build_generator(args, device):
+    g_model = Generator(args.upsample_mode, args.forward, args.backward, args.gen_sn, args.residual)
+    g_model.to(device)
+
+    # load checkpoint
+    if args.resume:
+        if os.path.isfile(args.resume):
+            print("=> loading checkpoint {}".format(args.resume))
+            checkpoint = torch.load(args.resume, map_location=device)
+            g_model.load_state_dict(checkpoint["g_model_state_dict"])
+            print("=> load chekcpoint {} (epoch {})"
+                  .format(args.resume, checkpoint["epoch"]))
+
+    g_model.eval()
+    return g_model
+
+def tile_origin(volume_name):
+    # (z, y, x) start of a cropped block, parsed from its file name
+    _, _, x_start, y_start, z_start = utils.Parse(volume_name)
+    return z_start, y_start, x_start
+
+def key_frames(dataset):
+    # variable name and the timesteps of the two key frames of an InferTVDataset
+    volume_type, t_start, _, _, _ = utils.Parse(dataset.vs[0])
+    _, t_end, _, _, _ = utils.Parse(dataset.vs[dataset.dataset_size])
+    return volume_type, t_start, t_end
+
+def intersects(origin, block_size, bbox):
+    # bbox: (z_start, z_end, y_start, y_end, x_start, x_end), end exclusive
+    for d in range(3):
+        if origin[d] >= bbox[2*d+1] or origin[d] + block_size <= bbox[2*d]:
+            return False
+    return True
+
+def lerp_volumes(v_f, v_b, total_step):
+    # linear interpolation shaped like the generator output: (batch, total_step, 1, z, y, x)
+    w = torch.arange(1, total_step + 1, dtype=v_f.dtype, device=v_f.device) / (total_step + 1)
+    w = w.view(1, total_step, 1, 1, 1, 1)
+    return (1 - w) * v_f.unsqueeze(1) + w * v_b.unsqueeze(1)
+
+def in_value_range(v_f, v_b, min_value, max_value):
+    # whether the key frames of each block reach the (denormalized) value range
+    denormalize = utils.Denormalize()
+    key = torch.cat([v_f, v_b], 1).flatten(1)
+    low = denormalize(key.min(1)[0])
+    high = denormalize(key.max(1)[0])
+    return (high >= min_value) & (low <= max_value)
+
+def block_activity(v_f, v_b):
+    # mean absolute change between the key frames and value range of each block, in data units
+    denormalize = utils.Denormalize()
+    scale = denormalize(1.) - denormalize(0.)
+    change = (v_b - v_f).abs().flatten(1).mean(1) * scale
+    key = torch.cat([v_f, v_b], 1).flatten(1)
+    value_range = (key.max(1)[0] - key.min(1)[0]) * scale
+    return change, value_range
+
+def skip_mask(v_f, v_b, change_threshold, range_threshold=0.):
+    # blocks that barely change (or are flat) only get the linear interpolation
+    change, value_range = block_activity(v_f, v_b)
+    return (change < change_threshold) | (value_range < range_threshold)
+
+class VolumeBlender(object):
+    # accumulates overlapping blocks and averages them, restricted to bbox
+    def __init__(self, bbox):
+        self.bbox = bbox
+        shape = (bbox[1] - bbox[0], bbox[3] - bbox[2], bbox[5] - bbox[4])
+        self.res = np.zeros(shape, dtype=np.float32)
+        self.scale = np.zeros(shape, dtype=np.float32)
+
+    def add(self, volume, origin):
+        src, dst = [], []
+        for d in range(3):
+            lo = max(origin[d], self.bbox[2*d])
+            hi = min(origin[d] + volume.shape[d], self.bbox[2*d+1])
+            if lo >= hi:
+                return
+            src.append(slice(lo - origin[d], hi - origin[d]))
+            dst.append(slice(lo - self.bbox[2*d], hi - self.bbox[2*d]))
+        self.res[tuple(dst)] += volume[tuple(src)]
+        self.scale[tuple(dst)] += 1
+
+    def result(self, z_start=0, z_end=None):
+        # optionally only the slab [z_start, z_end) of the bbox
+        return self.res[z_start:z_end] / np.maximum(self.scale[z_start:z_end], 1)
+
+def load_volume(path, shape, mmap=False):
+    # raw float32 volume, same layout as volume_loader but without the per-voxel reads
+    if mmap:
+        return np.memmap(path, dtype=np.float32, mode="r", shape=shape)
+    return np.fromfile(path, dtype=np.float32).reshape(shape)
+
+def save_volume(path, volume, origin=None):
+    volume.astype(np.float32).tofile(path)
+    # a cropped volume records where it lies in the full domain
+    if origin is not None:
+        with open(os.path.splitext(path)[0] + ".json", "w") as f:
+            json.dump({"origin_zyx": [int(o) for o in origin],
+                       "shape_zyx": [int(s) for s in volume.shape]}, f)
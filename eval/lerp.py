@@ -1,10 +1,9 @@
 import os
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pdb
-sys.path.append("../datasets")
-from trainDataset import volume_loader
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Deep Learning Model")
@@ -14,29 +13,74 @@ def parse_args():
                         help="starting key timestep")
     parser.add_argument("--test-end", type=int, default=66,
                         help="ending key timestep")
-    parser.add_argument("--infering-step", type=int, default=9,
-                        help="in the infering phase, the number of intermediate volumes")
+    parser.add_argument("--infering-step", type=int, default=0,
+                        help="number of intermediate volumes between key frames (default: one interval)")
+    parser.add_argument("--method", type=str, default="linear",
+                        help="temporal baseline, linear or cubic (Catmull-Rom on four key frames)")
+    parser.add_argument("--save-dir", type=str, default="",
+                        help="dir of the baseline volumes under root (default: save_lerp or save_cubic)")
+    parser.add_argument("--chunk-size", type=int, default=8,
+                        help="number of z slices processed at a time")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of chunks processed in parallel")
     return parser.parse_args()
 
+def weights(method, u):
+    # weights of the key frames (previous, start, end, next) at the fraction u of the interval
+    if method == "linear":
+        return [0., 1 - u, u, 0.]
+    if method == "cubic":
+        return [(-u ** 3 + 2 * u ** 2 - u) / 2, (3 * u ** 3 - 5 * u ** 2 + 2) / 2,
+                (-3 * u ** 3 + 4 * u ** 2 + u) / 2, (u ** 3 - u ** 2) / 2]
+    raise ValueError("unknown method {}".format(method))
+
+def key_frame(gt_root, t, shape):
+    idx = ("%04d" % t)
+    path = os.path.join(gt_root, "jet_" + idx, "jet_mixfrac_" + idx + ".dat")
+    if not os.path.isfile(path):
+        return None
+    return np.memmap(path, dtype=np.float32, mode="r", shape=shape)
+
+def interpolate_interval(args, gt_root, save_root, start, end, shape, pool):
+    interval = end - start
+    keys = [key_frame(gt_root, start - interval, shape), key_frame(gt_root, start, shape),
+            key_frame(gt_root, end, shape), key_frame(gt_root, end + interval, shape)]
+    # outside the available range the spline is clamped to the closest key frame
+    if keys[0] is None:
+        keys[0] = keys[1]
+    if keys[3] is None:
+        keys[3] = keys[2]
+
+    preds = []
+    for i in range(start + 1, end):
+        volume_name = "jet_mixfrac_" + ("%04d" % i) + '.raw'
+        pred = np.memmap(os.path.join(save_root, volume_name), dtype=np.float32, mode="w+", shape=shape)
+        preds.append((pred, weights(args.method, (i - start) / interval)))
+
+    def chunk(z):
+        frames = [np.asarray(key[z:z+args.chunk_size]) for key in keys]
+        for pred, w in preds:
+            out = pred[z:z+args.chunk_size]
+            np.multiply(frames[1], np.float32(w[1]), out=out)
+            for n in (0, 2, 3):
+                if w[n] != 0:
+                    out += np.float32(w[n]) * frames[n]
+
+    list(pool.map(chunk, range(0, shape[0], args.chunk_size)))
+    for pred, _ in preds:
+        pred.flush()
+
 def main(args):
     zSize, ySize, xSize = 120, 720, 480
 
     gt_root = os.path.join(args.root, "exavisData", "combustion")
+    save_root = os.path.join(args.root, args.save_dir or ("save_lerp" if args.method == "linear" else "save_cubic"))
 
-    start_idx = ("%04d" % args.test_start)
-    gt_start_filepath = os.path.join(gt_root, "jet_" + start_idx, "jet_mixfrac_" + start_idx + ".dat")
-    gt_start = volume_loader(gt_start_filepath, zSize, ySize, xSize)
-    end_idx = ("%04d" % args.test_end)
-    gt_end_filepath = os.path.join(gt_root, "jet_" + end_idx, "jet_mixfrac_" + end_idx + ".dat")
-    gt_end = volume_loader(gt_end_filepath, zSize, ySize, xSize)
-
-    for i in range(args.test_start+1, args.test_end):
-        offset = i - args.test_start
-        interval = args.test_end - args.test_start
-        pred = (1 - offset / interval) * gt_start + offset / interval * gt_end
-        pred = pred.astype(np.float32)
-        volume_name = "jet_mixfrac_" + ("%04d" % i) + '.raw'
-        pred.tofile(os.path.join(args.root, "save_lerp", volume_name))
+    interval = args.infering_step + 1 if args.infering_step > 0 else args.test_end - args.test_start
+    with ThreadPoolExecutor(args.workers) as pool:
+        for start in range(args.test_start, args.test_end, interval):
+            end = min(start + interval, args.test_end)
+            interpolate_interval(args, gt_root, save_root, start, end, (zSize, ySize, xSize), pool)
 
 if __name__ == "__main__":
-    main(parse_args())
\ No newline at end of file
+    main(parse_args())
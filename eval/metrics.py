@@ -0,0 +1,145 @@
+# streaming volume metrics
+
+import os
+import sys
+import argparse
+import json
+from multiprocessing import Pool
+
+import numpy as np
+
+import torch
+
+from ssim3d import ssim3d
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+    parser.add_argument("--root", required=True, type=str,
+                        help="root of the dataset")
+    parser.add_argument("--pred-dir", type=str, default="save_pred",
+                        help="dir of the predicted volumes under root (e.g. save_pred or save_lerp)")
+    parser.add_argument("--test-start", type=int, default=50,
+                        help="starting key timestep")
+    parser.add_argument("--test-end", type=int, default=66,
+                        help="ending key timestep")
+    parser.add_argument("--infering-step", type=int, default=7,
+                        help="in the infering phase, the number of intermediate volumes")
+    parser.add_argument("--volume-type", type=str, default="jet_mixfrac")
+    parser.add_argument("--chunk-size", type=int, default=8,
+                        help="number of z slices processed at a time")
+    parser.add_argument("--ssim", action="store_true", default=False,
+                        help="also compute the volumetric SSIM")
+    parser.add_argument("--ssim-slab-size", type=int, default=16,
+                        help="number of z slices per SSIM slab")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of timesteps evaluated in parallel")
+    parser.add_argument("--output", type=str, default="metrics.json",
+                        help="machine-readable report")
+    return parser.parse_args()
+
+def volume_metrics(gt, pred, chunk_size):
+    # one pass over z slabs; only the accumulators are float64
+    sse = 0.
+    max_error = 0.
+    gt_min, gt_max = np.inf, -np.inf
+    diff = None
+    for z in range(0, gt.shape[0], chunk_size):
+        g = np.asarray(gt[z:z+chunk_size])
+        p = np.asarray(pred[z:z+chunk_size])
+        if diff is None or diff.shape != g.shape:
+            diff = np.empty(g.shape, dtype=np.float32)
+        np.subtract(g, p, out=diff)
+        np.abs(diff, out=diff)
+        max_error = max(max_error, float(diff.max()))
+        np.square(diff, out=diff)
+        sse += float(diff.sum(dtype=np.float64))
+        gt_min = min(gt_min, float(g.min()))
+        gt_max = max(gt_max, float(g.max()))
+
+    mse = sse / gt.size
+    data_range = gt_max - gt_min
+    # undefined (None) for an exact prediction or a constant volume, and left out of the averages
+    psnr = 20. * np.log10(data_range) - 10. * np.log10(mse) if mse > 0 and data_range > 0 else None
+    return {"mse": mse, "psnr": psnr, "max_error": max_error, "data_range": data_range,
+            "min": gt_min, "max": gt_max}
+
+def evaluate(job):
+    t, args = job
+    zSize, ySize, xSize = 120, 720, 480
+    idx = ("%04d" % t)
+    gt_root = os.path.join(args.root, "exavisData", "combustion")
+    gt = np.memmap(os.path.join(gt_root, "jet_" + idx, args.volume_type + "_" + idx + ".dat"),
+                   dtype=np.float32, mode="r", shape=(zSize, ySize, xSize))
+    pred = np.memmap(os.path.join(args.root, args.pred_dir, args.volume_type + "_" + idx + ".raw"),
+                     dtype=np.float32, mode="r", shape=(zSize, ySize, xSize))
+    metrics = volume_metrics(gt, pred, args.chunk_size)
+    if args.ssim:
+        torch.set_num_threads(max(os.cpu_count() // args.workers, 1))
+        metrics["ssim"] = ssim3d(gt, pred, metrics["data_range"], slab_size=args.ssim_slab_size)
+    metrics["timestep"] = t
+    metrics["offset"] = (t - args.test_start) % (args.infering_step + 1)
+    return metrics
+
+def summarize(timesteps, interval):
+    # averages per offset inside the key frame interval, and per distance to the closest key frame
+    keys = [key for key in ("psnr", "mse", "ssim") if key in timesteps[0]]
+
+    def mean(members, key):
+        values = [m[key] for m in members if m[key] is not None]
+        return float(np.mean(values)) if values else None
+
+    summary = {"mean_" + key: mean(timesteps, key) for key in keys}
+    summary["undefined_psnr"] = sum(m["psnr"] is None for m in timesteps)
+    summary["per_offset"] = {}
+    summary["per_distance"] = {}
+    for m in timesteps:
+        distance = min(m["offset"], interval - m["offset"])
+        summary["per_offset"].setdefault(str(m["offset"]), []).append(m)
+        summary["per_distance"].setdefault(str(distance), []).append(m)
+    for group in ("per_offset", "per_distance"):
+        for name, members in summary[group].items():
+            summary[group][name] = {"mean_" + key: mean(members, key) for key in keys}
+            summary[group][name]["count"] = len(members)
+    return summary
+
+def main(args):
+    jobs = [(t, args) for t in range(args.test_start, args.test_end + 1)
+            if (t - args.test_start) % (args.infering_step + 1) != 0]
+    if not jobs:
+        print("=> no intermediate timestep between {} and {} with an inferring step of {}".format(
+            args.test_start, args.test_end, args.infering_step))
+        sys.exit(1)
+    missing = [t for t, _ in jobs if not os.path.isfile(
+        os.path.join(args.root, args.pred_dir, args.volume_type + "_" + "%04d" % t + ".raw"))]
+    if missing:
+        print("=> no prediction in {} for timesteps {}".format(os.path.join(args.root, args.pred_dir), missing))
+        sys.exit(1)
+    with Pool(min(args.workers, len(jobs))) as pool:
+        timesteps = pool.map(evaluate, jobs)
+
+    for m in timesteps:
+        psnr = m["psnr"] if m["psnr"] is not None else "undefined"
+        if args.ssim:
+            print("{}_{}, PSNR {}, SSIM {}".format(args.volume_type, "%04d" % m["timestep"], psnr, m["ssim"]))
+        else:
+            print("{}_{}, PSNR {}".format(args.volume_type, "%04d" % m["timestep"], psnr))
+    summary = summarize(timesteps, args.infering_step + 1)
+    print("Average PSNR: {}".format(summary["mean_psnr"]))
+    if summary["undefined_psnr"]:
+        print("=> PSNR undefined for {} timesteps (exact prediction or constant volume), left out of the averages"
+              .format(summary["undefined_psnr"]))
+    if args.ssim:
+        print("Average SSIM: {}".format(summary["mean_ssim"]))
+    for offset, m in sorted(summary["per_offset"].items(), key=lambda item: int(item[0])):
+        print("\toffset {}: PSNR {}{} ({} timesteps)".format(
+            offset, "{:.4f}".format(m["mean_psnr"]) if m["mean_psnr"] is not None else "undefined",
+            ", SSIM {:.4f}".format(m["mean_ssim"]) if args.ssim else "", m["count"]
+        ))
+
+    with open(args.output, "w") as f:
+        json.dump({"config": {"pred_dir": args.pred_dir, "test_start": args.test_start,
+                              "test_end": args.test_end, "infering_step": args.infering_step},
+                   "timesteps": timesteps, "summary": summary}, f, indent=2)
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,178 @@
+# coarse-to-fine progressive inference
+
+import os
+import argparse
+import time
+
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+import sys
+sys.path.append("../")
+sys.path.append("../datasets")
+sys.path.append("../model")
+import utils
+from infer_utils import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disable CUDA inference")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: 1)")
+
+    parser.add_argument("--root", required=True, type=str,
+                        help="dir of the full jet_XXXX/ key frame volumes")
+    parser.add_argument("--save-pred", required=True, type=str,
+                        help="dir of predicted volumes")
+    parser.add_argument("--resume", type=str, default="",
+                        help="path to the latest checkpoint (default: none)")
+    parser.add_argument("--volume-type", type=str, default="jet_mixfrac")
+    parser.add_argument("--test-start", type=int, default=50,
+                        help="starting key timestep")
+    parser.add_argument("--test-end", type=int, default=54,
+                        help="ending key timestep")
+
+    parser.add_argument("--gen-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
+    parser.add_argument("--wo-ori-volume", action="store_true", default=False,
+                        help="during training, without the original volume")
+    parser.add_argument("--upsample-mode", type=str, default="lr",
+                        help="how to do upsample, voxel shuffle (lr) or interpolate (hr)")
+    parser.add_argument("--norm", type=str, default="",
+                        help="how normalize hidden layer, none or batch norm or instance norm")
+    parser.add_argument("--forward", action="store_true", default=False,
+                        help="during training, do forward prediction")
+    parser.add_argument("--backward", action="store_true", default=False,
+                        help="during training, do backward prediction")
+
+    parser.add_argument("--batch-size", type=int, default=4,
+                        help="batch size for inference")
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="the size of the sub-block")
+    parser.add_argument("--stride", type=int, default=48,
+                        help="distance between neighbouring blocks, smaller than the block size to blend seams")
+    parser.add_argument("--preview-factor", type=int, default=4,
+                        help="downsampling factor of the preview pass in each axis")
+    parser.add_argument("--no-refine", action="store_true", default=False,
+                        help="stop after the preview")
+    return parser.parse_args()
+
+def block_origins(shape, block_size, stride):
+    # block grid covering the volume, the last block of every axis flush with the border
+    axes = []
+    for size in shape:
+        if size <= block_size:
+            axes.append([0])
+            continue
+        starts = list(range(0, size - block_size + 1, stride))
+        if starts[-1] != size - block_size:
+            starts.append(size - block_size)
+        axes.append(starts)
+    return [(z, y, x) for z in axes[0] for y in axes[1] for x in axes[2]]
+
+class VolumeWriter(object):
+    # memory-mapped output volumes that both passes write into, so readers always see the latest level
+    def __init__(self, save_dir, volume_type, timesteps, shape):
+        self.volumes = {}
+        for t in timesteps:
+            path = os.path.join(save_dir, volume_type + '_' + ("%04d" % t) + '.raw')
+            self.volumes[t] = np.memmap(path, dtype=np.float32, mode="w+", shape=shape)
+
+    def write(self, t, volume, origin=(0, 0, 0)):
+        z, y, x = origin
+        self.volumes[t][z:z+volume.shape[0], y:y+volume.shape[1], x:x+volume.shape[2]] = volume
+        self.volumes[t].flush()
+
+def pad_to_block(v, block_size):
+    # replicate the border so that every axis holds at least one block
+    pad = []
+    for size in reversed(v.shape[2:]):
+        pad += [0, max(block_size - size, 0)]
+    return F.pad(v, pad, mode="replicate")
+
+def infer_blocks(g_model, v_f, v_b, origins, total_step, blenders, args):
+    # predicts the blocks of the key frames (1, 1, z, y, x) at origins and adds them to the blenders
+    bs = args.block_size
+    denormalize = utils.Denormalize()
+    for s in range(0, len(origins), args.batch_size):
+        batch = origins[s:s+args.batch_size]
+        f = torch.cat([v_f[:, :, z:z+bs, y:y+bs, x:x+bs] for z, y, x in batch])
+        b = torch.cat([v_b[:, :, z:z+bs, y:y+bs, x:x+bs] for z, y, x in batch])
+        outputs = denormalize(g_model(f, b, total_step, args.wo_ori_volume, args.norm).to("cpu").numpy())
+        for n, origin in enumerate(batch):
+            for j in range(total_step):
+                blenders[j].add(outputs[n, j, 0], origin)
+
+# the main function
+def main(args):
+    # log hyperparameter
+    print(args)
+
+    # select device
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda: 0" if args.cuda else "cpu")
+
+    # set random seed
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    tic = time.time()
+    shape = (120, 720, 480)
+    normalize = utils.Normalize()
+    key = []
+    for t in (args.test_start, args.test_end):
+        path = os.path.join(args.root, "jet_" + ("%04d" % t), args.volume_type + '_' + ("%04d" % t) + '.dat')
+        key.append(torch.from_numpy(normalize(load_volume(path, shape)))[None, None].to(device))
+    v_f, v_b = key
+    total_step = args.test_end - args.test_start - 1
+    timesteps = list(range(args.test_start + 1, args.test_end))
+
+    g_model = build_generator(args, device)
+    writer = VolumeWriter(args.save_pred, args.volume_type, timesteps, shape)
+
+    with torch.no_grad():
+        # 1) preview: the same block size on downsampled key frames, upsampled back to full resolution
+        factor = args.preview_factor
+        f = F.avg_pool3d(v_f, factor, ceil_mode=True)
+        coarse = f.shape[2:]
+        f = pad_to_block(f, args.block_size)
+        b = pad_to_block(F.avg_pool3d(v_b, factor, ceil_mode=True), args.block_size)
+        # the overlap between blocks shrinks with the resolution
+        stride = args.block_size - max((args.block_size - args.stride) // factor, 1)
+        origins = block_origins(f.shape[2:], args.block_size, stride)
+        blenders = [VolumeBlender((0, coarse[0], 0, coarse[1], 0, coarse[2])) for _ in timesteps]
+        infer_blocks(g_model, f, b, origins, total_step, blenders, args)
+        for j, t in enumerate(timesteps):
+            preview = torch.from_numpy(blenders[j].result())[None, None]
+            preview = F.interpolate(preview, scale_factor=factor, mode="trilinear", align_corners=False)
+            writer.write(t, preview[0, 0, :shape[0], :shape[1], :shape[2]].numpy())
+        print("====> Preview of {} timesteps ({} blocks at 1/{}) after {:.2f}s".format(
+            total_step, len(origins), factor, time.time() - tic
+        ))
+        if args.no_refine:
+            return
+
+        # 2) refine: full resolution, one row of blocks along z at a time
+        origins = block_origins(shape, args.block_size, args.stride)
+        rows = sorted(set(z for z, _, _ in origins))
+        blenders = [VolumeBlender((0, shape[0], 0, shape[1], 0, shape[2])) for _ in timesteps]
+        written = 0
+        for n, z in enumerate(rows):
+            infer_blocks(g_model, v_f, v_b, [o for o in origins if o[0] == z], total_step, blenders, args)
+            # voxels below the next row are covered by no later block, so they are final
+            z_end = rows[n + 1] if n + 1 < len(rows) else shape[0]
+            for j, t in enumerate(timesteps):
+                writer.write(t, blenders[j].result(written, z_end), (written, 0, 0))
+            print("====> Refined z {}-{} after {:.2f}s".format(written, z_end, time.time() - tic))
+            written = z_end
+
+    print("====> Full resolution after {:.2f}s".format(time.time() - tic))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,169 @@
+# single timestep query
+
+import os
+import argparse
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+import torch
+from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
+
+import sys
+sys.path.append("../")
+sys.path.append("../datasets")
+sys.path.append("../model")
+from inferDataset import *
+import utils
+from infer_utils import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disable CUDA inference")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: 1)")
+
+    parser.add_argument("--root", required=True, type=str,
+                        help="root of the dataset")
+    parser.add_argument("--save-pred", required=True, type=str,
+                        help="dir of predicted volumes")
+    parser.add_argument("--resume", type=str, default="",
+                        help="path to the latest checkpoint (default: none)")
+    parser.add_argument("--volume-test-list", type=str, default="volume_test_list.txt")
+
+    parser.add_argument("--gen-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
+    parser.add_argument("--wo-ori-volume", action="store_true", default=False,
+                        help="during training, without the original volume")
+    parser.add_argument("--upsample-mode", type=str, default="lr",
+                        help="how to do upsample, voxel shuffle (lr) or interpolate (hr)")
+    parser.add_argument("--norm", type=str, default="",
+                        help="how normalize hidden layer, none or batch norm or instance norm")
+    parser.add_argument("--forward", action="store_true", default=False,
+                        help="during training, do forward prediction")
+    parser.add_argument("--backward", action="store_true", default=False,
+                        help="during training, do backward prediction")
+
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="batch size for inference")
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="the size of the sub-block")
+    parser.add_argument("--timestep", required=True, type=int,
+                        help="the intermediate timestep to infer")
+    parser.add_argument("--bbox", type=int, nargs=6, default=None,
+                        metavar=("X0", "X1", "Y0", "Y1", "Z0", "Z1"),
+                        help="only infer the given sub-region (end exclusive)")
+    parser.add_argument("--benchmark", type=int, default=0,
+                        help="compare the latency against full-interval inference on the given number of batches")
+    return parser.parse_args()
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+def benchmark(args, g_model, loader, t_start, t_end, device):
+    total_step = t_end - t_start - 1
+    time_full, time_query = 0., 0.
+    num_batches = 0
+    with torch.no_grad():
+        for i, sample in enumerate(loader):
+            if i >= args.benchmark:
+                break
+            v_f = sample["v_f"].to(device)
+            v_b = sample["v_b"].to(device)
+
+            sync(device)
+            tic = time.time()
+            g_model(v_f, v_b, total_step, args.wo_ori_volume, args.norm)
+            sync(device)
+            time_full += time.time() - tic
+
+            tic = time.time()
+            g_model.interpolate(v_f, v_b, t_start, t_end, args.timestep, args.wo_ori_volume, args.norm)
+            sync(device)
+            time_query += time.time() - tic
+            num_batches += 1
+
+    print("====> Latency per batch: full interval {:.4f}s, timestep {} {:.4f}s, speedup {:.2f}x".format(
+        time_full / num_batches, args.timestep, time_query / num_batches, time_full / time_query
+    ))
+
+# the main function
+def main(args):
+    # log hyperparameter
+    print(args)
+
+    # select device
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda: 0" if args.cuda else "cpu")
+
+    # set random seed
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # data loader
+    transform = transforms.Compose([
+        utils.Normalize(),
+        utils.ToTensor()
+    ])
+    infer_dataset = InferTVDataset(
+        root=args.root,
+        sub_size=args.block_size,
+        volume_list=args.volume_test_list,
+        max_k=0,
+        transform=transform
+    )
+    volume_type, t_start, t_end = key_frames(infer_dataset)
+    max_k = t_end - t_start - 1
+    infer_dataset.max_k = max_k
+
+    zSize, ySize, xSize = 120, 720, 480
+    if args.bbox is not None:
+        x0, x1, y0, y1, z0, z1 = args.bbox
+        bbox = (z0, z1, y0, y1, x0, x1)
+    else:
+        bbox = (0, zSize, 0, ySize, 0, xSize)
+
+    # only the blocks touching the requested region are loaded and inferred
+    indices = [i for i in range(len(infer_dataset))
+               if intersects(tile_origin(infer_dataset.vs[i]), args.block_size, bbox)]
+    print("=> {} of {} blocks intersect the region".format(len(indices), len(infer_dataset)))
+
+    kwargs = {"num_workers": 4, "pin_memory": True} if args.cuda else {}
+    infer_loader = DataLoader(Subset(infer_dataset, indices), batch_size=args.batch_size,
+                              shuffle=False, **kwargs)
+
+    # model
+    g_model = build_generator(args, device)
+
+    if args.benchmark > 0:
+        benchmark(args, g_model, infer_loader, t_start, t_end, device)
+
+    blender = VolumeBlender(bbox)
+    denormalize = utils.Denormalize()
+    time_start = time.time()
+    with torch.no_grad():
+        for i, sample in tqdm(enumerate(infer_loader)):
+            v_f = sample["v_f"].to(device)
+            v_b = sample["v_b"].to(device)
+            fake_volumes = g_model.interpolate(v_f, v_b, t_start, t_end, args.timestep,
+                                               args.wo_ori_volume, args.norm)
+            fake_volumes = denormalize(fake_volumes.to("cpu").numpy())
+            for b in range(fake_volumes.shape[0]):
+                blender.add(fake_volumes[b, 0], tile_origin(sample["vf_name"][b]))
+    print("====> Timestep {} inferred in {:.2f}s ({} of {} intermediates, interval {}-{})".format(
+        args.timestep, time.time() - time_start, 1, max_k, t_start, t_end
+    ))
+
+    volume_name = volume_type + '_' + ("%04d" % args.timestep) + '.raw'
+    save_volume(os.path.join(args.save_pred, volume_name), blender.result(),
+                origin=bbox[::2] if args.bbox is not None else None)
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,299 @@
+# local inference server
+
+import os
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+import torch
+from torchvision import transforms
+
+import sys
+sys.path.append("../")
+sys.path.append("../datasets")
+sys.path.append("../model")
+from inferDataset import *
+import utils
+from infer_utils import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disable CUDA inference")
+
+    parser.add_argument("--root", required=True, type=str,
+                        help="root of the dataset")
+    parser.add_argument("--resume", type=str, default="",
+                        help="path to the latest checkpoint (default: none)")
+    parser.add_argument("--volume-test-list", type=str, action="append", default=None,
+                        help="test list of one key frame interval, can be given several times")
+
+    parser.add_argument("--gen-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
+    parser.add_argument("--wo-ori-volume", action="store_true", default=False,
+                        help="during training, without the original volume")
+    parser.add_argument("--upsample-mode", type=str, default="lr",
+                        help="how to do upsample, voxel shuffle (lr) or interpolate (hr)")
+    parser.add_argument("--norm", type=str, default="",
+                        help="how normalize hidden layer, none or batch norm or instance norm")
+    parser.add_argument("--forward", action="store_true", default=False,
+                        help="during training, do forward prediction")
+    parser.add_argument("--backward", action="store_true", default=False,
+                        help="during training, do backward prediction")
+
+    parser.add_argument("--batch-size", type=int, default=4,
+                        help="number of blocks inferred together")
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="the size of the sub-block")
+
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="address to listen on (default: localhost only)")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port to listen on")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="memory budget of the block cache in MB")
+    return parser.parse_args()
+
+class LRUCache(object):
+    # least recently used blocks are evicted once the byte budget is exceeded
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.size -= self.entries.pop(key).nbytes
+        self.entries[key] = value
+        self.size += value.nbytes
+        while self.size > self.budget and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        # the latencies of the last requests
+        self.latencies = deque(maxlen=1000)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def summary(self, cache):
+        with self.lock:
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "requests": self.requests,
+                "latency_mean": float(latencies.mean()),
+                "latency_p50": float(np.percentile(latencies, 50)),
+                "latency_p95": float(np.percentile(latencies, 95)),
+                "block_hits": self.hits,
+                "block_misses": self.misses,
+                "block_coalesced": self.coalesced,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.,
+                "cache_entries": len(cache.entries),
+                "cache_bytes": cache.size,
+                "cache_budget": cache.budget,
+            }
+
+class InferenceService(object):
+    def __init__(self, args, device):
+        self.args = args
+        self.device = device
+        self.g_model = build_generator(args, device)
+        self.denormalize = utils.Denormalize()
+        transform = transforms.Compose([
+            utils.Normalize(),
+            utils.ToTensor()
+        ])
+
+        # key frame intervals per variable
+        self.intervals = {}
+        for volume_list in args.volume_test_list or ["volume_test_list.txt"]:
+            dataset = InferTVDataset(root=args.root, sub_size=args.block_size, max_k=0,
+                                     volume_list=volume_list, transform=transform)
+            volume_type, t_start, t_end = key_frames(dataset)
+            dataset.max_k = t_end - t_start - 1
+            origins = [tile_origin(dataset.vs[i]) for i in range(len(dataset))]
+            self.intervals.setdefault(volume_type, []).append((t_start, t_end, dataset, origins))
+            print("=> serving {} timesteps {}-{} ({} blocks)".format(volume_type, t_start, t_end, len(dataset)))
+
+        self.cache = LRUCache(args.cache_size * 1024 * 1024)
+        self.metrics = Metrics()
+        self.lock = threading.Lock()
+        self.model_lock = threading.Lock()
+        self.pending = {}
+
+    def find_interval(self, volume_type, t):
+        for interval in self.intervals.get(volume_type, []):
+            if interval[0] <= t < interval[1]:
+                return interval
+        raise ValueError("no key frames around {} timestep {}".format(volume_type, t))
+
+    def compute(self, keys, dataset, t_start, t_end):
+        # infer the blocks owned by this request, a batch at a time
+        results = {}
+        for n in range(0, len(keys), self.args.batch_size):
+            batch_keys = keys[n:n+self.args.batch_size]
+            samples = [dataset[key[2]] for key in batch_keys]
+            v_f = torch.stack([sample["v_f"] for sample in samples]).to(self.device)
+            v_b = torch.stack([sample["v_b"] for sample in samples]).to(self.device)
+            t = batch_keys[0][1]
+            with self.model_lock, torch.no_grad():
+                if t == t_start:
+                    volumes = v_f
+                else:
+                    volumes = self.g_model.interpolate(v_f, v_b, t_start, t_end, t,
+                                                       self.args.wo_ori_volume, self.args.norm)
+                volumes = self.denormalize(volumes.to("cpu").numpy())
+            for b, key in enumerate(batch_keys):
+                volume = np.ascontiguousarray(volumes[b, 0])
+                with self.lock:
+                    self.cache.put(key, volume)
+                    event = self.pending.pop(key)
+                event.result = volume
+                event.set()
+                results[key] = volume
+        return results
+
+    def query(self, volume_type, t, bbox):
+        tic = time.time()
+        t_start, t_end, dataset, origins = self.find_interval(volume_type, t)
+        indices = [i for i in range(len(dataset)) if intersects(origins[i], self.args.block_size, bbox)]
+
+        found, owned, waiting = {}, [], []
+        with self.lock:
+            for i in indices:
+                key = (volume_type, t, i)
+                volume = self.cache.get(key)
+                if volume is not None:
+                    found[i] = volume
+                elif key in self.pending:
+                    # another request is already inferring this block
+                    waiting.append((i, self.pending[key]))
+                else:
+                    self.pending[key] = threading.Event()
+                    owned.append(key)
+        with self.metrics.lock:
+            self.metrics.hits += len(found)
+            self.metrics.coalesced += len(waiting)
+            self.metrics.misses += len(owned)
+
+        try:
+            computed = self.compute(owned, dataset, t_start, t_end)
+        except Exception:
+            with self.lock:
+                for key in owned:
+                    event = self.pending.pop(key, None)
+                    if event is not None:
+                        event.result = None
+                        event.set()
+            raise
+        for key in owned:
+            found[key[2]] = computed[key]
+        for i, event in waiting:
+            event.wait()
+            if event.result is None:
+                raise RuntimeError("inference of block {} failed".format(i))
+            found[i] = event.result
+
+        blender = VolumeBlender(bbox)
+        for i in indices:
+            blender.add(found[i], origins[i])
+        result = blender.result()
+
+        with self.metrics.lock:
+            self.metrics.requests += 1
+            self.metrics.latencies.append(time.time() - tic)
+        return result
+
+def make_handler(service):
+    zSize, ySize, xSize = 120, 720, 480
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, content):
+            body = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/metrics":
+                self.send_json(200, service.metrics.summary(service.cache))
+                return
+            if url.path != "/volume":
+                self.send_json(404, {"error": "unknown path {}".format(url.path)})
+                return
+
+            # /volume?var=jet_mixfrac&t=55&bbox=x0,x1,y0,y1,z0,z1
+            try:
+                volume_type = query.get("var", ["jet_mixfrac"])[0]
+                t = int(query["t"][0])
+                if "bbox" in query:
+                    x0, x1, y0, y1, z0, z1 = [int(v) for v in query["bbox"][0].split(",")]
+                    bbox = (z0, z1, y0, y1, x0, x1)
+                else:
+                    bbox = (0, zSize, 0, ySize, 0, xSize)
+                volume = service.query(volume_type, t, bbox)
+            except (KeyError, ValueError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                # a failed inference or a missing key frame file
+                self.send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+                return
+
+            body = volume.astype(np.float32).tobytes()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Shape-ZYX", ",".join(str(s) for s in volume.shape))
+            self.send_header("X-Origin-ZYX", ",".join(str(o) for o in bbox[::2]))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+# the main function
+def main(args):
+    # log hyperparameter
+    print(args)
+
+    # select device
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda: 0" if args.cuda else "cpu")
+
+    service = InferenceService(args, device)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print("=> listening on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main(parse_args())
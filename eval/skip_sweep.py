@@ -0,0 +1,149 @@
+# PSNR / throughput trade-off of adaptive block skipping
+
+import os
+import argparse
+import time
+
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
+
+import sys
+sys.path.append("../")
+sys.path.append("../datasets")
+sys.path.append("../model")
+from trainDataset import *
+import utils
+from infer_utils import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disable CUDA inference")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: 1)")
+
+    parser.add_argument("--root", required=True, type=str,
+                        help="root of the dataset")
+    parser.add_argument("--resume", type=str, default="",
+                        help="path to the latest checkpoint (default: none)")
+    parser.add_argument("--volume-test-list", type=str, default="volume_test_list.txt")
+
+    parser.add_argument("--gen-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
+    parser.add_argument("--wo-ori-volume", action="store_true", default=False,
+                        help="during training, without the original volume")
+    parser.add_argument("--upsample-mode", type=str, default="lr",
+                        help="how to do upsample, voxel shuffle (lr) or interpolate (hr)")
+    parser.add_argument("--norm", type=str, default="",
+                        help="how normalize hidden layer, none or batch norm or instance norm")
+    parser.add_argument("--forward", action="store_true", default=False,
+                        help="during training, do forward prediction")
+    parser.add_argument("--backward", action="store_true", default=False,
+                        help="during training, do backward prediction")
+
+    parser.add_argument("--batch-size", type=int, default=4,
+                        help="batch size for inference")
+    parser.add_argument("--training-step", type=int, default=3,
+                        help="the number of intermediate volumes of the test list")
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="the size of the sub-block")
+    parser.add_argument("--num-samples", type=int, default=0,
+                        help="number of held-out samples to use (default: all)")
+    parser.add_argument("--thresholds", type=float, nargs="+",
+                        default=[0., 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2],
+                        help="mean key frame change thresholds to sweep")
+    parser.add_argument("--output", type=str, default="",
+                        help="write the trade-off curve as csv")
+    return parser.parse_args()
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+# the main function
+def main(args):
+    # log hyperparameter
+    print(args)
+
+    # select device
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda: 0" if args.cuda else "cpu")
+
+    # set random seed
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # held-out samples with ground truth intermediates, read again for every threshold
+    transform = transforms.Compose([
+        utils.Normalize(),
+        utils.ToTensor()
+    ])
+    test_dataset = TVDataset(
+        root=args.root,
+        sub_size=args.block_size,
+        volume_list=args.volume_test_list,
+        max_k=args.training_step,
+        train=False,
+        transform=transform
+    )
+    if args.num_samples > 0:
+        indices = np.random.permutation(len(test_dataset))[:args.num_samples]
+        test_dataset = Subset(test_dataset, indices.tolist())
+    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False)
+    num_blocks = len(test_dataset)
+
+    g_model = build_generator(args, device)
+
+    curve = []
+    with torch.no_grad():
+        for threshold in args.thresholds:
+            psnr_sum, psnr_count, num_skipped, elapsed = 0., 0, 0, 0.
+            for sample in test_loader:
+                v_f = sample["v_f"].to(device)
+                v_b = sample["v_b"].to(device)
+                v_i = sample["v_i"].to(device)
+
+                sync(device)
+                tic = time.time()
+                active = ~skip_mask(v_f, v_b, threshold)
+                fake_volumes = lerp_volumes(v_f, v_b, args.training_step)
+                if active.any():
+                    fake_volumes[active] = g_model(v_f[active], v_b[active], args.training_step,
+                                                   args.wo_ori_volume, args.norm)
+                sync(device)
+                elapsed += time.time() - tic
+                num_skipped += int((~active).sum())
+
+                # PSNR of every intermediate against its own data range; it is undefined for an exact prediction
+                # or a constant intermediate, which are left out of the average
+                mse = (fake_volumes - v_i).pow(2).flatten(2).mean(2)
+                diff = v_i.flatten(2).max(2)[0] - v_i.flatten(2).min(2)[0]
+                defined = (mse > 0) & (diff > 0)
+                psnr = 20. * torch.log10(diff[defined]) - 10. * torch.log10(mse[defined])
+                psnr_sum += psnr.sum().item()
+                psnr_count += psnr.numel()
+
+            if psnr_count < num_blocks * args.training_step:
+                print("=> threshold {:.2e}: PSNR undefined for {} of {} intermediates".format(
+                    threshold, num_blocks * args.training_step - psnr_count, num_blocks * args.training_step))
+            curve.append((threshold, num_skipped / num_blocks, psnr_sum / psnr_count if psnr_count else float("nan"),
+                          num_blocks / elapsed))
+
+    print("threshold\tskipped\tPSNR\tblocks/s")
+    for threshold, skipped, psnr, throughput in curve:
+        print("{:.2e}\t{:.3f}\t{:.4f}\t{:.2f}".format(threshold, skipped, psnr, throughput))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("threshold,skipped,psnr,blocks_per_second\n")
+            for row in curve:
+                f.write("{},{},{},{}\n".format(*row))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,82 @@
+# volumetric SSIM with separable gaussian windows
+
+import argparse
+import time
+
+import numpy as np
+
+import torch
+
+def gaussian_kernel(sigma, truncate):
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+def separable_filter(x, kernel):
+    # valid gaussian filtering of (n, 1, z, y, x) along each axis in turn, as a sum of shifted slices
+    # (much faster than conv3d with a 1d kernel on CPU)
+    k = len(kernel)
+    for dim in (2, 3, 4):
+        length = x.shape[dim] - k + 1
+        out = x.narrow(dim, 0, length) * float(kernel[0])
+        for i in range(1, k):
+            out.add_(x.narrow(dim, i, length), alpha=float(kernel[i]))
+        x = out
+    return x
+
+def ssim3d(gt, pred, data_range, sigma=1.5, truncate=3.5, slab_size=16, device="cpu"):
+    # mean SSIM over the voxels whose whole window lies inside the volume,
+    # computed on overlapping z slabs so that only slab_size + 2 * radius slices are in memory
+    kernel = gaussian_kernel(sigma, truncate)
+    radius = (len(kernel) - 1) // 2
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+
+    zSize = gt.shape[0]
+    ssim_sum = 0.
+    count = 0
+    for z in range(radius, zSize - radius, slab_size):
+        z_end = min(z + slab_size, zSize - radius)
+        g = torch.from_numpy(np.array(gt[z-radius:z_end+radius], dtype=np.float32)).to(device)
+        p = torch.from_numpy(np.array(pred[z-radius:z_end+radius], dtype=np.float32)).to(device)
+
+        # all five local moments in one batch
+        stack = torch.stack([g, p, g * g, p * p, g * p]).unsqueeze(1)
+        mu_g, mu_p, gg, pp, gp = separable_filter(stack, kernel)[:, 0]
+        var_g = gg - mu_g * mu_g
+        var_p = pp - mu_p * mu_p
+        cov = gp - mu_g * mu_p
+
+        ssim_map = ((2 * mu_g * mu_p + c1) * (2 * cov + c2)) / \
+                   ((mu_g * mu_g + mu_p * mu_p + c1) * (var_g + var_p + c2))
+        ssim_sum += ssim_map.double().sum().item()
+        count += ssim_map.numel()
+
+    return ssim_sum / count
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+    parser.add_argument("--slab-size", type=int, default=16,
+                        help="number of z slices per slab")
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disable CUDA")
+    return parser.parse_args()
+
+# benchmark on a synthetic full-size timestep
+def main(args):
+    device = "cuda" if not args.no_cuda and torch.cuda.is_available() else "cpu"
+    zSize, ySize, xSize = 120, 720, 480
+    rng = np.random.RandomState(1)
+    gt = rng.rand(zSize, ySize, xSize).astype(np.float32)
+    pred = gt + 0.05 * rng.randn(zSize, ySize, xSize).astype(np.float32)
+
+    tic = time.time()
+    ssim = ssim3d(gt, pred, data_range=float(gt.max() - gt.min()), slab_size=args.slab_size, device=device)
+    elapsed = time.time() - tic
+    print("SSIM {:.6f} on {}x{}x{} in {:.2f}s ({:.1f} Mvoxel/s, {})".format(
+        ssim, zSize, ySize, xSize, elapsed, zSize * ySize * xSize / elapsed / 1e6, device
+    ))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,66 @@
+# batched data augmentation on the training device
+
+import torch
+
+# the spatial axes of a volume (..., z, y, x)
+AXES = {"z": 0, "y": 1, "x": 2}
+OPS = ["flip-x", "flip-y", "flip-z", "rot-xy", "rot-xz", "rot-yz", "time"]
+
+def transform(v, perm, flips):
+    # v.permute(perm).flip(flips) on the last three dims
+    lead = v.dim() - 3
+    if perm != (0, 1, 2):
+        v = v.permute(list(range(lead)) + [lead + a for a in perm])
+    if flips:
+        v = v.flip([lead + a for a in flips])
+    return v
+
+class Augmentation(object):
+    # every op is drawn independently for every sample of the batch: flips along an axis and time reversal with
+    # probability p, rotations by a multiple of 90 degrees in a plane uniformly; rotations need cubic blocks.
+    # the ops drawn for a sample compose into one permutation of the axes, one set of flips and maybe a time
+    # reversal, so the volumes of the samples sharing them are copied once
+    def __init__(self, ops, p=0.5):
+        self.ops = ops.split(",") if ops else []
+        for op in self.ops:
+            if op not in OPS:
+                raise ValueError("unknown augmentation {}, expected one of {}".format(op, ", ".join(OPS)))
+        self.p = p
+
+    def draw(self):
+        # (perm, flips, reverse): the sample becomes v.permute(perm).flip(flips), played backwards with reverse
+        perm, flips, reverse = [0, 1, 2], set(), False
+        for op in self.ops:
+            if op == "time":
+                reverse = torch.rand(1).item() < self.p
+            elif op.startswith("flip-"):
+                if torch.rand(1).item() < self.p:
+                    flips ^= {AXES[op[-1]]}
+            else:
+                a, b = sorted((AXES[op[-2]], AXES[op[-1]]))
+                for _ in range(torch.randint(4, (1,)).item()):
+                    # a quarter turn is a flip of b, then a transpose of a and b
+                    flips ^= {b}
+                    perm[a], perm[b] = perm[b], perm[a]
+                    flips = {b if n == a else a if n == b else n for n in flips}
+        return tuple(perm), tuple(sorted(flips)), reverse
+
+    def apply(self, v_f, v_b, v_i, perm, flips, reverse):
+        if reverse:
+            # the sequence played backwards: the key volumes swap and the intermediates reverse
+            v_f, v_b, v_i = v_b, v_f, v_i.flip(1)
+        return transform(v_f, perm, flips), transform(v_b, perm, flips), transform(v_i, perm, flips)
+
+    def __call__(self, v_f, v_b, v_i):
+        groups = {}
+        for n in range(v_f.shape[0]):
+            groups.setdefault(self.draw(), []).append(n)
+        if len(groups) == 1:
+            return self.apply(v_f, v_b, v_i, *next(iter(groups)))
+        outputs = [torch.empty_like(v) for v in (v_f, v_b, v_i)]
+        for key, samples in groups.items():
+            index = torch.tensor(samples, device=v_f.device)
+            group = self.apply(v_f.index_select(0, index), v_b.index_select(0, index), v_i.index_select(0, index), *key)
+            for out, v in zip(outputs, group):
+                out.index_copy_(0, index, v)
+        return tuple(outputs)
@@ -0,0 +1,105 @@
+# micro-batch size from a memory budget
+
+import os
+import json
+import resource
+import queue
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.multiprocessing as mp
+
+from generator import Generator
+from discriminator import Discriminator
+
+def out_of_memory(e):
+    # the allocators of CUDA and of the CPU both report a failed allocation as a RuntimeError
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e) or "can't allocate memory" in str(e)
+
+def probe_worker(args, micro_batch_size, device, results):
+    # peak memory of two training iterations on random blocks; the second one includes the optimizer states
+    try:
+        g_model = Generator(args.upsample_mode, args.forward, args.backward, args.gen_sn, args.residual).to(device)
+        g_optimizer = optim.Adam(g_model.parameters(), lr=args.lr, betas=(args.beta1, args.beta2))
+        if args.gan_loss != "none":
+            d_model = Discriminator(args.dis_sn).to(device)
+            d_optimizer = optim.Adam(d_model.parameters(), lr=args.d_lr, betas=(args.beta1, args.beta2))
+        b = args.block_size
+        v_f = torch.randn(micro_batch_size, 1, b, b, b, device=device)
+        v_b = torch.randn(micro_batch_size, 1, b, b, b, device=device)
+        v_i = torch.randn(micro_batch_size, args.training_step, 1, b, b, b, device=device)
+        for _ in range(2):
+            fake_volumes = g_model(v_f, v_b, args.training_step, args.wo_ori_volume, args.norm)
+            loss = F.mse_loss(v_i, fake_volumes)
+            if args.gan_loss != "none":
+                d_optimizer.zero_grad()
+                d_model(torch.cat([v_i, fake_volumes.detach()], 0)).mean().backward()
+                d_optimizer.step()
+                loss = loss + d_model(fake_volumes).mean()
+                if args.feature_loss:
+                    for feat_real, feat_fake in zip(d_model.extract_features(v_i), d_model.extract_features(fake_volumes)):
+                        loss = loss + F.mse_loss(feat_real, feat_fake)
+            g_optimizer.zero_grad()
+            loss.backward()
+            g_optimizer.step()
+        if device.type == "cuda":
+            results.put(torch.cuda.max_memory_allocated(device))
+        else:
+            # ru_maxrss is in kilobytes on Linux
+            results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    except RuntimeError as e:
+        if not out_of_memory(e):
+            raise
+        results.put(None)
+
+def probe(args, micro_batch_size, device):
+    # every probe runs in a fresh process, so the peak memory only covers its own configuration
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=probe_worker, args=(args, micro_batch_size, device, results))
+    process.start()
+    process.join()
+    try:
+        return results.get(timeout=1)
+    except queue.Empty:
+        if process.exitcode > 0:
+            raise RuntimeError("the memory probe of a micro-batch of {} failed".format(micro_batch_size))
+        # killed, e.g. by the OOM killer
+        return None
+
+def tune_micro_batch_size(args, device):
+    # doubling up to the batch size, the largest micro-batch whose peak memory fits the budget
+    budget = args.memory_budget * 2 ** 20
+    measurements = {}
+    best = 0
+    micro_batch_size = 1
+    while micro_batch_size <= args.batch_size:
+        peak = probe(args, micro_batch_size, device)
+        measurements[micro_batch_size] = peak
+        print("=> micro-batch {}: peak memory {}".format(
+            micro_batch_size, "{:.1f} MB".format(peak / 2 ** 20) if peak is not None else "out of memory"))
+        if peak is None or peak > budget:
+            break
+        best = micro_batch_size
+        if micro_batch_size == args.batch_size:
+            break
+        micro_batch_size = min(micro_batch_size * 2, args.batch_size)
+    if best == 0:
+        raise ValueError("a micro-batch of 1 does not fit in {} MB".format(args.memory_budget))
+    return best, measurements
+
+def log_config(args, micro_batch_size, measurements):
+    accum_steps = -(-args.batch_size // micro_batch_size)
+    print("=> batch size {} as {} micro-batches of {} (block size {}, {} steps, {}, memory budget {} MB)".format(
+        args.batch_size, accum_steps, micro_batch_size, args.block_size, args.training_step,
+        "forward+backward" if args.forward and args.backward else ("forward" if args.forward else "backward"),
+        args.memory_budget
+    ))
+    os.makedirs(args.save_dir, exist_ok=True)
+    with open(os.path.join(args.save_dir, "autobatch.json"), "w") as f:
+        json.dump({"batch_size": args.batch_size, "micro_batch_size": micro_batch_size, "accum_steps": accum_steps,
+                   "block_size": args.block_size, "training_step": args.training_step,
+                   "forward": args.forward, "backward": args.backward, "memory_budget_mb": args.memory_budget,
+                   "peak_memory": {str(k): v for k, v in measurements.items()}}, f, indent=2)
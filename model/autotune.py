@@ -0,0 +1,236 @@
+# DataLoader workers, intra-op threads and batch size tuned for the current machine
+
+import os
+import sys
+import argparse
+import itertools
+import json
+import platform
+import queue
+import time
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, RandomSampler
+from torchvision import transforms
+
+from generator import Generator
+sys.path.append("../datasets")
+import utils
+
+def parse_args():
+    cores = len(os.sched_getaffinity(0))
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disable CUDA")
+    parser.add_argument("--root", required=True, type=str,
+                        help="root of the dataset")
+    parser.add_argument("--volume-train-list", type=str, default="volume_train_list.txt")
+    parser.add_argument("--volume-test-list", type=str, default="",
+                        help="list of test_cropped for the inference benchmark (default: training only)")
+    parser.add_argument("--block-size", type=int, default=64,
+                        help="the size of the sub-block")
+    parser.add_argument("--training-step", type=int, default=9,
+                        help="in the training phase, the number of intermediate volumes")
+    parser.add_argument("--infering-step", type=int, default=3,
+                        help="in the infering phase, the number of intermediate volumes")
+
+    parser.add_argument("--gen-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the generator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
+    parser.add_argument("--upsample-mode", type=str, default="lr",
+                        help="how to do upsample, voxel shuffle (lr) or interpolate (hr)")
+    parser.add_argument("--norm", type=str, default="",
+                        help="how normalize hidden layer, none or batch norm or instance norm")
+    parser.add_argument("--forward", action="store_true", default=False,
+                        help="during training, do forward prediction")
+    parser.add_argument("--backward", action="store_true", default=False,
+                        help="during training, do backward prediction")
+
+    parser.add_argument("--workers", type=int, nargs="+", default=[w for w in (0, 2, 4, 8) if w < cores],
+                        help="numbers of DataLoader workers to try")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=sorted({max(cores // d, 1) for d in (8, 4, 2, 1)}),
+                        help="numbers of intra-op threads to try")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4],
+                        help="batch sizes to try")
+    parser.add_argument("--pin-workers", action="store_true", default=False,
+                        help="pin the main process to its threads' cores and every worker to its own core set")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="number of batches run before timing")
+    parser.add_argument("--batches", type=int, default=4,
+                        help="number of timed batches per trial")
+    parser.add_argument("--output", type=str, default="tune_profile.json",
+                        help="profile file read by main.py and eval.py with --tune-profile")
+    args = parser.parse_args()
+    if args.batches < 1:
+        parser.error("--batches must be at least 1")
+    return args
+
+def rank_threads(settings, world_size=1):
+    # the tuned threads of one process, capped so that the processes of distributed training get disjoint cores
+    return max(min(settings["threads"], len(os.sched_getaffinity(0)) // world_size), 1)
+
+def core_layout(threads, num_workers, rank=0, world_size=1):
+    # the first world_size * threads cores run the intra-op threads of the main processes, rank after rank; the
+    # others are split between the workers of all the processes; without spare cores the workers share all of them
+    cores = sorted(os.sched_getaffinity(0))
+    main_cores = [cores[(rank * threads + n) % len(cores)] for n in range(threads)]
+    spare = cores[world_size * threads:] or cores
+    share = max(len(spare) // max(world_size * num_workers, 1), 1)
+    first = rank * num_workers
+    worker_cores = [[spare[((first + w) * share + n) % len(spare)] for n in range(share)] for w in range(num_workers)]
+    return main_cores, worker_cores
+
+class PinWorker(object):
+    # worker_init_fn pinning every DataLoader worker to its core set; a class so that it pickles
+    def __init__(self, worker_cores):
+        self.worker_cores = worker_cores
+
+    def __call__(self, worker_id):
+        os.sched_setaffinity(0, self.worker_cores[worker_id])
+        torch.set_num_threads(1)
+
+def load_profile(path, mode, batch_size):
+    # the settings tuned for the batch size closest to the given one ("train" or "infer")
+    with open(path) as f:
+        profile = json.load(f)
+    if mode not in profile:
+        raise ValueError("{} has no {} settings".format(path, mode))
+    tuned = {int(b): settings for b, settings in profile[mode]["by_batch_size"].items()}
+    settings = tuned[min(tuned, key=lambda b: (abs(b - batch_size), b))]
+    print("=> {} settings of {} (batch size {}): {} workers, {} threads{}; fastest batch size {}".format(
+        mode, path, settings["batch_size"], settings["num_workers"], settings["threads"],
+        ", pinned" if settings["pin_workers"] else "", profile[mode]["best"]["batch_size"]
+    ))
+    return settings
+
+def apply_profile(settings, rank=0, world_size=1):
+    # threads (and affinity) of the calling process, the rank-th of world_size processes sharing the machine
+    threads = rank_threads(settings, world_size)
+    torch.set_num_threads(threads)
+    try:
+        # nothing in the model runs inter-op parallel work
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # already set, or inter-op work already started
+        pass
+    if settings["pin_workers"]:
+        main_cores, _ = core_layout(threads, settings["num_workers"], rank, world_size)
+        os.sched_setaffinity(0, main_cores)
+
+def loader_kwargs(settings, cuda, rank=0, world_size=1):
+    # DataLoader arguments of the tuned settings; without any, the historical defaults
+    if settings is None:
+        return {"num_workers": 4, "pin_memory": True} if cuda else {}
+    kwargs = {"num_workers": settings["num_workers"], "pin_memory": cuda}
+    if settings["pin_workers"] and settings["num_workers"] > 0:
+        kwargs["worker_init_fn"] = PinWorker(core_layout(rank_threads(settings, world_size), settings["num_workers"],
+                                                         rank, world_size)[1])
+    return kwargs
+
+def trial_worker(args, mode, settings, device, results):
+    from trainDataset import TVDataset
+    from inferDataset import InferTVDataset
+
+    apply_profile(settings)
+    transform = transforms.Compose([utils.Normalize(), utils.ToTensor()])
+    if mode == "train":
+        dataset = TVDataset(root=args.root, sub_size=args.block_size, max_k=args.training_step,
+                            volume_list=args.volume_train_list, train=True, transform=transform)
+        steps = args.training_step
+    else:
+        dataset = InferTVDataset(root=args.root, sub_size=args.block_size, max_k=args.infering_step,
+                                 volume_list=args.volume_test_list, transform=transform)
+        steps = args.infering_step
+    batch_size = settings["batch_size"]
+    # drawn with replacement, so small datasets still give every timed batch
+    sampler = RandomSampler(dataset, replacement=True, num_samples=batch_size * (args.warmup + args.batches))
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, drop_last=True,
+                        **loader_kwargs(settings, device.type == "cuda"))
+
+    g_model = Generator(args.upsample_mode, args.forward, args.backward, args.gen_sn, args.residual).to(device)
+    g_optimizer = optim.Adam(g_model.parameters())
+    for i, sample in enumerate(loader):
+        if i == args.warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            tic = time.time()
+        v_f = sample["v_f"].to(device, non_blocking=True)
+        v_b = sample["v_b"].to(device, non_blocking=True)
+        if mode == "train":
+            v_i = sample["v_i"].to(device, non_blocking=True)
+            loss = F.mse_loss(v_i, g_model(v_f, v_b, steps, False, args.norm))
+            g_optimizer.zero_grad()
+            loss.backward()
+            g_optimizer.step()
+        else:
+            with torch.no_grad():
+                g_model(v_f, v_b, steps, False, args.norm).cpu()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    results.put(batch_size * args.batches / (time.time() - tic))
+
+def trial(args, mode, settings, device):
+    # every trial runs in a fresh process: the thread pools are only sized once per process
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=trial_worker, args=(args, mode, settings, device, results))
+    process.start()
+    process.join()
+    try:
+        return results.get(timeout=1)
+    except queue.Empty:
+        return None
+
+def tune(args, mode, device):
+    trials = []
+    for batch_size, num_workers, threads in itertools.product(args.batch_sizes, args.workers, args.threads):
+        settings = {"batch_size": batch_size, "num_workers": num_workers, "threads": threads,
+                    "pin_workers": args.pin_workers}
+        settings["samples_per_sec"] = trial(args, mode, settings, device)
+        print("=> {} batch size {}, {} workers, {} threads: {}".format(
+            mode, batch_size, num_workers, threads,
+            "{:.3f} samples/s".format(settings["samples_per_sec"]) if settings["samples_per_sec"] else "failed"
+        ))
+        trials.append(settings)
+    done = [s for s in trials if s["samples_per_sec"]]
+    if not done:
+        raise RuntimeError("every {} trial failed: see the errors above, or the trial processes were killed, "
+                           "e.g. for lack of memory".format(mode))
+    by_batch_size = {}
+    for s in done:
+        if s["batch_size"] not in by_batch_size or s["samples_per_sec"] > by_batch_size[s["batch_size"]]["samples_per_sec"]:
+            by_batch_size[s["batch_size"]] = s
+    return {"best": max(done, key=lambda s: s["samples_per_sec"]),
+            "by_batch_size": {str(b): s for b, s in sorted(by_batch_size.items())},
+            "trials": trials}
+
+def main(args):
+    device = torch.device("cuda: 0" if not args.no_cuda and torch.cuda.is_available() else "cpu")
+    profile = {"machine": {"hostname": platform.node(), "cores": len(os.sched_getaffinity(0)),
+                           "device": str(device), "torch": torch.__version__},
+               "config": {"block_size": args.block_size, "training_step": args.training_step,
+                          "infering_step": args.infering_step, "upsample_mode": args.upsample_mode,
+                          "forward": args.forward, "backward": args.backward, "residual": args.residual}}
+    modes = ["train"] + (["infer"] if args.volume_test_list else [])
+    for mode in modes:
+        profile[mode] = tune(args, mode, device)
+
+    print("====> Tuned settings ({} cores, {})".format(profile["machine"]["cores"], device))
+    print("{:>6}{:>8}{:>10}{:>10}{:>14}".format("mode", "batch", "workers", "threads", "samples/s"))
+    for mode in modes:
+        for s in profile[mode]["by_batch_size"].values():
+            print("{:>6}{:>8}{:>10}{:>10}{:>14.3f}{}".format(
+                mode, s["batch_size"], s["num_workers"], s["threads"], s["samples_per_sec"],
+                "  *" if s == profile[mode]["best"] else ""
+            ))
+    with open(args.output, "w") as f:
+        json.dump(profile, f, indent=2)
+    print("=> profile written to {}".format(args.output))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -177,9 +177,9 @@ class ConvLSTMCell(nn.Module):
         h = o * torch.tanh(c)
         return h, c
 
-    def init_hidden(self, batch_size, hidden_channels, shape):
-        return (Variable(torch.zeros(batch_size, hidden_channels, shape[0], shape[1], shape[2])).cuda(),
-                Variable(torch.zeros(batch_size, hidden_channels, shape[0], shape[1], shape[2])).cuda())
+    def init_hidden(self, batch_size, hidden_channels, shape, device="cuda"):
+        return (Variable(torch.zeros(batch_size, hidden_channels, shape[0], shape[1], shape[2], device=device)),
+                Variable(torch.zeros(batch_size, hidden_channels, shape[0], shape[1], shape[2], device=device)))
 
 
 
@@ -0,0 +1,171 @@
+# asynchronous checkpoints and resumable sampling
+
+import os
+import json
+import math
+import queue
+import random
+import threading
+
+import numpy as np
+
+import torch
+from torch.utils.data import Sampler
+
+def to_cpu(obj):
+    # a copy of every tensor, so training can keep updating the originals while the copy is written
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def rng_state(cuda=False):
+    # the numpy key is stored as a list, so the checkpoint only holds tensors and python values
+    numpy_state = np.random.get_state()
+    state = {"torch": torch.get_rng_state(), "random": random.getstate(),
+             "numpy": (numpy_state[0], numpy_state[1].tolist()) + tuple(numpy_state[2:])}
+    if cuda:
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"].cpu())
+    numpy_state = state["numpy"]
+    np.random.set_state((numpy_state[0], np.array(numpy_state[1], dtype=np.uint32)) + tuple(numpy_state[2:]))
+    random.setstate(state["random"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+def find_checkpoint(save_dir, which):
+    # "latest" or "best" checkpoint recorded in the index of a save dir
+    index_path = os.path.join(save_dir, "checkpoints.json")
+    if not os.path.isfile(index_path):
+        return ""
+    with open(index_path) as f:
+        index = json.load(f)
+    return os.path.join(save_dir, index[which]) if index.get(which) else ""
+
+class ResumableSampler(Sampler):
+    # seeded shuffling that only depends on the epoch, sharded like DistributedSampler, and able to start in the
+    # middle of an epoch; its length is the full epoch's, so the progress logs stay in epoch units
+    def __init__(self, dataset, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(len(dataset) / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        # start: number of samples of this replica already seen in the epoch
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        # pad so that every replica gets the same number of samples
+        indices += indices[:self.total_size - len(indices)]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples
+
+class AsyncCheckpointer(object):
+    # checkpoints are snapshotted to CPU memory by the training loop and written by a background thread to a
+    # temporary file renamed into place, so a crash never leaves a truncated checkpoint; the last keep_last
+    # checkpoints and the one with the best test loss are kept, and checkpoints.json records both
+    def __init__(self, save_dir, keep_last=0):
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        os.makedirs(save_dir, exist_ok=True)
+        self.index = {"saved": [], "latest": "", "best": "", "best_files": [], "best_loss": None}
+        index_path = os.path.join(save_dir, "checkpoints.json")
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                self.index.update(json.load(f))
+        # one checkpoint in flight: a new snapshot waits until the previous one is written
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, files, test_loss=None, keep=False):
+        # files: {file name: object}, the first file is the checkpoint recorded in the index; kept files are listed
+        # apart and never rotated
+        if self.error is not None:
+            raise self.error
+        self.queue.put(([(name, to_cpu(obj)) for name, obj in files.items()], test_loss, keep))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            try:
+                self.write(*job)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def write(self, files, test_loss, keep=False):
+        for name, obj in files:
+            path = os.path.join(self.save_dir, name)
+            torch.save(obj, path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+        group = [name for name, _ in files]
+        if keep:
+            self.index.setdefault("kept", []).append(group)
+            self.write_index()
+            return
+        self.index["saved"].append(group)
+        self.index["latest"] = group[0]
+        old_best = self.index["best_files"]
+        if test_loss is not None and (self.index["best_loss"] is None or test_loss < self.index["best_loss"]):
+            self.index["best"] = group[0]
+            self.index["best_files"] = group
+            self.index["best_loss"] = test_loss
+
+        # rotation: the last keep_last checkpoints, and the best one
+        removed = []
+        if self.keep_last > 0:
+            removed = self.index["saved"][:-self.keep_last]
+            self.index["saved"] = self.index["saved"][-self.keep_last:]
+        if old_best and old_best != self.index["best_files"] and old_best not in self.index["saved"]:
+            removed.append(old_best)
+        for old in removed:
+            if old == self.index["best_files"]:
+                continue
+            for name in old:
+                if os.path.isfile(os.path.join(self.save_dir, name)):
+                    os.remove(os.path.join(self.save_dir, name))
+        self.write_index()
+
+    def write_index(self):
+        index_path = os.path.join(self.save_dir, "checkpoints.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(index_path + ".tmp", index_path)
+
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,50 @@
+# time per iteration and test loss of adversarial passes scoring subsets of the intermediate volumes
+
+import os
+import argparse
+
+from telemetry import run_main
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model",
+                                     epilog="the remaining arguments are passed to main.py (a gan loss is needed)")
+    parser.add_argument("--subsets", type=int, nargs="+", default=[0, 3, 1],
+                        help="numbers of scored intermediate volumes to compare, 0 scores all of them")
+    parser.add_argument("--baseline", type=int, default=None,
+                        help="subset the speedups are relative to (default: the first of --subsets)")
+    parser.add_argument("--log-dir", type=str, default="d_subset",
+                        help="dir of the telemetry and the models of every run")
+    parser.add_argument("--skip", type=int, default=1,
+                        help="number of logged sub-epochs discarded as warm-up")
+    return parser.parse_known_args()
+
+def main(args, main_args):
+    baseline = args.subsets[0] if args.baseline is None else args.baseline
+    subsets = args.subsets if baseline in args.subsets else [baseline] + args.subsets
+    os.makedirs(args.log_dir, exist_ok=True)
+    results = []
+    for k in subsets:
+        run_dir = os.path.join(args.log_dir, "subset_{}".format(k))
+        # main.py requires --save-dir; every run gets its own
+        summary = run_main(main_args + ["--d-subset-steps", str(k), "--save-dir", run_dir],
+                           os.path.join(run_dir, "metrics.jsonl"), args.skip)
+        # seconds per iteration over the logged sub-epochs after the warm-up, and the last test loss
+        results.append((k, summary["elapsed"] / summary["batches"], summary["d_update"] / summary["batches"],
+                        summary["test_loss"]))
+
+    base = dict((k, per_iter) for k, per_iter, _, _ in results)[baseline]
+    print("=> speedups relative to scoring {}".format(
+        "all intermediate volumes" if baseline == 0 else "{} intermediate volumes".format(baseline)))
+    print("====> Adversarial passes scoring subsets of the intermediate volumes")
+    print("{:>8}{:>14}{:>14}{:>10}{:>14}".format("scored", "s/iter", "d_update s", "speedup", "test loss"))
+    for k, per_iter, d_update, test_loss in results:
+        print("{:>8}{:>14.3f}{:>14.3f}{:>10.2f}{:>14.6f}".format(
+            k if k > 0 else "all", per_iter, d_update, base / per_iter, test_loss
+        ))
+    with open(os.path.join(args.log_dir, "d_subset.csv"), "w") as f:
+        f.write("d_subset_steps,sec_per_iter,d_update_sec_per_iter,speedup,test_loss\n")
+        for k, per_iter, d_update, test_loss in results:
+            f.write("{},{},{},{},{}\n".format(k, per_iter, d_update, base / per_iter, test_loss))
+
+if __name__ == "__main__":
+    main(*parse_args())
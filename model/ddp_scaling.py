@@ -0,0 +1,45 @@
+# scaling of distributed training from 1 to N processes
+
+import os
+import argparse
+
+from telemetry import run_main
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model",
+                                     epilog="the remaining arguments are passed to main.py")
+    parser.add_argument("--procs", type=int, nargs="+", default=[1, 2, 4],
+                        help="numbers of processes to run")
+    parser.add_argument("--port", type=int, default=23456,
+                        help="first port of the rendezvous urls")
+    parser.add_argument("--log-dir", type=str, default="scaling",
+                        help="dir of the telemetry of every run")
+    parser.add_argument("--skip", type=int, default=1,
+                        help="number of logged sub-epochs discarded as warm-up")
+    return parser.parse_known_args()
+
+def main(args, main_args):
+    os.makedirs(args.log_dir, exist_ok=True)
+    results = []
+    for n in args.procs:
+        summary = run_main(main_args + [
+            "--distributed", "--world-size", str(n), "--dist-url", "tcp://127.0.0.1:{}".format(args.port + n)],
+            os.path.join(args.log_dir, "scaling_{}.jsonl".format(n)), args.skip)
+        # every process trains batch_size samples per step, so the total throughput is n times that of rank 0
+        results.append((n, summary["samples_per_sec"] * n, summary["peak_memory"]))
+
+    base = results[0][1] / results[0][0]
+    print("====> Scaling (batch size per process fixed)")
+    print("{:>8}{:>14}{:>10}{:>12}{:>16}".format("procs", "samples/s", "speedup", "efficiency", "peak mem (MB)"))
+    for n, samples_per_sec, peak_memory in results:
+        print("{:>8}{:>14.3f}{:>10.2f}{:>11.1f}%{:>16.1f}".format(
+            n, samples_per_sec, samples_per_sec / base, 100. * samples_per_sec / (base * n), peak_memory / 2 ** 20
+        ))
+    with open(os.path.join(args.log_dir, "scaling.csv"), "w") as f:
+        f.write("procs,samples_per_sec,speedup,efficiency,peak_memory\n")
+        for n, samples_per_sec, peak_memory in results:
+            f.write("{},{},{},{},{}\n".format(n, samples_per_sec, samples_per_sec / base,
+                                              samples_per_sec / (base * n), peak_memory))
+
+if __name__ == "__main__":
+    main(*parse_args())
@@ -61,110 +61,74 @@ class Generator(nn.Module):
 
         self.tanh = nn.Tanh()
 
+    def encode(self, x, norm):
+        # feature learning component
+        x = self.for_down1(x, norm)
+        if self.residual:
+            x = self.for_res1(x, norm)
+        x = self.for_down2(x, norm)
+        if self.residual:
+            x = self.for_res2(x, norm)
+        x = self.for_down3(x, norm)
+        if self.residual:
+            x = self.for_res3(x, norm)
+        x = self.for_down4(x, norm)
+        if self.residual:
+            x = self.for_res4(x, norm)
+        return x
+
+    def decode(self, x, norm):
+        # upscaling component
+        x = self.back_up1(x, norm)
+        if self.residual:
+            x = self.back_res1(x, norm)
+        x = self.back_up2(x, norm)
+        if self.residual:
+            x = self.back_res2(x, norm)
+        x = self.back_up3(x, norm)
+        if self.residual:
+            x = self.back_res3(x, norm)
+        x = self.back_up4(x, norm)
+        if self.residual:
+            x = self.back_res4(x, norm)
+        x = self.tanh(x)
+        return x
+
+    def predict(self, x, direction, num_steps, norm):
+        # run the recurrence of one direction (0: forward, 1: backward) for num_steps steps
+        internal_state = []
+        outputs = []
+        for step in range(num_steps):
+            x = self.encode(x, norm)
+
+            # temporal component
+            for i in range(self.num_layers):
+                # all cells are initialized in the first step
+                name = 'cell{}{}'.format(i, direction)
+                if step == 0:
+                    bsize, _, height, length, width = x.size()
+                    (h, c) = getattr(self, name).init_hidden(batch_size=bsize, hidden_channels=64,
+                                                             shape=(height, length, width), device=x.device)
+                    internal_state.append((h, c))
+                (h, c) = internal_state[i]
+                x, new_c = getattr(self, name)(x, h, c)
+                internal_state[i] = (x, new_c)
+
+            # the decoded volume is the input of the next step, so every step needs a decoder pass
+            x = self.decode(x, norm)
+
+            # save result
+            outputs.append(x)
+        return outputs
+
     def forward(self, x_f, x_b, total_step, wo_ori_volume, norm):
         # forward prediction
         if self.fwd:
-            internal_state = []
-            outputs_f = []
-            x = x_f
-            for step in range(total_step):
-                # feature learning component
-                x = self.for_down1(x, norm)
-                if self.residual:
-                    x = self.for_res1(x, norm)
-                x = self.for_down2(x, norm)
-                if self.residual:
-                    x = self.for_res2(x, norm)
-                x = self.for_down3(x, norm)
-                if self.residual:
-                    x = self.for_res3(x, norm)
-                x = self.for_down4(x, norm)
-                if self.residual:
-                    x = self.for_res4(x, norm)
-
-                # temporal component
-                for i in range(self.num_layers):
-                    # all cells are initialized in the first step
-                    name = 'cell{}{}'.format(i, 0)
-                    if step == 0:
-                        bsize, _, height, length, width = x.size()
-                        (h, c) = getattr(self, name).init_hidden(batch_size=bsize, hidden_channels=64,
-                                                                 shape=(height, length, width))
-                        internal_state.append((h, c))
-                    # do forward
-                    (h, c) = internal_state[i]
-                    x, new_c = getattr(self, name)(x, h, c)
-                    internal_state[i] = (x, new_c)
-
-                # upscaling component
-                x = self.back_up1(x, norm)
-                if self.residual:
-                    x = self.back_res1(x, norm)
-                x = self.back_up2(x, norm)
-                if self.residual:
-                    x = self.back_res2(x, norm)
-                x = self.back_up3(x, norm)
-                if self.residual:
-                    x = self.back_res3(x, norm)
-                x = self.back_up4(x, norm)
-                if self.residual:
-                    x = self.back_res4(x, norm)
-                x = self.tanh(x)
-
-                # save result
-                outputs_f.append(x)
+            outputs_f = self.predict(x_f, 0, total_step, norm)
 
         # backward prediction
         if self.bwd:
-            internal_state = []
-            outputs_b = []
-            x = x_b
-            for step in range(total_step):
-                # feature learning component
-                x = self.for_down1(x, norm)
-                if self.residual:
-                    x = self.for_res1(x, norm)
-                x = self.for_down2(x, norm)
-                if self.residual:
-                    x = self.for_res2(x, norm)
-                x = self.for_down3(x, norm)
-                if self.residual:
-                    x = self.for_res3(x, norm)
-                x = self.for_down4(x, norm)
-                if self.residual:
-                    x = self.for_res4(x, norm)
-
-                # temporal component
-                for i in range(self.num_layers):
-                    # all cells are initialized in the first step
-                    name = 'cell{}{}'.format(i, 1)
-                    if step == 0:
-                        bsize, _, height, length, width = x.size()
-                        (h, c) = getattr(self, name).init_hidden(batch_size=bsize, hidden_channels=64,
-                                                                 shape=(height, length, width))
-                        internal_state.append((h, c))
-                    # do backward
-                    (h, c) = internal_state[i]
-                    x, new_c = getattr(self, name)(x, h, c)
-                    internal_state[i] = (x, new_c)
-
-                # upscaling component
-                x = self.back_up1(x, norm)
-                if self.residual:
-                    x = self.back_res1(x, norm)
-                x = self.back_up2(x, norm)
-                if self.residual:
-                    x = self.back_res2(x, norm)
-                x = self.back_up3(x, norm)
-                if self.residual:
-                    x = self.back_res3(x, norm)
-                x = self.back_up4(x, norm)
-                if self.residual:
-                    x = self.back_res4(x, norm)
-                x = self.tanh(x)
-
-                # save result
-                outputs_b.append(x)
+            outputs_b = self.predict(x_b, 1, total_step, norm)
 
         # blend module
         outputs = []
@@ -191,3 +155,37 @@ class Generator(nn.Module):
         outputs = torch.cat(outputs, 1)
 
         return outputs
+
+    def interpolate(self, x_f, x_b, t_start, t_end, t, wo_ori_volume, norm, region=None):
+        # query a single intermediate timestep t (t_start < t < t_end) between the key frames x_f and x_b,
+        # only running the forward recurrence for t - t_start steps and the backward one for t_end - t steps
+        total_step = t_end - t_start - 1
+        step = t - t_start - 1
+        if step < 0 or step >= total_step:
+            raise ValueError("timestep {} is not strictly between {} and {}".format(t, t_start, t_end))
+
+        # region: (z_start, z_end, y_start, y_end, x_start, x_end) inside the block
+        if region is not None:
+            z0, z1, y0, y1, x0, x1 = region
+            crop = lambda v: v[:, :, z0:z1, y0:y1, x0:x1]
+        else:
+            crop = lambda v: v
+
+        if self.fwd:
+            output_f = crop(self.predict(x_f, 0, step + 1, norm)[-1])
+        if self.bwd:
+            output_b = crop(self.predict(x_b, 1, total_step - step, norm)[-1])
+
+        # blend module
+        w = (step + 1) / (total_step + 1)
+        lerp = (1 - w) * crop(x_f) + w * crop(x_b)
+        if self.fwd and self.bwd:
+            output = 0.5 * (output_f + output_b)
+        elif self.fwd:
+            output = output_f
+        elif self.bwd:
+            output = output_b
+        if not wo_ori_volume:
+            output = lerp + output
+
+        return output
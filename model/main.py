@@ -2,9 +2,11 @@
 
 import os
 import argparse
+import json
 import math
 import pdb
 import time
+from contextlib import nullcontext
 
 import numpy as np
 from tqdm import tqdm
@@ -14,14 +16,25 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.autograd import Variable
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision.utils import save_image
 from torchvision import transforms
 from torchsummary import summary
 
 from generator import Generator
 from discriminator import Discriminator
+from telemetry import Telemetry
+from profiler import ModuleProfiler
+from checkpoint import AsyncCheckpointer, ResumableSampler, rng_state, set_rng_state, find_checkpoint
+from validation import CachedSubset, AsyncValidator, validation_loss
+from autobatch import tune_micro_batch_size, log_config
+from augment import Augmentation
+from autotune import load_profile, apply_profile, loader_kwargs
 import sys
 sys.path.append("../datasets")
 from trainDataset import *
@@ -34,6 +47,14 @@ def parse_args():
                         help="disable CUDA training")
     parser.add_argument("--data-parallel", action="store_true", default=False,
                         help="enable data parallelism")
+    parser.add_argument("--distributed", action="store_true", default=False,
+                        help="enable distributed data parallel training, one process per device (or CPU share)")
+    parser.add_argument("--world-size", type=int, default=1,
+                        help="number of distributed processes")
+    parser.add_argument("--dist-backend", type=str, default="",
+                        help="distributed backend (default: nccl with CUDA, gloo otherwise)")
+    parser.add_argument("--dist-url", type=str, default="tcp://127.0.0.1:23456",
+                        help="url used to set up distributed training")
     parser.add_argument("--seed", type=int, default=1,
                         help="random seed (default: 1)")
 
@@ -42,7 +63,7 @@ def parse_args():
     parser.add_argument("--save-dir", required=True, type=str,
                         help="dir of the output models")
     parser.add_argument("--resume", type=str, default="",
-                        help="path to the latest checkpoint (default: none)")
+                        help="path to the checkpoint to resume from, or latest or best in the save dir (default: none)")
     parser.add_argument("--volume-train-list", type=str, default="volume_train_list.txt")
     parser.add_argument("--volume-test-list", type=str, default="volume_test_list.txt")
 
@@ -86,12 +107,21 @@ def parse_args():
                         help="beta2 of Adam (default: 0.999)")
     parser.add_argument("--batch-size", type=int, default=1,
                         help="batch size for training")
+    parser.add_argument("--micro-batch-size", type=int, default=0,
+                        help="accumulate the gradients of every batch over micro-batches of the given size (default: whole batch)")
+    parser.add_argument("--memory-budget", type=int, default=0,
+                        help="pick the largest micro-batch whose peak memory (MB; GPU memory, or process RSS on CPU) fits")
     parser.add_argument("--training-step", type=int, default=9,
                         help="in the training phase, the number of intermediate volumes")
     parser.add_argument("--n-d", type=int, default=2,
                         help="number of D updates per iteration")
     parser.add_argument("--n-g", type=int, default=1,
                         help="number of G upadates per iteration")
+    parser.add_argument("--d-subset-steps", type=int, default=0,
+                        help="number of randomly drawn intermediate volumes scored by every adversarial pass (default: all)")
+    parser.add_argument("--step-schedule", type=str, default="",
+                        help="train the steps of comma separated step:epochs stages in turn, each stage warm-started "
+                             "from the previous one, e.g. 3:40,5:30,9:30 (the lists hold windows of the largest step)")
     parser.add_argument("--start-epoch", type=int, default=0,
                         help="start epoch number (default: 0)")
     parser.add_argument("--epochs", type=int, default=100,
@@ -101,26 +131,110 @@ def parse_args():
                         help="log training status every given number of batches")
     parser.add_argument("--test-every", type=int, default=9,
                         help="test every given number of sub-epochs (default: 5")
+    parser.add_argument("--test-subset", type=int, default=0,
+                        help="test on a fixed random subset of the given size, kept in memory (default: whole test set)")
+    parser.add_argument("--async-test", action="store_true", default=False,
+                        help="test weight snapshots in a separate process while training continues")
+    parser.add_argument("--test-threads", type=int, default=1,
+                        help="number of threads of the asynchronous test process")
     parser.add_argument("--check-every", type=int, default=30,
                         help="save checkpoint every given number of sub-epochs (default: 20)")
+    parser.add_argument("--keep-last", type=int, default=5,
+                        help="number of recent checkpoints kept besides the best one, 0 keeps all (default: 5)")
 
     parser.add_argument("--block-size", type=int, default=64,
                         help="the size of the sub-block")
+    parser.add_argument("--cache-tiles", action="store_true", default=False,
+                        help="load every tile once and keep it in memory")
+    parser.add_argument("--pack-file", type=str, default="",
+                        help="read the tiles from <pack-file>_train.npy and <pack-file>_test.npy, memory-mapped files "
+                             "shared by concurrent runs (written on first use)")
+    parser.add_argument("--pack-only", action="store_true", default=False,
+                        help="only write the pack file")
+    parser.add_argument("--augment", type=str, default="",
+                        help="comma separated augmentations of the training batches, drawn per sample: "
+                             "flip-x, flip-y, flip-z, rot-xy, rot-xz, rot-yz, time (default: none)")
+    parser.add_argument("--augment-prob", type=float, default=0.5,
+                        help="probability of every flip and of the time reversal (default: 0.5)")
+
+    parser.add_argument("--tune-profile", type=str, default="",
+                        help="DataLoader workers, threads and core pinning from a profile written by autotune.py")
+    parser.add_argument("--metrics-file", type=str, default="",
+                        help="record per-phase timings of every logged sub-epoch to a jsonl (or .csv) file")
+    parser.add_argument("--profile", type=str, default="",
+                        help="profile the modules of the first batches and write <profile>_trace.json and <profile>_summary.txt")
+    parser.add_argument("--profile-batches", type=int, default=3,
+                        help="number of training batches to profile")
     return parser.parse_args()
 
-# the main function
-def main(args):
-    # log hyperparameter
-    print(args)
+# only the first process prints in distributed training
+def setup_for_distributed(is_master):
+    import builtins
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        if is_master:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+# "3:40,5:30" -> [(3, 40), (5, 30)]
+def parse_schedule(schedule):
+    stages = []
+    for stage in schedule.split(","):
+        step, epochs = stage.split(":")
+        stages.append((int(step), int(epochs)))
+    return stages
+
+# the stage training the given epoch
+def stage_of(stages, epoch):
+    end = 0
+    for n, (_, epochs) in enumerate(stages):
+        end += epochs
+        if epoch < end:
+            return n
+    return len(stages) - 1
 
+# the main function
+def main(args, rank=0):
     # select device
     args.cuda = not args.no_cuda and torch.cuda.is_available()
-    device = torch.device("cuda: 0" if args.cuda else "cpu")
+    device = torch.device("cuda: {}".format(rank if args.distributed else 0) if args.cuda else "cpu")
+    if args.distributed:
+        dist.init_process_group(backend=args.dist_backend or ("nccl" if args.cuda else "gloo"),
+                                init_method=args.dist_url, world_size=args.world_size, rank=rank)
+        setup_for_distributed(rank == 0)
+        if args.cuda:
+            torch.cuda.set_device(rank)
+        else:
+            # the processes share the cores of the machine
+            torch.set_num_threads(max(torch.get_num_threads() // args.world_size, 1))
+    tuning = None
+    world_size = args.world_size if args.distributed else 1
+    if args.tune_profile:
+        # replaces the even split of the threads: every process gets its own slice of the cores
+        tuning = load_profile(args.tune_profile, "train", args.batch_size)
+        apply_profile(tuning, rank, world_size)
+
+    # log hyperparameter
+    print(args)
 
     # set random seed
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
+    telemetry = Telemetry(args.metrics_file if rank == 0 else "", device)
+    augmentation = Augmentation(args.augment, args.augment_prob) if args.augment else None
+
+    # training stages: without a schedule, a single one of training_step
+    if args.step_schedule:
+        stages = parse_schedule(args.step_schedule)
+        args.epochs = sum(epochs for _, epochs in stages)
+    else:
+        stages = [(args.training_step, args.epochs)]
+    # the windows of the lists, re-sliced for the step of every stage
+    window = max(step for step, _ in stages)
+
     # data loader
     transform = transforms.Compose([
         utils.Normalize(),
@@ -130,24 +244,60 @@ def main(args):
         root=args.root,
         sub_size=args.block_size,
         volume_list=args.volume_train_list,
-        max_k=args.training_step,
+        max_k=window,
         train=True,
-        transform=transform
+        transform=transform,
+        cache=args.cache_tiles
     )
     test_dataset = TVDataset(
         root=args.root,
         sub_size=args.block_size,
         volume_list=args.volume_test_list,
-        max_k=args.training_step,
+        max_k=window,
         train=False,
-        transform=transform
+        transform=transform,
+        cache=args.cache_tiles
     )
-
-    kwargs = {"num_workers": 4, "pin_memory": True} if args.cuda else {}
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size,
-                              shuffle=True, **kwargs)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size,
-                             shuffle=False, **kwargs)
+    if args.pack_file:
+        tic = time.time()
+        train_dataset.pack(args.pack_file + "_train.npy")
+        test_dataset.pack(args.pack_file + "_test.npy")
+        print("=> tiles packed in {} in {:.2f}s".format(args.pack_file, time.time() - tic))
+        if args.pack_only:
+            return
+    elif args.cache_tiles:
+        tic = time.time()
+        train_dataset.preload()
+        test_dataset.preload()
+        print("=> {} tiles loaded in {:.2f}s".format(len(train_dataset.cache) + len(test_dataset.cache), time.time() - tic))
+
+    def set_stage(n):
+        # the loaders of a stage, over the windows re-sliced for its step
+        args.training_step = stages[n][0]
+        train_dataset.set_step(args.training_step)
+        test_dataset.set_step(args.training_step)
+        test_set = test_dataset
+        test_kwargs = loader_kwargs(tuning, args.cuda, rank, world_size)
+        if args.test_subset > 0:
+            # the cached samples live in this process, not in loader workers
+            test_set = CachedSubset(test_dataset, args.test_subset, args.seed)
+            test_kwargs = {}
+
+        kwargs = loader_kwargs(tuning, args.cuda, rank, world_size)
+        # the order of the samples only depends on the seed and the epoch, so training can resume mid-epoch;
+        # in distributed training every process trains on its own shard, with a batch size of batch_size
+        train_sampler = ResumableSampler(train_dataset, shuffle=True, seed=args.seed,
+                                         num_replicas=args.world_size if args.distributed else 1, rank=rank)
+        train_loader = DataLoader(train_dataset, batch_size=args.batch_size,
+                                  sampler=train_sampler, **kwargs)
+        if args.distributed:
+            test_sampler = DistributedSampler(test_set, num_replicas=args.world_size, rank=rank, shuffle=False)
+            test_loader = DataLoader(test_set, batch_size=args.batch_size,
+                                     sampler=test_sampler, **test_kwargs)
+        else:
+            test_loader = DataLoader(test_set, batch_size=args.batch_size,
+                                     shuffle=False, **test_kwargs)
+        return train_sampler, train_loader, test_loader
 
     # model
     def generator_weights_init(m):
@@ -167,6 +317,12 @@ def main(args):
     if args.data_parallel and torch.cuda.device_count() > 1:
         g_model = nn.DataParallel(g_model)
     g_model.to(device)
+    if args.distributed:
+        # the affine parameters of the instance norms are only used with --norm Instance
+        g_model = DistributedDataParallel(g_model, device_ids=[rank] if args.cuda else None,
+                                          find_unused_parameters=args.norm != "Instance")
+    # the bare model, for the checkpoints
+    g_net = g_model.module if args.distributed else g_model
 
     if args.gan_loss != "none":
         d_model = Discriminator(args.dis_sn)
@@ -176,6 +332,11 @@ def main(args):
         if args.data_parallel and torch.cuda.device_count() > 1:
             d_model = nn.DataParallel(d_model)
         d_model.to(device)
+        if args.distributed:
+            d_model = DistributedDataParallel(d_model, device_ids=[rank] if args.cuda else None)
+        # the generator update goes through the bare discriminator: its gradients are discarded, so they need no
+        # synchronization, and extract_features is not a forward of the wrapper
+        d_net = d_model.module if args.distributed else d_model
 
     mse_loss = nn.MSELoss()
     adversarial_loss = nn.MSELoss()
@@ -191,45 +352,155 @@ def main(args):
 
     Tensor = torch.cuda.FloatTensor if args.cuda else torch.FloatTensor
 
+    def draw_steps():
+        # the intermediate volumes scored by one adversarial pass, the same for all its micro-batches; the losses
+        # are means over the scored volumes, so a random subset estimates them without rescaling
+        if 0 < args.d_subset_steps < args.training_step:
+            return torch.randperm(args.training_step)[:args.d_subset_steps].sort()[0].to(device)
+        return None
+
+    def scored(volumes, steps):
+        return volumes if steps is None else volumes.index_select(1, steps)
+
     # load checkpoint
+    start_batch = 0
+    # seconds and epochs of the resumed stage spent before the checkpoint
+    stage_progress = None
+    if args.resume in ("latest", "best"):
+        args.resume = find_checkpoint(args.save_dir, args.resume)
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint {}".format(args.resume))
-            checkpoint = torch.load(args.resume)
+            checkpoint = torch.load(args.resume, map_location=device)
             args.start_epoch = checkpoint["epoch"]
-            g_model.load_state_dict(checkpoint["g_model_state_dict"])
-            # g_optimizer.load_state_dict(checkpoint["g_optimizer_state_dict"])
+            g_net.load_state_dict(checkpoint["g_model_state_dict"])
+            g_optimizer.load_state_dict(checkpoint["g_optimizer_state_dict"])
             if args.gan_loss != "none":
-                d_model.load_state_dict(checkpoint["d_model_state_dict"])
-                # d_optimizer.load_state_dict(checkpoint["d_optimizer_state_dict"])
+                d_net.load_state_dict(checkpoint["d_model_state_dict"])
+                d_optimizer.load_state_dict(checkpoint["d_optimizer_state_dict"])
                 d_losses = checkpoint["d_losses"]
                 g_losses = checkpoint["g_losses"]
             train_losses = checkpoint["train_losses"]
             test_losses = checkpoint["test_losses"]
-            print("=> load chekcpoint {} (epoch {})"
-                  .format(args.resume, checkpoint["epoch"]))
+            # checkpoints saved mid-epoch continue with the next batch of the same epoch
+            if "position" in checkpoint:
+                _, position_loader, _ = set_stage(stage_of(stages, checkpoint["position"]["epoch"]))
+                if checkpoint["position"]["batch"] < len(position_loader):
+                    args.start_epoch = checkpoint["position"]["epoch"]
+                    start_batch = checkpoint["position"]["batch"]
+            if "rng_state" in checkpoint:
+                set_rng_state(checkpoint["rng_state"])
+            if "stage_progress" in checkpoint:
+                stage_progress = checkpoint["stage_progress"]
+            print("=> load chekcpoint {} (epoch {}, batch {})"
+                  .format(args.resume, args.start_epoch, start_batch))
+
+    # the first process tests the whole (sub)set in the background, one validator per stage
+    validator = None
+    # (epoch, batch) of the weights the last test loss was computed on
+    tested_at = None
+
+    def record_tests(finished):
+        nonlocal tested_at
+        for (test_epoch, test_batch, test_subEpoch), test_loss in finished:
+            test_losses.append(test_loss)
+            tested_at = (test_epoch, test_batch)
+            print("====> SubEpoch: {} Test set loss {:4f} Time {}".format(
+                test_subEpoch, test_loss, time.asctime(time.localtime(time.time()))
+            ))
+        return finished[-1][1] if finished else None
+
+    # checkpoints are written in the background by the first process
+    checkpointer = AsyncCheckpointer(args.save_dir, args.keep_last) if rank == 0 else None
+
+    # per-module profiling
+    profiler = None
+    if args.profile and rank == 0:
+        models = {"g_model": g_model.module if isinstance(g_model, (nn.DataParallel, DistributedDataParallel)) else g_model}
+        if args.gan_loss != "none":
+            models["d_model"] = d_model.module if isinstance(d_model, (nn.DataParallel, DistributedDataParallel)) else d_model
+        profiler = ModuleProfiler(models, args.cuda)
+
+    def end_stage(n, elapsed, epochs):
+        step = stages[n][0]
+        print("====> Stage {}: step {}, {} epochs in {:.2f}s Time {}".format(
+            n, step, epochs, elapsed, time.asctime(time.localtime(time.time()))
+        ))
+        stage_times.append({"stage": n, "training_step": step, "epochs": epochs, "seconds": elapsed,
+                            "train_loss": train_losses[-1] if train_losses else None,
+                            "test_loss": test_losses[-1] if test_losses else None})
+        if rank == 0:
+            # the final weights of every step are kept out of the checkpoint rotation
+            if len(stages) > 1:
+                checkpointer.save({"model_step{}.pth".format(step): g_net.state_dict()}, keep=True)
+            with open(stages_file, "w") as f:
+                json.dump(stage_times, f, indent=2)
 
     # main loop
-    for epoch in tqdm(range(args.start_epoch, args.epochs)):
+    new_test_loss = None
+    stage, stage_start, stage_epochs, stage_times = None, 0., 0, []
+    stages_file = os.path.join(args.save_dir, "stages.json")
+    if args.resume and os.path.isfile(stages_file):
+        # the stages finished before the resumed one keep their records
+        with open(stages_file) as f:
+            stage_times = [t for t in json.load(f) if t["stage"] < stage_of(stages, args.start_epoch)]
+    for epoch in tqdm(range(args.start_epoch, args.epochs), disable=rank != 0):
+        if stage_of(stages, epoch) != stage:
+            # the test process holds the step and the test windows of its stage
+            if validator is not None:
+                new_test_loss = record_tests(validator.close())
+            if stage is not None:
+                end_stage(stage, time.time() - stage_start, stage_epochs)
+                print("=> warm-starting step {} from step {}".format(stages[stage_of(stages, epoch)][0], stages[stage][0]))
+            stage, stage_start, stage_epochs = stage_of(stages, epoch), time.time(), 0
+            if stage_progress is not None and stage_progress["stage"] == stage:
+                stage_start -= stage_progress["seconds"]
+                stage_epochs = stage_progress["epochs"]
+            stage_progress = None
+            train_sampler, train_loader, test_loader = set_stage(stage)
+            if args.async_test and rank == 0:
+                validator = AsyncValidator(args, test_loader.dataset, device, args.test_threads)
+        first_batch = start_batch if epoch == args.start_epoch else 0
+        train_sampler.set_epoch(epoch, first_batch * args.batch_size)
         # training..
         g_model.train()
         if args.gan_loss != "none":
             d_model.train()
         train_loss = 0.
         volume_loss_part = np.zeros(args.training_step)
-        for i, sample in enumerate(train_loader):
+        telemetry.reset()
+        for i, sample in enumerate(telemetry.iterate(train_loader), first_batch):
             params = list(g_model.named_parameters())
             # pdb.set_trace()
             # params[0][1].register_hook(lambda g: print("{}.grad: {}".format(params[0][0], g)))
-            # adversarial ground truths
-            real_label = Variable(Tensor(sample["v_i"].shape[0], sample["v_i"].shape[1], 1, 1, 1, 1).fill_(1.0), requires_grad=False)
-            fake_label = Variable(Tensor(sample["v_i"].shape[0], sample["v_i"].shape[1], 1, 1, 1, 1).fill_(0.0), requires_grad=False)
-
             v_f = sample["v_f"].to(device)
             v_b = sample["v_b"].to(device)
             v_i = sample["v_i"].to(device)
+            if augmentation is not None:
+                with telemetry.phase("augment"):
+                    v_f, v_b, v_i = augmentation(v_f, v_b, v_i)
+            # micro-batches, each weighted by its share of the batch so the accumulated gradients are the batch's
+            micro_size = args.micro_batch_size if args.micro_batch_size > 0 else v_i.shape[0]
+            micro_batches = list(zip(v_f.split(micro_size), v_b.split(micro_size), v_i.split(micro_size)))
+            weights = [m_i.shape[0] / v_i.shape[0] for _, _, m_i in micro_batches]
+            accumulate = len(micro_batches) > 1
+
+            # distributed models only synchronize the gradients of the last micro-batch
+            def sync(model, m):
+                if args.distributed and m < len(micro_batches) - 1:
+                    return model.no_sync()
+                return nullcontext()
+
             g_optimizer.zero_grad()
-            fake_volumes = g_model(v_f, v_b, args.training_step, args.wo_ori_volume, args.norm)
+            with telemetry.phase("g_forward"):
+                if accumulate:
+                    # only one graph at a time: the discriminator sees fakes computed without it, and the generator
+                    # update recomputes them
+                    with torch.no_grad():
+                        fakes = [g_model(m_f, m_b, args.training_step, args.wo_ori_volume, args.norm)
+                                 for m_f, m_b, _ in micro_batches]
+                else:
+                    fakes = [g_model(v_f, v_b, args.training_step, args.wo_ori_volume, args.norm)]
 
             # adversarial loss
             # update discriminator
@@ -238,61 +509,84 @@ def main(args):
                 avg_d_loss_real = 0.
                 avg_d_loss_fake = 0.
                 for k in range(args.n_d):
-                    d_optimizer.zero_grad()
-                    decisions = d_model(v_i)
-                    d_loss_real = adversarial_loss(decisions, real_label)
-                    fake_decisions = d_model(fake_volumes.detach())
-
-                    d_loss_fake = adversarial_loss(fake_decisions, fake_label)
-                    d_loss = d_loss_real + d_loss_fake
-                    d_loss.backward()
-                    avg_d_loss += d_loss.item() / args.n_d
-                    avg_d_loss_real += d_loss_real / args.n_d
-                    avg_d_loss_fake += d_loss_fake / args.n_d
-
-                    d_optimizer.step()
+                    with telemetry.phase("d_update"):
+                        d_optimizer.zero_grad()
+                        steps = draw_steps()
+                        for m, ((_, _, m_i), fake_volumes) in enumerate(zip(micro_batches, fakes)):
+                            m_i, fake_volumes = scored(m_i, steps), scored(fake_volumes, steps)
+                            # adversarial ground truths
+                            real_label = Variable(Tensor(m_i.shape[0], m_i.shape[1], 1, 1, 1, 1).fill_(1.0), requires_grad=False)
+                            fake_label = Variable(Tensor(m_i.shape[0], m_i.shape[1], 1, 1, 1, 1).fill_(0.0), requires_grad=False)
+                            with sync(d_model, m):
+                                # real and fake volumes in one forward, so a distributed discriminator synchronizes once
+                                decisions, fake_decisions = d_model(torch.cat([m_i, fake_volumes.detach()], 0)).chunk(2, 0)
+                                d_loss_real = weights[m] * adversarial_loss(decisions, real_label)
+
+                                d_loss_fake = weights[m] * adversarial_loss(fake_decisions, fake_label)
+                                d_loss = d_loss_real + d_loss_fake
+                                d_loss.backward()
+                            avg_d_loss += d_loss.item() / args.n_d
+                            avg_d_loss_real += d_loss_real.item() / args.n_d
+                            avg_d_loss_fake += d_loss_fake.item() / args.n_d
+
+                    with telemetry.phase("optimizer"):
+                        d_optimizer.step()
 
             # update generator
             if args.gan_loss != "none":
                 avg_g_loss = 0.
             avg_loss = 0.
             for k in range(args.n_g):
-                loss = 0.
                 g_optimizer.zero_grad()
-
-                # adversarial loss
-                if args.gan_loss != "none":
-                    fake_decisions = d_model(fake_volumes)
-                    g_loss = args.gan_loss_weight * adversarial_loss(fake_decisions, real_label)
-                    loss += g_loss
-                    avg_g_loss += g_loss.item() / args.n_g
-
-                # volume loss
-                if args.volume_loss:
-                    volume_loss = args.volume_loss_weight * mse_loss(v_i, fake_volumes)
-                    for j in range(v_i.shape[1]):
-                        volume_loss_part[j] += mse_loss(v_i[:, j, :], fake_volumes[:, j, :]) / args.n_g / args.log_every
-                    loss += volume_loss
-
-                # feature loss
-                if args.feature_loss:
-                    feat_real = d_model.extract_features(v_i)
-                    feat_fake = d_model.extract_features(fake_volumes)
-                    for m in range(len(feat_real)):
-                        loss += args.feature_loss_weight / len(feat_real) * mse_loss(feat_real[m], feat_fake[m])
-
-                avg_loss += loss / args.n_g
-                loss.backward()
-                g_optimizer.step()
+                steps = draw_steps()
+                for m, (m_f, m_b, m_i) in enumerate(micro_batches):
+                    loss = 0.
+                    with sync(g_model, m):
+                        if accumulate:
+                            with telemetry.phase("g_forward"):
+                                fake_volumes = g_model(m_f, m_b, args.training_step, args.wo_ori_volume, args.norm)
+                        else:
+                            fake_volumes = fakes[m]
+                        real_label = Variable(Tensor(m_i.shape[0], scored(m_i, steps).shape[1], 1, 1, 1, 1).fill_(1.0), requires_grad=False)
+
+                        # adversarial loss
+                        if args.gan_loss != "none":
+                            fake_decisions = d_net(scored(fake_volumes, steps))
+                            g_loss = args.gan_loss_weight * adversarial_loss(fake_decisions, real_label)
+                            loss += g_loss
+                            avg_g_loss += weights[m] * g_loss.item() / args.n_g
+
+                        # volume loss
+                        if args.volume_loss:
+                            volume_loss = args.volume_loss_weight * mse_loss(m_i, fake_volumes)
+                            for j in range(m_i.shape[1]):
+                                volume_loss_part[j] += weights[m] * mse_loss(m_i[:, j, :], fake_volumes[:, j, :]).item() / args.n_g / args.log_every
+                            loss += volume_loss
+
+                        # feature loss
+                        if args.feature_loss:
+                            feat_real = d_net.extract_features(scored(m_i, steps))
+                            feat_fake = d_net.extract_features(scored(fake_volumes, steps))
+                            for n in range(len(feat_real)):
+                                loss += args.feature_loss_weight / len(feat_real) * mse_loss(feat_real[n], feat_fake[n])
+
+                        loss = weights[m] * loss
+                        avg_loss += loss.detach() / args.n_g
+                        with telemetry.phase("g_backward"):
+                            loss.backward()
+                with telemetry.phase("optimizer"):
+                    g_optimizer.step()
 
             train_loss += avg_loss
+            telemetry.step(v_i.shape[0])
 
             # log training status
             subEpoch = (i + 1) // args.log_every
             if (i+1) % args.log_every == 0:
+                # the samples of this process's shard of the epoch
                 print("Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}".format(
-                    epoch, (i+1) * args.batch_size, len(train_loader.dataset), 100. * (i+1) / len(train_loader),
-                    avg_loss
+                    epoch, min((i+1) * args.batch_size, len(train_loader.sampler)), len(train_loader.sampler),
+                    100. * (i+1) / len(train_loader), avg_loss
                 ))
                 print("Volume Loss: ")
                 for j in range(volume_loss_part.shape[0]):
@@ -316,53 +610,104 @@ def main(args):
 
             # testing...
             if (i + 1) % args.test_every == 0:
-                g_model.eval()
-                if args.gan_loss != "none":
-                    d_model.eval()
-                test_loss = 0.
-                with torch.no_grad():
-                    for i, sample in enumerate(test_loader):
-                        v_f = sample["v_f"].to(device)
-                        v_b = sample["v_b"].to(device)
-                        v_i = sample["v_i"].to(device)
-                        fake_volumes = g_model(v_f, v_b, args.training_step, args.wo_ori_volume, args.norm)
-                        test_loss += args.volume_loss_weight * mse_loss(v_i, fake_volumes).item()
-
-                test_losses.append(test_loss * args.batch_size / len(test_loader.dataset))
-                print("====> SubEpoch: {} Test set loss {:4f} Time {}".format(
-                    subEpoch, test_losses[-1], time.asctime(time.localtime(time.time()))
-                ))
+                with telemetry.phase("test"):
+                    if validator is not None:
+                        if not validator.submit((epoch, i + 1, subEpoch), g_net.state_dict()):
+                            print("=> test process busy, skipping the snapshot of sub-epoch {}".format(subEpoch))
+                    elif not args.async_test:
+                        g_model.eval()
+                        if args.gan_loss != "none":
+                            d_model.eval()
+                        test_loss = validation_loss(g_net, test_loader, args, device)
+                        if args.distributed:
+                            # every process evaluated its shard of the test set
+                            test_loss = torch.tensor(test_loss, device=device)
+                            dist.all_reduce(test_loss)
+                            test_loss = test_loss.item()
+
+                        new_test_loss = test_loss * args.batch_size / len(test_loader.dataset)
+                        test_losses.append(new_test_loss)
+                        tested_at = (epoch, i + 1)
+                        print("====> SubEpoch: {} Test set loss {:4f} Time {}".format(
+                            subEpoch, test_losses[-1], time.asctime(time.localtime(time.time()))
+                        ))
+                        g_model.train()
+                        if args.gan_loss != "none":
+                            d_model.train()
+            if validator is not None:
+                finished = validator.poll()
+                if finished:
+                    new_test_loss = record_tests(finished)
 
             # saving...
-            if (i+1) % args.check_every == 0:
-                print("=> saving checkpoint at epoch {}".format(epoch))
-                if args.gan_loss != "none":
-                    torch.save({"epoch": epoch + 1,
-                                "g_model_state_dict": g_model.state_dict(),
-                                "g_optimizer_state_dict":  g_optimizer.state_dict(),
-                                "d_model_state_dict": d_model.state_dict(),
-                                "d_optimizer_state_dict": d_optimizer.state_dict(),
-                                "d_losses": d_losses,
-                                "g_losses": g_losses,
-                                "train_losses": train_losses,
-                                "test_losses": test_losses},
-                               os.path.join(args.save_dir, "model_" + str(epoch) + "_" + str(subEpoch) + "_" + "pth.tar")
-                               )
-                else:
-                    torch.save({"epoch": epoch + 1,
-                                "g_model_state_dict": g_model.state_dict(),
-                                "g_optimizer_state_dict": g_optimizer.state_dict(),
-                                "train_losses": train_losses,
-                                "test_losses": test_losses},
-                               os.path.join(args.save_dir, "model_" + str(epoch) + "_" + str(subEpoch) + "_" + "pth.tar")
-                               )
-                torch.save(g_model.state_dict(),
-                           os.path.join(args.save_dir, "model_" + str(epoch) + "_" + str(subEpoch) + ".pth"))
+            if (i+1) % args.check_every == 0 and rank == 0:
+                with telemetry.phase("checkpoint"):
+                    print("=> saving checkpoint at epoch {}".format(epoch))
+                    state = {"epoch": epoch + 1,
+                             "position": {"epoch": epoch, "batch": i + 1},
+                             "rng_state": rng_state(args.cuda),
+                             "stage_progress": {"stage": stage, "seconds": time.time() - stage_start,
+                                                "epochs": stage_epochs + (i + 1 == len(train_loader))},
+                             "g_model_state_dict": g_net.state_dict(),
+                             "g_optimizer_state_dict": g_optimizer.state_dict(),
+                             "train_losses": train_losses,
+                             "test_losses": test_losses}
+                    if args.gan_loss != "none":
+                        state.update({"d_model_state_dict": d_net.state_dict(),
+                                      "d_optimizer_state_dict": d_optimizer.state_dict(),
+                                      "d_losses": d_losses,
+                                      "g_losses": g_losses})
+                    name = "model_" + str(epoch) + "_" + str(subEpoch)
+                    # the best checkpoint is only judged on a test loss of these very weights
+                    checkpointer.save({name + "_pth.tar": state, name + ".pth": g_net.state_dict()},
+                                      test_losses[-1] if tested_at == (epoch, i + 1) else None)
+
+            if (i+1) % args.log_every == 0:
+                telemetry.log(epoch=epoch, sub_epoch=subEpoch, world_size=args.world_size if args.distributed else 1,
+                              training_step=args.training_step, loss=train_losses[-1],
+                              test_loss=new_test_loss)
+                new_test_loss = None
+
+            if profiler is not None and (i + 1) >= args.profile_batches:
+                print("=> saving profile {} and {}".format(*profiler.export(args.profile)))
+                profiler.remove()
+                profiler = None
 
         num_subEpoch = len(train_loader) // args.log_every
         print("====> Epoch: {} Average loss: {:.6f} Time {}".format(
             epoch, np.array(train_losses[-num_subEpoch:]).mean(), time.asctime(time.localtime(time.time()))
         ))
+        stage_epochs += 1
+
+    if profiler is not None:
+        print("=> saving profile {} and {}".format(*profiler.export(args.profile)))
+        profiler.remove()
+
+    if validator is not None:
+        record_tests(validator.close())
+    if stage is not None:
+        end_stage(stage, time.time() - stage_start, stage_epochs)
+    if checkpointer is not None:
+        checkpointer.close()
+    if args.distributed:
+        dist.destroy_process_group()
+
+# the entry of a distributed process
+def main_worker(rank, args):
+    main(args, rank)
 
 if __name__  == "__main__":
-    main(parse_args())
\ No newline at end of file
+    args = parse_args()
+    if args.memory_budget > 0:
+        # probed once, before the processes of distributed training start
+        device = torch.device("cuda: 0" if not args.no_cuda and torch.cuda.is_available() else "cpu")
+        # at the largest step trained, that of the longest windows of a schedule
+        probe_args = argparse.Namespace(**vars(args))
+        if args.step_schedule:
+            probe_args.training_step = max(step for step, _ in parse_schedule(args.step_schedule))
+        args.micro_batch_size, measurements = tune_micro_batch_size(probe_args, device)
+        log_config(probe_args, args.micro_batch_size, measurements)
+    if args.distributed:
+        mp.spawn(main_worker, args=(args,), nprocs=args.world_size)
+    else:
+        main(args)
\ No newline at end of file
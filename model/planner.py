@@ -0,0 +1,434 @@
+# analytic parameters, FLOPs and memory of generator configurations
+
+import os
+import argparse
+import itertools
+import queue
+import resource
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model")
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=[32, 64, 96],
+                        help="sizes of the sub-block to plan")
+    parser.add_argument("--steps", type=int, nargs="+", default=[3, 5, 9],
+                        help="numbers of intermediate volumes to plan")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4],
+                        help="batch sizes to plan")
+    parser.add_argument("--memory-budget", type=int, default=0,
+                        help="memory budget (MB) of the feasible configurations (default: list all)")
+    parser.add_argument("--overhead", type=float, default=0.,
+                        help="factor applied to the estimated peak memory, e.g. the measured/estimated ratio of --validate "
+                             "(default: with --memory-budget, that ratio measured on the smallest configuration, else 1)")
+
+    parser.add_argument("--gen-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the generator")
+    parser.add_argument("--dis-sn", action="store_true", default=False,
+                        help="enable spectral normalization for the discriminator")
+    parser.add_argument("--residual", action="store_true", default=False,
+                        help="decide whether adding residual block in the generator or not")
+    parser.add_argument("--gan-loss", type=str, default="none",
+                        help="gan loss (default: none)")
+    parser.add_argument("--feature-loss", action="store_true", default=False,
+                        help="enable feature loss")
+    parser.add_argument("--upsample-mode", type=str, default="lr",
+                        help="how to do upsample, voxel shuffle (lr) or interpolate (hr)")
+    parser.add_argument("--norm", type=str, default="",
+                        help="how normalize hidden layer, none or batch norm or instance norm")
+    parser.add_argument("--forward", action="store_true", default=False,
+                        help="during training, do forward prediction")
+    parser.add_argument("--backward", action="store_true", default=False,
+                        help="during training, do backward prediction")
+    parser.add_argument("--n-d", type=int, default=2,
+                        help="number of D updates per iteration")
+
+    parser.add_argument("--detail", action="store_true", default=False,
+                        help="print the per-module FLOPs and saved activations of one timestep of the first configuration")
+    parser.add_argument("--validate", type=int, default=0,
+                        help="measure the given number of the smallest feasible configurations on the CPU")
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="measure on the CPU even if CUDA is available")
+    return parser.parse_args()
+
+class Activation(object):
+    # the shape of an activation of one sample: channels and a cubic size
+    def __init__(self, channels, size):
+        self.channels = channels
+        self.size = size
+
+    def numel(self):
+        return self.channels * self.size ** 3
+
+class Trace(object):
+    # walks an architecture like its forward does: the parameters of every named layer (counted once however often
+    # it runs), the convolution FLOPs, and the activations autograd saves for the backward pass, per sample
+    def __init__(self, sn=False):
+        self.sn = sn
+        self.params = {}
+        self.flops = 0
+        self.saved = {}
+        self.largest = 0
+        self.prefix = ""
+        # per-module (flops, saved elements)
+        self.modules = {}
+
+    def new(self, channels, size):
+        x = Activation(channels, size)
+        self.largest = max(self.largest, x.numel())
+        return x
+
+    def save(self, *xs):
+        for x in xs:
+            if id(x) not in self.saved:
+                self.saved[id(x)] = x
+                self.count(0, x.numel())
+
+    def count(self, flops, saved):
+        name = self.prefix.split(".")[0]
+        module_flops, module_saved = self.modules.get(name, (0, 0))
+        self.modules[name] = (module_flops + flops, module_saved + saved)
+
+    def saved_elements(self):
+        return sum(x.numel() for x in self.saved.values())
+
+    def conv(self, name, x, out_channels, kernel_size, stride=1, padding=None, bias=True, sn=True):
+        padding = (kernel_size - 1) // 2 if padding is None else padding
+        self.params[self.prefix + name] = x.channels * out_channels * kernel_size ** 3 + (out_channels if bias else 0)
+        y = self.new(out_channels, (x.size + 2 * padding - kernel_size) // stride + 1)
+        flops = 2 * y.numel() * x.channels * kernel_size ** 3
+        self.flops += flops
+        self.count(flops, 0)
+        self.save(x)
+        if self.sn and sn:
+            # spectral normalization computes a new weight every call, saved like an activation
+            self.save(Activation(x.channels * out_channels, kernel_size))
+        return y
+
+    def norm(self, name, x, enabled):
+        # the affine parameters exist whether or not the norm is used
+        self.params[self.prefix + name] = 2 * x.channels
+        if not enabled:
+            return x
+        self.save(x)
+        return self.new(x.channels, x.size)
+
+    def activation(self, x):
+        # relu, sigmoid and tanh save their output, leaky relu its input
+        y = self.new(x.channels, x.size)
+        self.save(y)
+        return y
+
+    def avg_pool(self, x):
+        self.save(x)
+        return self.new(x.channels, x.size // 2)
+
+    def upsample(self, x, shuffle):
+        # voxel shuffle (a copy) or nearest interpolation, nothing saved
+        return self.new(x.channels // 8 if shuffle else x.channels, x.size * 2)
+
+    def add(self, a, b):
+        return self.new(a.channels, a.size)
+
+    def mul(self, a, b):
+        self.save(a, b)
+        return self.new(a.channels, a.size)
+
+def forward_block(t, x, out_channels, kernel_size, norm):
+    out = t.conv("p1_conv0", x, out_channels, kernel_size)
+    out = t.activation(t.norm("p1_in0", out, norm))
+    out = t.norm("p1_in1", t.conv("p1_conv1", out, out_channels, kernel_size, stride=2), norm)
+    residual = t.avg_pool(t.conv("p2_conv0", x, out_channels, 1))
+    return t.add(out, residual)
+
+def residual_block(t, x, norm):
+    out = t.activation(t.norm("in0", t.conv("conv0", x, x.channels, 3), norm))
+    out = t.norm("in1", t.conv("conv1", out, x.channels, 3), norm)
+    return t.add(out, x)
+
+def upsample_conv(t, name, x, out_channels, kernel_size, upsample_mode):
+    if upsample_mode == "lr":
+        return t.upsample(t.conv(name, x, out_channels * 8, kernel_size), True)
+    return t.conv(name, t.upsample(x, False), out_channels, kernel_size)
+
+def backward_block(t, x, out_channels, kernel_size, upsample_mode, norm):
+    out = upsample_conv(t, "p1_conv0", x, x.channels, kernel_size, upsample_mode)
+    out = t.activation(t.norm("p1_in0", out, norm))
+    out = t.norm("p1_in1", t.conv("p1_conv1", out, out_channels, kernel_size), norm)
+    residual = upsample_conv(t, "p2_conv0", x, out_channels, 1, upsample_mode)
+    return t.add(out, residual)
+
+def lstm_cell(t, x, h, c):
+    gates = {}
+    for gate in "fioc":
+        # the cells are never spectrally normalized
+        gates[gate] = t.add(t.conv("Wx" + gate, x, 64, 3, sn=False), t.conv("Wh" + gate, h, 64, 3, bias=False, sn=False))
+        gates[gate] = t.activation(gates[gate])
+    c = t.add(t.mul(gates["i"], gates["c"]), t.mul(gates["f"], c))
+    h = t.mul(gates["o"], t.activation(c))
+    return h, c
+
+# the layers of Generator.encode and Generator.decode
+ENCODER = [("for_down1", 16, 5), ("for_down2", 32, 3), ("for_down3", 64, 3), ("for_down4", 64, 3)]
+DECODER = [("back_up1", 64, 3), ("back_up2", 32, 3), ("back_up3", 16, 3), ("back_up4", 1, 5)]
+
+def generator_step(t, x, state, direction, args):
+    norm = args.norm == "Instance"
+    for n, (name, channels, kernel_size) in enumerate(ENCODER):
+        t.prefix = name + "."
+        x = forward_block(t, x, channels, kernel_size, norm)
+        if args.residual:
+            t.prefix = "for_res{}.".format(n + 1)
+            x = residual_block(t, x, norm)
+    t.prefix = "cell0{}.".format(direction)
+    if state is None:
+        state = (t.new(64, x.size), t.new(64, x.size))
+    x, c = lstm_cell(t, x, *state)
+    state = (x, c)
+    for n, (name, channels, kernel_size) in enumerate(DECODER):
+        t.prefix = name + "."
+        x = backward_block(t, x, channels, kernel_size, args.upsample_mode, norm)
+        if args.residual:
+            t.prefix = "back_res{}.".format(n + 1)
+            x = residual_block(t, x, norm)
+    t.prefix = "tanh."
+    x = t.activation(x)
+    t.prefix = ""
+    return x, state
+
+def discriminator(t, x):
+    # one intermediate volume
+    t.prefix = "discriminator."
+    for n, channels in enumerate([64, 128, 256, 512]):
+        x = t.activation(t.conv("conv{}".format(n + 1), x, channels, 4, stride=2))
+    x = t.conv("conv5", x, 1, 4, padding=0)
+    t.prefix = ""
+    return x
+
+def plan(args, block_size, steps, batch_size):
+    # per sample analytic costs, then the batch's training footprint
+    directions = [d for d, enabled in ((0, args.forward), (1, args.backward)) if enabled]
+    t = Trace(args.gen_sn)
+    per_step = []
+    for direction in directions:
+        x, state = t.new(1, block_size), None
+        for step in range(steps):
+            flops, saved = t.flops, t.saved_elements()
+            x, state = generator_step(t, x, state, direction, args)
+            per_step.append((t.flops - flops, t.saved_elements() - saved))
+    g_params = sum(t.params.values())
+
+    d = Trace(args.dis_sn)
+    gan = args.gan_loss != "none"
+    if gan:
+        discriminator(d, d.new(1, block_size))
+    d_params = sum(d.params.values())
+
+    # steps of both directions run as pairs
+    step_flops = max(flops for flops, _ in per_step) * len(directions)
+    step_saved = max(saved for _, saved in per_step) * len(directions)
+    volume = block_size ** 3
+    g_forward = t.flops * batch_size
+    # the backward pass costs about twice the forward one
+    iteration_flops = 3 * g_forward
+    if gan:
+        # n_d updates on real and fake volumes, the generator update through the discriminator (and the features)
+        iteration_flops += 3 * d.flops * batch_size * steps * (2 * args.n_d + 1 + (2 if args.feature_loss else 0))
+
+    # fp32 bytes: weights, gradients and the two Adam moments
+    states = 16 * (g_params + d_params)
+    # v_f, v_b, v_i, the generated volumes and the gradient of the loss
+    data = 4 * batch_size * volume * (2 + 3 * steps)
+    g_saved = 4 * batch_size * t.saved_elements()
+    d_saved = 4 * batch_size * steps * d.saved_elements() * max(2, 1 + (2 if args.feature_loss else 0))
+    # the gradients of the largest activation and of its input while it is back-propagated
+    workspace = 2 * 4 * batch_size * max(t.largest, d.largest)
+    return {"block_size": block_size, "steps": steps, "batch_size": batch_size,
+            "g_params": g_params, "d_params": d_params,
+            "step_flops": step_flops * batch_size, "g_forward_flops": g_forward, "iteration_flops": iteration_flops,
+            "step_saved": 4 * batch_size * step_saved, "g_saved": g_saved, "d_saved": d_saved,
+            "peak_memory": args.overhead * (states + data + g_saved + d_saved + workspace),
+            "valid": block_size % 16 == 0 and (not gan or block_size == 64), "trace": t,
+            "timesteps": steps * len(directions)}
+
+def measure_worker(args, config, device, results):
+    # the same quantities of a real training iteration
+    import torch
+    import torch.nn.functional as F
+    import torch.optim as optim
+    from torch.utils.flop_counter import FlopCounterMode
+    from generator import Generator
+    from discriminator import Discriminator
+
+    b, steps, batch_size = config["block_size"], config["steps"], config["batch_size"]
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    g_model = Generator(args.upsample_mode, args.forward, args.backward, args.gen_sn, args.residual).to(device)
+    g_optimizer = optim.Adam(g_model.parameters())
+    gan = args.gan_loss != "none"
+    if gan:
+        d_model = Discriminator(args.dis_sn).to(device)
+        d_optimizer = optim.Adam(d_model.parameters())
+    v_f = torch.randn(batch_size, 1, b, b, b, device=device)
+    v_b = torch.randn(batch_size, 1, b, b, b, device=device)
+    v_i = torch.randn(batch_size, steps, 1, b, b, b, device=device)
+    measured = {"g_params": sum(p.numel() for p in g_model.parameters()),
+                "d_params": sum(p.numel() for p in d_model.parameters()) if gan else 0}
+
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        g_model(v_f, v_b, steps, False, args.norm)
+    measured["g_forward_flops"] = counter.get_total_flops()
+
+    # the storage of every tensor autograd saves, except the parameters
+    parameters = {p.untyped_storage().data_ptr() for p in g_model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameters:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fake_volumes = g_model(v_f, v_b, steps, False, args.norm)
+    measured["g_saved"] = sum(saved.values())
+    del fake_volumes
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    timings = []
+    for _ in range(2):
+        tic = time.time()
+        fake_volumes = g_model(v_f, v_b, steps, False, args.norm)
+        loss = F.mse_loss(v_i, fake_volumes)
+        if gan:
+            for _ in range(args.n_d):
+                d_optimizer.zero_grad()
+                d_model(torch.cat([v_i, fake_volumes.detach()], 0)).mean().backward()
+                d_optimizer.step()
+            loss = loss + d_model(fake_volumes).mean()
+            if args.feature_loss:
+                for feat_real, feat_fake in zip(d_model.extract_features(v_i), d_model.extract_features(fake_volumes)):
+                    loss = loss + F.mse_loss(feat_real, feat_fake)
+        g_optimizer.zero_grad()
+        loss.backward()
+        g_optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        timings.append(time.time() - tic)
+        del fake_volumes, loss
+    if device.type == "cuda":
+        measured["peak_memory"] = torch.cuda.max_memory_allocated(device)
+    else:
+        # ru_maxrss is in kilobytes on Linux; the growth over the process before the models
+        measured["peak_memory"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base
+    measured["iteration_time"] = timings[-1]
+    results.put(measured)
+
+def measure(args, config, device):
+    import torch.multiprocessing as mp
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=measure_worker, args=(args, config, device, results))
+    # a fixed mmap threshold returns the freed large blocks to the system, so the RSS follows the live tensors
+    # instead of the high-water mark of the heap
+    threshold = os.environ.get("MALLOC_MMAP_THRESHOLD_")
+    os.environ["MALLOC_MMAP_THRESHOLD_"] = threshold or "65536"
+    process.start()
+    if threshold is None:
+        del os.environ["MALLOC_MMAP_THRESHOLD_"]
+    process.join()
+    try:
+        return results.get(timeout=1)
+    except queue.Empty:
+        return None
+
+def print_detail(config):
+    t = config["trace"]
+    print("====> One timestep of block size {} (per sample)".format(config["block_size"]))
+    print("{:<14}{:>12}{:>16}".format("module", "MFLOP", "saved (MB)"))
+    for name, (flops, saved) in t.modules.items():
+        # the encoder and the decoder run in every step of both directions, the cell<layer><direction> of one
+        # direction only in its own steps
+        steps = config["steps"] if name.startswith("cell") else config["timesteps"]
+        print("{:<14}{:>12.1f}{:>16.2f}".format(name, flops / steps / 1e6, 4 * saved / steps / 2 ** 20))
+
+def calibrate(args, configs, device):
+    # the estimate leaves out the allocator, the runtime and the scratch memory of the convolution kernels, whose
+    # size depends on the algorithm the kernels pick; the ratio of the smallest configuration is the largest, as
+    # the fixed part weighs the most there
+    config = min([c for c in configs if c["valid"]], key=lambda c: c["peak_memory"])
+    measured = measure(args, config, device)
+    if measured is None:
+        raise ValueError("measuring block size {}, {} steps, batch size {} failed; pass a calibrated --overhead".format(
+            config["block_size"], config["steps"], config["batch_size"]))
+    overhead = measured["peak_memory"] / config["peak_memory"]
+    print("=> overhead {:.2f}: {:.1f} MB measured for {:.1f} MB estimated (block size {}, {} steps, batch size {}, {})"
+          .format(overhead, measured["peak_memory"] / 2 ** 20, config["peak_memory"] / 2 ** 20, config["block_size"],
+                  config["steps"], config["batch_size"], device))
+    return overhead
+
+def main(args):
+    if not args.forward and not args.backward:
+        raise ValueError("at least one of --forward and --backward is needed")
+    calibrated = args.overhead > 0
+    if not calibrated:
+        args.overhead = 1.
+    configs = [plan(args, b, k, n) for b, k, n in itertools.product(args.block_sizes, args.steps, args.batch_sizes)]
+    budget = args.memory_budget * 2 ** 20
+    if budget > 0 and not calibrated:
+        # a budget is only checked against an estimate scaled to the measured peak
+        import torch
+        device = torch.device("cuda: 0" if not args.no_cuda and torch.cuda.is_available() else "cpu")
+        args.overhead = calibrate(args, configs, device)
+        configs = [plan(args, b, k, n) for b, k, n in itertools.product(args.block_sizes, args.steps, args.batch_sizes)]
+    print("====> Training configurations ({}{}, {} upsampling{}{})".format(
+        "forward+backward" if args.forward and args.backward else ("forward" if args.forward else "backward"),
+        ", residual" if args.residual else "", args.upsample_mode,
+        ", norm " + args.norm if args.norm else "",
+        ", gan" + (" + feature loss" if args.feature_loss else "") if args.gan_loss != "none" else ""
+    ))
+    print("{:>6}{:>6}{:>6}{:>12}{:>12}{:>12}{:>14}{:>12}{:>10}".format(
+        "block", "steps", "batch", "params (M)", "GFLOP/step", "GFLOP/iter", "act MB/step", "peak (MB)", "fits"))
+    for config in configs:
+        if not config["valid"]:
+            fits = "invalid"
+        elif budget > 0:
+            fits = "yes" if config["peak_memory"] <= budget else "no"
+        else:
+            fits = "-"
+        if budget > 0 and fits != "yes":
+            continue
+        print("{:>6}{:>6}{:>6}{:>12.3f}{:>12.2f}{:>12.1f}{:>14.1f}{:>12.1f}{:>10}".format(
+            config["block_size"], config["steps"], config["batch_size"],
+            (config["g_params"] + config["d_params"]) / 1e6, config["step_flops"] / 1e9,
+            config["iteration_flops"] / 1e9, config["step_saved"] / 2 ** 20, config["peak_memory"] / 2 ** 20, fits
+        ))
+    if args.detail:
+        print_detail(configs[0])
+
+    if args.validate > 0:
+        import torch
+        device = torch.device("cuda: 0" if not args.no_cuda and torch.cuda.is_available() else "cpu")
+        candidates = sorted([c for c in configs if c["valid"] and (budget == 0 or c["peak_memory"] <= budget)],
+                            key=lambda c: c["peak_memory"])[:args.validate]
+        # on the CPU the measured peak is the growth of the RSS, which adds the allocator's and the kernels'
+        # scratch memory to the tensors the estimate counts
+        print("====> Estimated / measured on {}".format(device))
+        print("{:>6}{:>6}{:>6}{:>18}{:>20}{:>18}{:>20}{:>8}{:>10}".format(
+            "block", "steps", "batch", "params", "G fwd GFLOP", "G saved (MB)", "peak (MB)", "ratio", "iter (s)"))
+        for config in candidates:
+            measured = measure(args, config, device)
+            if measured is None:
+                print("{:>6}{:>6}{:>6}  measurement failed".format(config["block_size"], config["steps"],
+                                                                   config["batch_size"]))
+                continue
+            print("{:>6}{:>6}{:>6}{:>18}{:>20}{:>18}{:>20}{:>8.2f}{:>10.2f}".format(
+                config["block_size"], config["steps"], config["batch_size"],
+                "{}/{}".format(config["g_params"] + config["d_params"], measured["g_params"] + measured["d_params"]),
+                "{:.2f}/{:.2f}".format(config["g_forward_flops"] / 1e9, measured["g_forward_flops"] / 1e9),
+                "{:.1f}/{:.1f}".format(config["g_saved"] / 2 ** 20, measured["g_saved"] / 2 ** 20),
+                "{:.1f}/{:.1f}".format(config["peak_memory"] / 2 ** 20, measured["peak_memory"] / 2 ** 20),
+                measured["peak_memory"] / config["peak_memory"], measured["iteration_time"]
+            ))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,139 @@
+# per-module profiling of the generator and the discriminator
+
+import json
+import time
+
+import torch
+import torch.nn as nn
+
+from basicblock import VoxelShuffle
+
+class ModuleProfiler(object):
+    # forward hooks on the top-level blocks of the models (and every VoxelShuffle) that record wall time,
+    # an estimate of the convolution FLOPs and the output activation size of every call, tagged with the
+    # timestep: for the recurrences of the generator, the direction (0: forward, 1: backward) and the step
+    # counted from the key frame the direction starts at; otherwise the call index of the block inside one
+    # forward of its model. The backward pass of autograd is not attributed to the blocks
+    def __init__(self, models, cuda=False):
+        self.cuda = cuda
+        self.events = []
+        self.handles = []
+        self.stack = []
+        self.calls = {}
+        self.direction = None
+        self.tracked = []
+        self.origin = time.time()
+
+        for model_name, model in models.items():
+            self.handles.append(model.register_forward_pre_hook(self.reset_calls))
+            if hasattr(model, "predict"):
+                # the recurrence of one direction; shadowed on the instance until remove()
+                model.predict = self.track_direction(model.predict)
+                self.tracked.append(model)
+            for name, module in model.named_modules():
+                # the flops of a profiled convolution are counted before its own frame is closed
+                if isinstance(module, nn.Conv3d):
+                    self.handles.append(module.register_forward_hook(self.count_flops))
+                if ("." not in name and name != "") or isinstance(module, VoxelShuffle):
+                    full_name = model_name + "." + name
+                    self.handles.append(module.register_forward_pre_hook(self.enter(full_name)))
+                    self.handles.append(module.register_forward_hook(self.exit(full_name)))
+
+    def reset_calls(self, module, inputs):
+        if not self.stack:
+            self.calls = {}
+
+    def track_direction(self, predict):
+        def wrapper(x, direction, num_steps, norm):
+            # every block runs once per step, so its call index restarts with the direction
+            self.direction, self.calls = direction, {}
+            try:
+                return predict(x, direction, num_steps, norm)
+            finally:
+                self.direction = None
+        return wrapper
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def enter(self, name):
+        def hook(module, inputs):
+            self.sync()
+            record = torch.autograd.profiler.record_function(name)
+            record.__enter__()
+            self.stack.append({"name": name, "start": time.time(), "flops": 0, "record": record})
+        return hook
+
+    def exit(self, name):
+        def hook(module, inputs, output):
+            self.sync()
+            frame = self.stack.pop()
+            frame["record"].__exit__(None, None, None)
+            outputs = output if isinstance(output, tuple) else (output,)
+            step = self.calls.get(name, 0)
+            self.calls[name] = step + 1
+            self.events.append({
+                "name": name,
+                "start": frame["start"] - self.origin,
+                "duration": time.time() - frame["start"],
+                "direction": self.direction,
+                "timestep": step,
+                "flops": frame["flops"],
+                "activation_bytes": sum(o.numel() * o.element_size() for o in outputs if torch.is_tensor(o)),
+            })
+            # nested profiled blocks (VoxelShuffle) count towards their parents too
+            if self.stack:
+                self.stack[-1]["flops"] += frame["flops"]
+        return hook
+
+    def count_flops(self, module, inputs, output):
+        if not self.stack:
+            return
+        kernel = 1
+        for k in module.kernel_size:
+            kernel *= k
+        # one multiply and one add per weight and output voxel
+        self.stack[-1]["flops"] += 2 * output.numel() * module.in_channels // module.groups * kernel
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        for model in self.tracked:
+            del model.predict
+        self.tracked = []
+
+    def summary(self):
+        rows = {}
+        for event in self.events:
+            row = rows.setdefault(event["name"], {"calls": 0, "time": 0., "flops": 0, "activation_bytes": 0})
+            row["calls"] += 1
+            row["time"] += event["duration"]
+            row["flops"] += event["flops"]
+            row["activation_bytes"] = max(row["activation_bytes"], event["activation_bytes"])
+        return sorted(rows.items(), key=lambda item: -item[1]["time"])
+
+    def export(self, prefix):
+        # chrome://tracing (or Perfetto) trace, raw events and a text summary sorted by total time
+        trace = {"traceEvents": [{
+            "name": event["name"], "ph": "X", "pid": 0, "tid": 0,
+            "ts": event["start"] * 1e6, "dur": event["duration"] * 1e6,
+            "args": {"direction": event["direction"], "timestep": event["timestep"], "flops": event["flops"],
+                     "activation_bytes": event["activation_bytes"]},
+        } for event in self.events]}
+        with open(prefix + "_trace.json", "w") as f:
+            json.dump(trace, f)
+
+        rows = self.summary()
+        total = sum(row["time"] for name, row in rows if name.count(".") == 1)
+        with open(prefix + "_summary.txt", "w") as f:
+            f.write("forward passes only: the time of the backward pass of autograd is not attributed to the modules\n")
+            f.write("{:<40}{:>8}{:>12}{:>10}{:>12}{:>10}{:>14}\n".format(
+                "module", "calls", "time (s)", "share", "GFLOP", "GFLOP/s", "act (MB)"))
+            for name, row in rows:
+                f.write("{:<40}{:>8}{:>12.4f}{:>9.1f}%{:>12.3f}{:>10.2f}{:>14.2f}\n".format(
+                    name, row["calls"], row["time"], 100. * row["time"] / max(total, 1e-12),
+                    row["flops"] / 1e9, row["flops"] / 1e9 / max(row["time"], 1e-12),
+                    row["activation_bytes"] / 2 ** 20))
+        return prefix + "_trace.json", prefix + "_summary.txt"
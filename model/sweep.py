@@ -0,0 +1,134 @@
+# concurrent training runs of a hyperparameter grid, sharing one packed copy of the dataset
+
+import os
+import sys
+import argparse
+import itertools
+import subprocess
+import time
+
+from telemetry import MODEL_DIR, main_command, summarize_run
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deep Learning Model",
+                                     epilog="the remaining arguments are passed to every run of main.py")
+    parser.add_argument("--grid", type=str, nargs="+", required=True,
+                        help="name=value,... per swept argument of main.py, e.g. lr=1e-4,5e-5 norm=,Instance; "
+                             "flags take on,off, e.g. residual=on,off")
+    parser.add_argument("--parallel", type=int, default=2,
+                        help="number of concurrent runs")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="number of threads of every run (default: its share of the cores)")
+    parser.add_argument("--no-affinity", action="store_true", default=False,
+                        help="do not pin every run to its share of the cores")
+    parser.add_argument("--sweep-dir", type=str, default="sweep",
+                        help="dir of the models, logs and telemetry of every run")
+    parser.add_argument("--pack-file", type=str, default="",
+                        help="prefix of the packed dataset (default: <sweep-dir>/pack)")
+    parser.add_argument("--skip", type=int, default=1,
+                        help="number of logged sub-epochs discarded as warm-up")
+    return parser.parse_known_args()
+
+def configurations(grid):
+    # every combination of the swept values, as (name, arguments of main.py)
+    axes = []
+    for axis in grid:
+        key, values = axis.split("=", 1)
+        axes.append([(key, value) for value in values.split(",")])
+    configs = []
+    for combination in itertools.product(*axes):
+        name, arguments = [], []
+        for key, value in combination:
+            name.append("{}={}".format(key, value))
+            if value in ("on", "off"):
+                arguments += ["--" + key] if value == "on" else []
+            else:
+                arguments += ["--" + key, value]
+        configs.append(("_".join(name), arguments))
+    return configs
+
+def core_sets(parallel):
+    # contiguous shares of the cores this process may run on
+    cores = sorted(os.sched_getaffinity(0))
+    share = max(len(cores) // parallel, 1)
+    return [[cores[(slot * share + n) % len(cores)] for n in range(share)] for slot in range(parallel)]
+
+def main(args, main_args):
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    pack_file = os.path.abspath(args.pack_file or os.path.join(args.sweep_dir, "pack"))
+
+    # the tiles are read and normalized once; every run maps the same pages
+    command = [sys.executable, "main.py"] + main_args + [
+        "--save-dir", args.sweep_dir, "--pack-file", pack_file, "--pack-only"]
+    print("=> packing {}".format(" ".join(command)))
+    subprocess.run(command, check=True, cwd=MODEL_DIR)
+
+    pending = configurations(args.grid)
+    slots = core_sets(args.parallel)
+    running = {}
+    results = []
+    print("=> {} runs, {} at a time on cores {}".format(len(pending), args.parallel, slots))
+    while pending or running:
+        for slot in range(args.parallel):
+            if slot in running or not pending:
+                continue
+            name, arguments = pending.pop(0)
+            run_dir = os.path.abspath(os.path.join(args.sweep_dir, name))
+            os.makedirs(run_dir, exist_ok=True)
+            metrics_file = os.path.join(run_dir, "metrics.jsonl")
+            threads = str(args.threads or len(slots[slot]))
+            env = dict(os.environ, OMP_NUM_THREADS=threads, MKL_NUM_THREADS=threads)
+            cores = slots[slot]
+            command = main_command(main_args + arguments + ["--save-dir", run_dir, "--pack-file", pack_file],
+                                   metrics_file)
+            print("=> [slot {}] {}".format(slot, " ".join(command)))
+            log = open(os.path.join(run_dir, "log.txt"), "w")
+            process = subprocess.Popen(command, cwd=MODEL_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                       preexec_fn=None if args.no_affinity else lambda: os.sched_setaffinity(0, cores))
+            running[slot] = (name, process, log, metrics_file, time.time())
+
+        time.sleep(1)
+        for slot, (name, process, log, metrics_file, start) in list(running.items()):
+            if process.poll() is None:
+                continue
+            log.close()
+            del running[slot]
+            wall = time.time() - start
+            if process.returncode != 0 or not os.path.isfile(metrics_file):
+                print("=> {} failed with exit code {}".format(name, process.returncode))
+                results.append((name, None, wall))
+                continue
+            summary = summarize_run(metrics_file, args.skip)
+            if summary is None:
+                print("=> {} failed: nothing logged in {}".format(name, metrics_file))
+            else:
+                print("=> {} finished in {:.2f}s".format(name, wall))
+            results.append((name, summary, wall))
+
+    # best test loss first, failed runs last
+    results.sort(key=lambda result: (result[1] is None, result[1]["best_test_loss"] if result[1] else 0.))
+    width = max(len(name) for name, _, _ in results) + 2
+    print("====> Sweep")
+    print("{:<{}}{:>12}{:>14}{:>14}{:>14}{:>16}{:>10}".format(
+        "run", width, "samples/s", "train loss", "test loss", "best test", "peak mem (MB)", "time (s)"))
+    for name, summary, wall in results:
+        if summary is None:
+            print("{:<{}}{:>12}".format(name, width, "failed"))
+            continue
+        print("{:<{}}{:>12.3f}{:>14.6f}{:>14.6f}{:>14.6f}{:>16.1f}{:>10.1f}".format(
+            name, width, summary["samples_per_sec"], summary["train_loss"], summary["test_loss"],
+            summary["best_test_loss"], summary["peak_memory"] / 2 ** 20, wall
+        ))
+    with open(os.path.join(args.sweep_dir, "sweep.csv"), "w") as f:
+        f.write("run,samples_per_sec,train_loss,test_loss,best_test_loss,peak_memory,wall_time\n")
+        for name, summary, wall in results:
+            if summary is None:
+                f.write("{},,,,,,{}\n".format(name, wall))
+                continue
+            f.write("{},{},{},{},{},{},{}\n".format(
+                name, summary["samples_per_sec"], summary["train_loss"], summary["test_loss"],
+                summary["best_test_loss"], summary["peak_memory"], wall
+            ))
+
+if __name__ == "__main__":
+    main(*parse_args())
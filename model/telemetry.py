@@ -0,0 +1,170 @@
+# training telemetry
+
+import os
+import sys
+import json
+import subprocess
+import time
+import resource
+from contextlib import contextmanager
+
+import torch
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_PHASE = NullPhase()
+
+class Telemetry(object):
+    # per-phase wall time, throughput and peak memory, written as one row per logged sub-epoch; the peak memory is
+    # the peak allocated by CUDA, or the largest resident set sampled on the CPU; without a path every call is a no-op
+    PHASES = ["data_wait", "augment", "g_forward", "g_backward", "d_update", "optimizer", "test", "checkpoint"]
+
+    def __init__(self, path, device):
+        self.enabled = bool(path)
+        self.path = path
+        self.cuda = device.type == "cuda"
+        self.csv = path.endswith(".csv")
+        self.reset()
+        if self.enabled and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def reset(self):
+        self.times = dict.fromkeys(self.PHASES, 0.)
+        self.samples = 0
+        self.batches = 0
+        self.start = time.time()
+        # on the CPU, the largest resident set sampled in the sub-epoch
+        self.peak_rss = 0
+        if self.enabled and self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def _phase(self, name):
+        self.sync()
+        tic = time.time()
+        try:
+            yield
+        finally:
+            self.sync()
+            self.times[name] += time.time() - tic
+            self.sample_memory()
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return self._phase(name)
+
+    def iterate(self, loader):
+        # the time spent waiting for the next batch
+        if not self.enabled:
+            for sample in loader:
+                yield sample
+            return
+        iterator = iter(loader)
+        while True:
+            tic = time.time()
+            try:
+                sample = next(iterator)
+            except StopIteration:
+                return
+            self.times["data_wait"] += time.time() - tic
+            yield sample
+
+    def step(self, batch_size):
+        if self.enabled:
+            self.samples += batch_size
+            self.batches += 1
+            self.sample_memory()
+
+    def sample_memory(self):
+        # the resident set at the end of every phase and batch; the process high-water mark (ru_maxrss) never
+        # comes down, so it cannot tell the sub-epochs apart
+        if self.cuda:
+            return
+        try:
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            return
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def peak_memory(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated()
+        if self.peak_rss:
+            return self.peak_rss
+        # without /proc, the high-water mark of the process; ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def log(self, **fields):
+        if not self.enabled:
+            return
+        elapsed = time.time() - self.start
+        row = dict(fields)
+        row.update({"time": time.time(), "elapsed": elapsed, "batches": self.batches, "samples": self.samples,
+                    "samples_per_sec": self.samples / elapsed if elapsed > 0 else 0.,
+                    "peak_memory": self.peak_memory()})
+        row.update(self.times)
+        row["compute"] = elapsed - self.times["data_wait"]
+
+        if self.csv:
+            new_file = not os.path.isfile(self.path)
+            with open(self.path, "a") as f:
+                if new_file:
+                    f.write(",".join(row.keys()) + "\n")
+                f.write(",".join(str(v) for v in row.values()) + "\n")
+        else:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(row) + "\n")
+        self.reset()
+
+# runs of main.py compared by the benchmark scripts
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def main_command(main_args, metrics_file):
+    # a run of main.py logging its telemetry to a fresh metrics_file
+    if os.path.isfile(metrics_file):
+        os.remove(metrics_file)
+    return [sys.executable, "main.py"] + main_args + ["--metrics-file", metrics_file]
+
+def run_main(main_args, metrics_file, skip):
+    # runs main.py to completion and summarizes its telemetry
+    command = main_command(main_args, metrics_file)
+    print("=> running {}".format(" ".join(command)))
+    subprocess.run(command, check=True, cwd=MODEL_DIR)
+    summary = summarize_run(metrics_file, skip) if os.path.isfile(metrics_file) else None
+    if summary is None:
+        raise RuntimeError("nothing logged in {}: is --log-every at most the number of batches?".format(metrics_file))
+    return summary
+
+def summarize_run(path, skip):
+    # throughput and phase times over the logged sub-epochs after the first skip (warm-up), the last and the best
+    # test loss and the peak memory over all of them; None if the run logged no timed sub-epoch
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    test_losses = [row["test_loss"] for row in rows if row.get("test_loss") is not None]
+    timed = rows[skip:] if len(rows) > skip else rows
+    elapsed = sum(row["elapsed"] for row in timed)
+    if not timed or elapsed == 0:
+        return None
+    summary = {"elapsed": elapsed,
+               "samples": sum(row["samples"] for row in timed),
+               "batches": sum(row["batches"] for row in timed),
+               "train_loss": rows[-1]["loss"],
+               "test_loss": test_losses[-1] if test_losses else float("nan"),
+               "best_test_loss": min(test_losses) if test_losses else float("nan"),
+               "peak_memory": max(row["peak_memory"] for row in rows)}
+    summary["samples_per_sec"] = summary["samples"] / elapsed
+    for phase in Telemetry.PHASES:
+        summary[phase] = sum(row.get(phase, 0.) for row in timed)
+    return summary
@@ -0,0 +1,97 @@
+# validation during training
+
+import queue
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, DataLoader
+
+from generator import Generator
+
+class CachedSubset(Dataset):
+    # a fixed random subset of the test set (all of it with size 0), every sample loaded once and kept in memory
+    def __init__(self, dataset, size, seed):
+        if 0 < size < len(dataset):
+            self.indices = sorted(np.random.RandomState(seed).choice(len(dataset), size, replace=False).tolist())
+        else:
+            self.indices = list(range(len(dataset)))
+        self.dataset = dataset
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if index not in self.cache:
+            self.cache[index] = self.dataset[self.indices[index]]
+        return self.cache[index]
+
+def validation_loss(g_model, loader, args, device):
+    # the sum of the per-batch test losses
+    mse_loss = nn.MSELoss()
+    test_loss = 0.
+    with torch.no_grad():
+        for sample in loader:
+            v_f = sample["v_f"].to(device)
+            v_b = sample["v_b"].to(device)
+            v_i = sample["v_i"].to(device)
+            fake_volumes = g_model(v_f, v_b, args.training_step, args.wo_ori_volume, args.norm)
+            test_loss += args.volume_loss_weight * mse_loss(v_i, fake_volumes).item()
+    return test_loss
+
+def validation_worker(args, dataset, device, threads, jobs, results):
+    torch.set_num_threads(threads)
+    g_model = Generator(args.upsample_mode, args.forward, args.backward, args.gen_sn, args.residual)
+    g_model.to(device)
+    g_model.eval()
+    # the cached subset lives in this process, so it is loaded once
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        tag, state_dict = job
+        g_model.load_state_dict(state_dict)
+        test_loss = validation_loss(g_model, loader, args, device)
+        results.put((tag, test_loss * args.batch_size / len(dataset)))
+
+class AsyncValidator(object):
+    # a separate process evaluating weight snapshots while training continues; while it is busy with one snapshot
+    # at most one more waits, later ones are skipped
+    def __init__(self, args, dataset, device, threads=1):
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue(maxsize=1)
+        self.results = ctx.Queue()
+        self.pending = 0
+        self.process = ctx.Process(target=validation_worker,
+                                   args=(args, dataset, device, threads, self.jobs, self.results), daemon=True)
+        self.process.start()
+
+    def submit(self, tag, state_dict):
+        snapshot = {k: v.detach().to("cpu", copy=True) for k, v in state_dict.items()}
+        try:
+            self.jobs.put_nowait((tag, snapshot))
+        except queue.Full:
+            return False
+        self.pending += 1
+        return True
+
+    def poll(self, block=False):
+        # (tag, test loss) of the finished snapshots
+        finished = []
+        while self.pending > 0:
+            try:
+                finished.append(self.results.get(block=block))
+            except queue.Empty:
+                break
+            self.pending -= 1
+        return finished
+
+    def close(self):
+        finished = self.poll(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        return finished